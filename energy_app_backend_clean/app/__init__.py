@@ -10,10 +10,51 @@ def create_app(config_class=Config):
     app = Flask(__name__)
     app.config.from_object(config_class)
 
-    db.init_app(app)
+    from app.database import init_database
+    init_database(app)
+
     bcrypt.init_app(app)
 
+    from app.stations import init_stations, stations_cli
+    init_stations(app)
+    app.cli.add_command(stations_cli)
+
+    from app.payments import mpesa_cli, settlements
+    settlements.init_app(app)
+    app.cli.add_command(mpesa_cli)
+
+    from app.callbacks import callback_queue
+    callback_queue.init_app(app)
+
+    from app.events import event_feed
+    event_feed.init_app(app)
+
+    from app.daraja import daraja
+    daraja.init_app(app)
+
+    from app.reference import reference_data, reference_cli
+    reference_data.init_app(app)
+    app.cli.add_command(reference_cli)
+
+    from app.archive import archive_cli
+    app.cli.add_command(archive_cli)
+
+    from app.exports import exports_cli
+    app.cli.add_command(exports_cli)
+
+    from app.rollups import rollups_cli
+    app.cli.add_command(rollups_cli)
+
+    from app.schema import schema_cli
+    app.cli.add_command(schema_cli)
+
+    from app.search import search_cli
+    app.cli.add_command(search_cli)
+
     from app.routes import main
     app.register_blueprint(main)
 
+    from app.instrumentation import init_instrumentation
+    init_instrumentation(app)
+
     return app
@@ -0,0 +1,142 @@
+from datetime import datetime, timedelta
+
+import click
+from flask import current_app
+from flask.cli import AppGroup
+from sqlalchemy import String, exists, func, insert, literal, select
+
+from app import db
+from app.models import (
+    ArchivedMonth, MpesaTransaction, MpesaTransactionArchive, PumpShift, SalesRecord, SalesRecordArchive
+)
+
+archive_cli = AppGroup('archive', help='Move old sales history into the archive tables.')
+
+SALE_COLUMNS = [column.name for column in SalesRecord.__table__.columns]
+MPESA_COLUMNS = [column.name for column in MpesaTransaction.__table__.columns]
+
+
+def month_start(moment):
+    return datetime(moment.year, moment.month, 1)
+
+
+def next_month(start):
+    return datetime(start.year + start.month // 12, start.month % 12 + 1, 1)
+
+
+def archive_cutoff(now=None):
+    """Start of the oldest month kept hot: whole months older than ARCHIVE_AFTER_DAYS are archived."""
+    now = now or datetime.utcnow()
+    return month_start(now - timedelta(days=current_app.config['ARCHIVE_AFTER_DAYS']))
+
+
+def _archivable(start, end):
+    """Settled sales of closed shifts made in [start, end)."""
+    shift_closed = exists().where(PumpShift.pump_shift_id == SalesRecord.pump_shift_id, PumpShift.is_closed == True)
+    return (SalesRecord.sale_time >= start, SalesRecord.sale_time < end,
+            SalesRecord.transaction_status != 'PENDING', shift_closed)
+
+
+def _record_month(label):
+    count, first, last = db.session.query(
+        func.count(SalesRecordArchive.sale_id), func.min(SalesRecordArchive.sale_time),
+        func.max(SalesRecordArchive.sale_time)
+    ).filter(SalesRecordArchive.archive_month == label).one()
+    db.session.merge(ArchivedMonth(archive_month=label, sale_count=count, first_sale_time=first,
+                                   last_sale_time=last, archived_at=datetime.utcnow()))
+
+
+def archive_month(start, batch_size):
+    """Moves one month's archivable sales and their M-Pesa transactions; returns the number of sales moved.
+
+    Each batch of `batch_size` sales is copied and deleted in its own
+    transaction, so locks stay short and an interrupted run can be resumed.
+    """
+    end = next_month(start)
+    label = start.strftime('%Y-%m')
+    sales = SalesRecord.__table__
+    mpesa = MpesaTransaction.__table__
+    moved = 0
+    while True:
+        sale_ids = [row.sale_id for row in db.session.query(SalesRecord.sale_id)
+                    .filter(*_archivable(start, end))
+                    .order_by(SalesRecord.sale_time, SalesRecord.sale_id)
+                    .limit(batch_size)]
+        if not sale_ids:
+            return moved
+
+        db.session.execute(insert(SalesRecordArchive.__table__).from_select(
+            SALE_COLUMNS + ['archive_month'],
+            select(*[sales.c[name] for name in SALE_COLUMNS], literal(label, String))
+            .where(sales.c.sale_id.in_(sale_ids))
+        ))
+        db.session.execute(insert(MpesaTransactionArchive.__table__).from_select(
+            MPESA_COLUMNS + ['archive_month'],
+            select(*[mpesa.c[name] for name in MPESA_COLUMNS], literal(label, String))
+            .where(mpesa.c.sale_id.in_(sale_ids))
+        ))
+        db.session.execute(mpesa.delete().where(mpesa.c.sale_id.in_(sale_ids)))
+        db.session.execute(sales.delete().where(sales.c.sale_id.in_(sale_ids)))
+        _record_month(label)
+        db.session.commit()
+        moved += len(sale_ids)
+
+
+def archive_old_sales(now=None):
+    """Archives every whole month before archive_cutoff(); returns {month: sales moved}.
+
+    Sales still PENDING or in open shifts stay in sales_records. Rollups are
+    left alone: they already count the archived sales.
+    """
+    cutoff = archive_cutoff(now)
+    oldest = db.session.query(func.min(SalesRecord.sale_time)) \
+        .filter(SalesRecord.sale_time < cutoff, SalesRecord.transaction_status != 'PENDING') \
+        .scalar()
+    moved = {}
+    if oldest is None:
+        return moved
+    start = month_start(oldest)
+    while start < cutoff:
+        count = archive_month(start, current_app.config['ARCHIVE_BATCH_SIZE'])
+        if count:
+            moved[start.strftime('%Y-%m')] = count
+        start = next_month(start)
+    return moved
+
+
+def archive_bounds():
+    """Returns (first, last) sale_time of the archived sales, or None while nothing is archived.
+
+    Read from archived_months on every call rather than cached: `flask archive
+    run` writes it from another process, and the table holds a row per month.
+    """
+    first, last = db.session.query(func.min(ArchivedMonth.first_sale_time),
+                                   func.max(ArchivedMonth.last_sale_time)).one()
+    return (first, last) if first is not None else None
+
+
+def archive_overlaps(start=None, end=None):
+    """True if archived sales may fall in the half-open range [start, end)."""
+    bounds = archive_bounds()
+    if bounds is None:
+        return False
+    first, last = bounds
+    return (start is None or start <= last) and (end is None or end > first)
+
+
+@archive_cli.command('run')
+def run_command():
+    """Archive closed-shift sales older than ARCHIVE_AFTER_DAYS; run it monthly, e.g. from cron."""
+    db.create_all()
+    moved = archive_old_sales()
+    for month, count in moved.items():
+        click.echo(f'{month}: archived {count} sales.')
+    click.echo(f'Archived {sum(moved.values())} sales before {archive_cutoff():%Y-%m-%d}.')
+
+
+@archive_cli.command('status')
+def status_command():
+    """List the archived months."""
+    for month in ArchivedMonth.query.order_by(ArchivedMonth.archive_month):
+        click.echo(f'{month.archive_month}: {month.sale_count} sales, '
+                   f'{month.first_sale_time:%Y-%m-%d %H:%M} to {month.last_sale_time:%Y-%m-%d %H:%M}')
@@ -0,0 +1,179 @@
+import hashlib
+import hmac
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout
+from functools import wraps
+
+from flask import current_app, g, jsonify, request
+from itsdangerous import BadSignature, SignatureExpired, URLSafeTimedSerializer
+
+from app import bcrypt, db
+from app.models import User, UserRole
+
+TOKEN_SALT = 'energy-app-session'
+
+Principal = namedtuple('Principal', ['user_id', 'username', 'full_name', 'role', 'is_active', 'password_stamp'])
+
+
+class PasswordCheckBusy(Exception):
+    """Raised when a password check could not start within BCRYPT_QUEUE_TIMEOUT."""
+
+
+def password_stamp(password_hash):
+    """A keyed fingerprint of the password hash; tokens stop validating when the password changes.
+
+    Tokens are signed, not encrypted, so the stamp must not reveal any part of the hash.
+    """
+    key = current_app.config['SECRET_KEY'].encode('utf-8')
+    return hmac.new(key, password_hash.encode('utf-8'), hashlib.sha256).hexdigest()[:16]
+
+
+def hash_rounds(password_hash):
+    """Returns the cost factor encoded in a bcrypt hash ($2b$<rounds>$...)."""
+    try:
+        return int(password_hash.split('$')[2])
+    except (IndexError, ValueError):
+        return None
+
+
+class PasswordVerifier:
+    """Runs bcrypt checks on a small bounded thread pool.
+
+    bcrypt releases the GIL, so the pool size caps how many cores a login storm
+    can occupy; requests beyond it queue, and give up after BCRYPT_QUEUE_TIMEOUT.
+    """
+
+    def __init__(self):
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def _pool(self):
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(
+                    max_workers=current_app.config['BCRYPT_VERIFY_WORKERS'],
+                    thread_name_prefix='bcrypt'
+                )
+            return self._executor
+
+    def _run(self, fn, *args):
+        future = self._pool().submit(fn, *args)
+        try:
+            return future.result(timeout=current_app.config['BCRYPT_QUEUE_TIMEOUT'])
+        except FutureTimeout:
+            if future.cancel():
+                raise PasswordCheckBusy()
+            # Already running; it finishes quickly once started
+            return future.result()
+
+    def check(self, password_hash, password):
+        return self._run(bcrypt.check_password_hash, password_hash, password)
+
+    def hash(self, password, rounds):
+        """Hashes a password with `rounds` on the pool; raises PasswordCheckBusy like check()."""
+        return self._run(bcrypt.generate_password_hash, password, rounds).decode('utf-8')
+
+
+class PrincipalCache:
+    """Caches user/role principals by user id for AUTH_PRINCIPAL_TTL seconds."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries = {}
+
+    def get(self, user_id):
+        with self._lock:
+            entry = self._entries.get(user_id)
+        if entry and entry[1] > time.monotonic():
+            return entry[0]
+
+        row = db.session.query(
+            User.user_id, User.username, User.full_name, UserRole.role_name,
+            User.is_active, User.password_hash
+        ).join(UserRole, User.role_id == UserRole.role_id).filter(User.user_id == user_id).first()
+        if row is None:
+            return None
+
+        principal = Principal(row.user_id, row.username, row.full_name, row.role_name,
+                              bool(row.is_active) if row.is_active is not None else True,
+                              password_stamp(row.password_hash))
+        with self._lock:
+            self._entries[user_id] = (principal, time.monotonic() + current_app.config['AUTH_PRINCIPAL_TTL'])
+        return principal
+
+    def invalidate(self, user_id=None):
+        with self._lock:
+            if user_id is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(user_id, None)
+
+
+password_verifier = PasswordVerifier()
+principals = PrincipalCache()
+
+
+def _serializer():
+    return URLSafeTimedSerializer(current_app.config['SECRET_KEY'], salt=TOKEN_SALT)
+
+
+def issue_token(principal):
+    """Signs a session token for a principal."""
+    return _serializer().dumps({'uid': principal.user_id, 'pw': principal.password_stamp})
+
+
+def principal_from_token(token):
+    """Returns the principal for a valid, unexpired token, or None."""
+    try:
+        data = _serializer().loads(token, max_age=current_app.config['AUTH_TOKEN_MAX_AGE'])
+    except (SignatureExpired, BadSignature):
+        return None
+    principal = principals.get(data.get('uid'))
+    if principal is None or not principal.is_active or principal.password_stamp != data.get('pw'):
+        return None
+    return principal
+
+
+def authenticate(username, password):
+    """Verifies a username/password pair and returns its principal, or None.
+
+    Hashes made with a different cost than BCRYPT_LOG_ROUNDS are re-hashed on a
+    successful login, so changing the configured cost takes effect gradually.
+    """
+    user = User.query.filter_by(username=username).first()
+    if not user or not password or not password_verifier.check(user.password_hash, password):
+        return None
+
+    rounds = current_app.config['BCRYPT_LOG_ROUNDS']
+    if hash_rounds(user.password_hash) != rounds:
+        try:
+            user.password_hash = password_verifier.hash(password, rounds)
+        except PasswordCheckBusy:
+            pass  # the login stands; the hash is upgraded on a later one
+        else:
+            db.session.commit()
+            principals.invalidate(user.user_id)
+
+    return principals.get(user.user_id)
+
+
+def bearer_token():
+    header = request.headers.get('Authorization', '')
+    if header.startswith('Bearer '):
+        return header[len('Bearer '):].strip()
+    return None
+
+
+def login_required(view):
+    """Rejects requests without a valid session token; the principal is available as g.principal."""
+    @wraps(view)
+    def wrapped(*args, **kwargs):
+        token = bearer_token()
+        principal = principal_from_token(token) if token else None
+        if principal is None:
+            return jsonify({'status': 'error', 'message': 'Invalid or expired session token.'}), 401
+        g.principal = principal
+        return view(*args, **kwargs)
+    return wrapped
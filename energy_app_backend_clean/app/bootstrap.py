@@ -0,0 +1,150 @@
+from datetime import datetime
+
+from flask import current_app
+from sqlalchemy import select
+from sqlalchemy.exc import IntegrityError, OperationalError, ProgrammingError
+
+from app import bcrypt, db
+from app.models import (
+    Pump, SalesRecord, SalesRecordArchive, SalesRollup, SchemaMeta, Setting, Shift, Station, User, UserRole
+)
+from app.rollups import rebuild_rollups
+from app.schema import upgrade_columns, upgrade_derived_tables, upgrade_indexes
+from app.search import backfill_search_index
+
+# Bump when the models gain tables, columns or indexes, or the default data changes;
+# databases recorded at an older version are upgraded and re-seeded on the next start
+SCHEMA_VERSION = 3
+
+SCHEMA_META_ID = 1
+
+DEFAULT_ROLES = ('Admin', 'Pump Attendant')
+DEFAULT_SHIFTS = ('Day Shift', 'Night Shift')
+DEFAULT_STATION = {'station_code': 'STN001', 'station_name': 'Main Station'}
+DEFAULT_PUMPS = (('P1', 'Pump One'), ('P2', 'Pump Two'), ('P3', 'Pump Three'))
+# (full_name, username, mobile_no, role, password)
+DEFAULT_USERS = (
+    ('System Administrator', 'admin', '0700123456', 'Admin', 'admin123'),
+    ('John Doe', 'attendant1', '0711223344', 'Pump Attendant', 'pass123'),
+)
+DEFAULT_SETTINGS = {
+    'mpesa_till_number': '174379',
+    'mpesa_consumer_key': 'mock_key',
+    'mpesa_consumer_secret': 'mock_secret',
+    'mpesa_passkey': 'mock_passkey',
+}
+
+
+def applied_version():
+    """The version recorded in schema_meta, or None for a database that was never bootstrapped."""
+    try:
+        with db.engine.connect() as conn:
+            return conn.execute(select(SchemaMeta.version).where(SchemaMeta.id == SCHEMA_META_ID)).scalar()
+    except (OperationalError, ProgrammingError):
+        # schema_meta does not exist yet
+        return None
+
+
+def rollups_missing():
+    """True when there are sales, live or archived, but no sales rollups."""
+    if db.session.query(SalesRollup.station_id).first() is not None:
+        return False
+    return any(db.session.query(model.sale_id).first() is not None for model in (SalesRecord, SalesRecordArchive))
+
+
+def _missing(column, keys):
+    """Returns the `keys` not yet stored in `column`, with one query."""
+    present = {value for (value,) in db.session.execute(select(column).where(column.in_(keys)))}
+    return [key for key in keys if key not in present]
+
+
+def seed_defaults():
+    """Inserts the missing default rows in the session's transaction.
+
+    Each table costs one query for the keys already present and one
+    executemany insert; passwords are only hashed for users actually created.
+    Default pumps are only added to a database without pumps.
+    """
+    roles = UserRole.__table__
+    missing = _missing(roles.c.role_name, DEFAULT_ROLES)
+    if missing:
+        db.session.execute(roles.insert(), [{'role_name': name} for name in missing])
+
+    shifts = Shift.__table__
+    missing = _missing(shifts.c.shift_name, DEFAULT_SHIFTS)
+    if missing:
+        db.session.execute(shifts.insert(), [{'shift_name': name} for name in missing])
+
+    stations = Station.__table__
+    if _missing(stations.c.station_code, [DEFAULT_STATION['station_code']]):
+        db.session.execute(stations.insert(), [dict(DEFAULT_STATION, is_active=True,
+                                                    created_at=datetime.utcnow())])
+
+    pumps = Pump.__table__
+    if db.session.execute(select(pumps.c.pump_id).limit(1)).first() is None:
+        station_id = db.session.execute(
+            select(stations.c.station_id).where(stations.c.station_code == DEFAULT_STATION['station_code'])
+        ).scalar()
+        db.session.execute(pumps.insert(), [
+            {'station_id': station_id, 'pump_no': pump_no, 'pump_name': pump_name, 'is_active': True}
+            for pump_no, pump_name in DEFAULT_PUMPS
+        ])
+
+    users = User.__table__
+    missing = set(_missing(users.c.username, [user[1] for user in DEFAULT_USERS]))
+    if missing:
+        role_ids = dict(db.session.execute(select(roles.c.role_name, roles.c.role_id)).all())
+        db.session.execute(users.insert(), [{
+            'full_name': full_name,
+            'username': username,
+            'mobile_no': mobile_no,
+            'role_id': role_ids[role],
+            'password_hash': bcrypt.generate_password_hash(password).decode('utf-8'),
+            'is_active': True,
+        } for full_name, username, mobile_no, role, password in DEFAULT_USERS if username in missing])
+
+    settings = Setting.__table__
+    missing = _missing(settings.c.setting_key, list(DEFAULT_SETTINGS))
+    if missing:
+        db.session.execute(settings.insert(), [{'setting_key': key, 'setting_value': DEFAULT_SETTINGS[key]}
+                                               for key in missing])
+
+
+def bootstrap_database(force=False):
+    """Brings the database to SCHEMA_VERSION; returns False after a single query if it is already there.
+
+    Otherwise the tables, columns and indexes are created or upgraded, recreated
+    rollups are rebuilt and new search columns backfilled, and then the default
+    data and the new version are written in one transaction. A database at a
+    newer version (during a rolling deploy) is left alone.
+    """
+    version = applied_version()
+    if not force and version is not None and version >= SCHEMA_VERSION:
+        return False
+
+    db.create_all()
+    recreated = upgrade_derived_tables()
+    upgrade_columns()
+    _, skipped = upgrade_indexes()
+    if skipped:
+        current_app.logger.warning('Skipped %s; run `flask schema upgrade-indexes` for details.', ', '.join(skipped))
+
+    # Refill what the upgrade left empty before the version is recorded; an interrupted
+    # refill is picked up again on the next start, since the rollups are then still empty
+    if recreated or rollups_missing():
+        current_app.logger.info('Rebuilt %d sales rollup groups.', rebuild_rollups())
+    indexed = backfill_search_index()
+    if indexed:
+        current_app.logger.info('Indexed the customer numbers of %d sales.', indexed)
+
+    try:
+        seed_defaults()
+        db.session.merge(SchemaMeta(id=SCHEMA_META_ID, version=max(version or 0, SCHEMA_VERSION),
+                                    applied_at=datetime.utcnow()))
+        db.session.commit()
+    except IntegrityError:
+        # Another process bootstrapped the database at the same time
+        db.session.rollback()
+        if (applied_version() or 0) < SCHEMA_VERSION:
+            raise
+    return True
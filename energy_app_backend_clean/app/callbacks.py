@@ -0,0 +1,280 @@
+import heapq
+import json
+import os
+import queue
+import sqlite3
+import threading
+import time
+from collections import namedtuple
+
+from sqlalchemy.exc import OperationalError
+
+from app import db
+from app.payments import CallbackResult, settle_batch
+
+
+# A queued callback: `key` identifies it in the inbox, `attempts` counts the times it found no STK request
+InboxItem = namedtuple('InboxItem', ['key', 'result', 'received_at', 'attempts'])
+
+
+class MemoryInbox:
+    """Callbacks waiting in this process; ones not yet applied are lost if it stops."""
+
+    def __init__(self):
+        self._queue = queue.Queue()
+        self._deferred = []  # heap of (due, seq, InboxItem)
+        self._seq = 0
+        self._lock = threading.Lock()
+
+    def put(self, result):
+        self._queue.put(InboxItem(None, result, time.time(), 0))
+
+    def _due(self):
+        """Requeues deferred items that are due; returns seconds until the next one, or None."""
+        now = time.monotonic()
+        with self._lock:
+            while self._deferred and self._deferred[0][0] <= now:
+                self._queue.put(heapq.heappop(self._deferred)[2])
+            return self._deferred[0][0] - now if self._deferred else None
+
+    def take(self, limit, timeout):
+        """Returns up to `limit` InboxItems, waiting up to `timeout` for the first."""
+        next_due = self._due()
+        try:
+            items = [self._queue.get(timeout=timeout if next_due is None else min(timeout, next_due))]
+        except queue.Empty:
+            return []
+        while len(items) < limit:
+            try:
+                items.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return items
+
+    def done(self, items):
+        pass
+
+    def release(self, items):
+        for item in items:
+            self._queue.put(item)
+
+    def defer(self, item, delay):
+        """Takes `item` again after `delay` seconds, counting one more attempt."""
+        with self._lock:
+            self._seq += 1
+            heapq.heappush(self._deferred, (time.monotonic() + delay, self._seq,
+                                            item._replace(attempts=item.attempts + 1)))
+
+    def pending(self):
+        with self._lock:
+            return self._queue.qsize() + len(self._deferred)
+
+
+class SQLiteInbox:
+    """Callbacks journaled to a local SQLite file, so they survive a restart.
+
+    The workers on one host can share the file: each claims a batch before
+    applying it, and a batch whose worker died is claimed again after
+    `claim_timeout` seconds. A callback redelivered while the first copy is
+    still queued is dropped on insert.
+    """
+
+    def __init__(self, path, claim_timeout):
+        self.path = path
+        self.claim_timeout = claim_timeout
+        self._local = threading.local()
+        self._wake = threading.Event()
+        conn = sqlite3.connect(path)
+        try:
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS callback_inbox ('
+                'id INTEGER PRIMARY KEY, checkout_request_id TEXT NOT NULL UNIQUE, payload TEXT NOT NULL, '
+                'received_at REAL NOT NULL, claimed_by TEXT, claimed_at REAL, '
+                'attempts INTEGER NOT NULL DEFAULT 0, not_before REAL)'
+            )
+            # Journals written before unmatched callbacks were retried lack the retry columns
+            columns = {row[1] for row in conn.execute('PRAGMA table_info(callback_inbox)')}
+            if 'attempts' not in columns:
+                conn.execute('ALTER TABLE callback_inbox ADD COLUMN attempts INTEGER NOT NULL DEFAULT 0')
+            if 'not_before' not in columns:
+                conn.execute('ALTER TABLE callback_inbox ADD COLUMN not_before REAL')
+            conn.commit()
+        finally:
+            conn.close()
+
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+        return conn
+
+    def put(self, result):
+        self._connection().execute(
+            'INSERT OR IGNORE INTO callback_inbox (checkout_request_id, payload, received_at) VALUES (?, ?, ?)',
+            (result.checkout_request_id, json.dumps(result), time.time())
+        )
+        self._wake.set()
+
+    def take(self, limit, timeout):
+        items = self._claim(limit)
+        if not items:
+            # Callbacks put by other workers on this host, and deferred ones, are found on the next poll
+            self._wake.wait(timeout)
+            self._wake.clear()
+            items = self._claim(limit)
+        return items
+
+    def _claim(self, limit):
+        conn = self._connection()
+        now = time.time()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            rows = conn.execute(
+                'SELECT id, payload, received_at, attempts FROM callback_inbox '
+                'WHERE (claimed_at IS NULL OR claimed_at < ?) AND (not_before IS NULL OR not_before <= ?) '
+                'ORDER BY id LIMIT ?',
+                (now - self.claim_timeout, now, limit)
+            ).fetchall()
+            conn.executemany('UPDATE callback_inbox SET claimed_by = ?, claimed_at = ? WHERE id = ?',
+                             [(str(os.getpid()), now, row[0]) for row in rows])
+            conn.execute('COMMIT')
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        return [InboxItem(row[0], CallbackResult(*json.loads(row[1])), row[2], row[3]) for row in rows]
+
+    def done(self, items):
+        self._connection().executemany('DELETE FROM callback_inbox WHERE id = ?', [(item.key,) for item in items])
+
+    def release(self, items):
+        self._connection().executemany('UPDATE callback_inbox SET claimed_by = NULL, claimed_at = NULL WHERE id = ?',
+                                       [(item.key,) for item in items])
+
+    def defer(self, item, delay):
+        self._connection().execute(
+            'UPDATE callback_inbox SET claimed_by = NULL, claimed_at = NULL, attempts = ?, not_before = ? WHERE id = ?',
+            (item.attempts + 1, time.time() + delay, item.key)
+        )
+
+    def pending(self):
+        return self._connection().execute('SELECT COUNT(*) FROM callback_inbox').fetchone()[0]
+
+
+class CallbackQueue:
+    """Write-behind queue between /api/mpesa/callback and the database.
+
+    The endpoint only appends the result to the inbox, so its latency does not
+    depend on the database. One worker thread per process takes whatever has
+    queued up (at most MPESA_CALLBACK_BATCH_SIZE) and applies it with
+    settle_batch in a single transaction; bursts therefore commit in fewer,
+    larger batches. Results are only removed from the inbox once applied (or
+    found to be redeliveries); see _acknowledge for those that arrive before
+    their STK request. With MPESA_CALLBACK_QUEUE_PATH the inbox is a SQLite
+    journal instead of process memory.
+    """
+
+    def __init__(self, app=None):
+        self.app = None
+        self.inbox = MemoryInbox()
+        self._worker = None
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        app.extensions['callback_queue'] = self
+        path = app.config['MPESA_CALLBACK_QUEUE_PATH']
+        if path:
+            self.inbox = SQLiteInbox(path, app.config['MPESA_CALLBACK_CLAIM_TIMEOUT'])
+            # Drain what a previous run left in the journal without waiting for the next callback
+            app.before_request(self._ensure_started)
+        else:
+            self.inbox = MemoryInbox()
+
+    def _ensure_started(self):
+        if self._worker is not None and self._worker.is_alive():
+            return
+        with self._lock:
+            if self._worker is None or not self._worker.is_alive():
+                self._worker = threading.Thread(target=self._run, name='mpesa-callbacks', daemon=True)
+                self._worker.start()
+
+    def submit(self, result):
+        """Queues a CallbackResult for the worker."""
+        self._ensure_started()
+        self.inbox.put(result)
+
+    def _run(self):
+        config = self.app.config
+        while True:
+            try:
+                items = self.inbox.take(config['MPESA_CALLBACK_BATCH_SIZE'], config['MPESA_CALLBACK_POLL_INTERVAL'])
+            except sqlite3.Error:
+                self.app.logger.exception('Could not read the M-Pesa callback journal')
+                time.sleep(config['MPESA_CALLBACK_POLL_INTERVAL'])
+                continue
+            if items:
+                self._apply(items)
+
+    def _apply(self, items):
+        with self.app.app_context():
+            try:
+                _, unknown = settle_batch([item.result for item in items])
+                self._acknowledge(items, set(unknown))
+                return
+            except Exception:
+                db.session.rollback()
+                self.app.logger.exception('Failed to apply %d M-Pesa callbacks as a batch', len(items))
+            finally:
+                db.session.remove()
+
+            # Apply them one by one, so a single bad result cannot hold back the rest
+            unavailable = []
+            for item in items:
+                try:
+                    _, unknown = settle_batch([item.result])
+                    self._acknowledge([item], set(unknown))
+                except OperationalError:
+                    db.session.rollback()
+                    unavailable.append(item)
+                except Exception:
+                    db.session.rollback()
+                    self.app.logger.exception('Dropping M-Pesa callback for %s', item.result.checkout_request_id)
+                    self.inbox.done([item])
+                finally:
+                    db.session.remove()
+
+        if unavailable:
+            # The database is down or locked: keep them queued and back off
+            self.inbox.release(unavailable)
+            time.sleep(self.app.config['MPESA_CALLBACK_POLL_INTERVAL'])
+
+    def _acknowledge(self, items, unknown):
+        """Removes the applied items from the inbox and defers those whose STK request is not recorded yet.
+
+        A callback can arrive before the request that started the push has
+        committed its sale, so an unmatched one is retried with exponential
+        backoff until MPESA_CALLBACK_UNMATCHED_WINDOW after it arrived.
+        """
+        config = self.app.config
+        finished = []
+        for item in items:
+            if item.result.checkout_request_id not in unknown:
+                finished.append(item)
+            elif time.time() - item.received_at < config['MPESA_CALLBACK_UNMATCHED_WINDOW']:
+                delay = min(config['MPESA_CALLBACK_RETRY_BACKOFF'] * (2 ** item.attempts),
+                            config['MPESA_CALLBACK_RETRY_MAX_BACKOFF'])
+                self.inbox.defer(item, delay)
+            else:
+                self.app.logger.warning('Dropping M-Pesa callback for unknown checkout request %s (receipt %s)',
+                                        item.result.checkout_request_id, item.result.mpesa_receipt_number)
+                finished.append(item)
+        if finished:
+            self.inbox.done(finished)
+
+
+callback_queue = CallbackQueue()
@@ -0,0 +1,392 @@
+import base64
+import http.client
+import json
+import queue
+import random
+import threading
+import time
+from collections import namedtuple
+from datetime import datetime, timedelta
+from decimal import Decimal, InvalidOperation
+from urllib.parse import urlparse
+
+from flask import current_app
+from sqlalchemy import delete, insert, select
+
+from app import db
+from app.models import MpesaTokenCache
+from app.search import normalize_mobile, SUBSCRIBER_DIGITS, COUNTRY_CODE
+
+Credentials = namedtuple('Credentials', ['station_id', 'consumer_key', 'consumer_secret',
+                                         'shortcode', 'till_number', 'passkey'])
+
+# Statuses worth retrying for idempotent calls
+TRANSIENT_STATUSES = (429, 500, 502, 503, 504)
+# Errors that mean a pooled keep-alive connection was closed by the server while idle
+STALE_CONNECTION_ERRORS = (http.client.RemoteDisconnected, BrokenPipeError, ConnectionResetError)
+
+
+class DarajaError(Exception):
+    """A Daraja call failed; `status` and `body` are set when Daraja answered.
+
+    `sent` is true when the request reached Daraja but no answer came back, so
+    Daraja may have acted on it.
+    """
+
+    def __init__(self, message, status=None, body=None, sent=False):
+        super().__init__(message)
+        self.status = status
+        self.body = body
+        self.sent = sent
+
+
+class ResponseLost(OSError):
+    """The request was written in full but reading the response failed."""
+
+
+def default_credentials():
+    """The till's credentials from the settings table, falling back to Config."""
+    from app.reference import get_setting
+    config = current_app.config
+    till_number = get_setting('mpesa_till_number') or config['MPESA_TILL_NUMBER']
+    return Credentials(
+        station_id=None,
+        consumer_key=get_setting('mpesa_consumer_key') or config['MPESA_CONSUMER_KEY'],
+        consumer_secret=get_setting('mpesa_consumer_secret') or config['MPESA_CONSUMER_SECRET'],
+        shortcode=config['MPESA_SHORTCODE'] or till_number,
+        till_number=till_number,
+        passkey=get_setting('mpesa_passkey') or config['MPESA_PASSKEY'],
+    )
+
+
+def station_credentials(station_id):
+    """The station's own till credentials; fields it leaves blank come from default_credentials().
+
+    Stations without their own consumer key share the default OAuth token.
+    """
+    from app.reference import reference_data
+    defaults = default_credentials()
+    station = reference_data.get('stations').get(station_id) if station_id is not None else None
+    if station is None:
+        return defaults
+    till_number = station['mpesa_till_number'] or defaults.till_number
+    own_app = bool(station['mpesa_consumer_key'])
+    return Credentials(
+        station_id=station_id if own_app else None,
+        consumer_key=station['mpesa_consumer_key'] if own_app else defaults.consumer_key,
+        consumer_secret=station['mpesa_consumer_secret'] if own_app else defaults.consumer_secret,
+        shortcode=station['mpesa_shortcode'] or (till_number if station['mpesa_till_number'] else defaults.shortcode),
+        till_number=till_number,
+        passkey=station['mpesa_passkey'] or defaults.passkey,
+    )
+
+
+def daraja_phone(mobile_no):
+    """Formats a customer number as Daraja expects it: 2547XXXXXXXX."""
+    digits = normalize_mobile(mobile_no)
+    if not digits or len(digits) != SUBSCRIBER_DIGITS:
+        raise ValueError('Invalid mobile number.')
+    return COUNTRY_CODE + digits
+
+
+def daraja_amount(amount):
+    """The amount in whole shillings, which is all Daraja can charge; raises ValueError for anything else."""
+    try:
+        value = Decimal(str(amount))
+    except InvalidOperation:
+        raise ValueError('Invalid amount.')
+    if not value.is_finite() or value <= 0 or value != value.to_integral_value():
+        raise ValueError('Amount must be a whole number of shillings.')
+    return int(value)
+
+
+class RetryBudget:
+    """Caps retries at a fraction of recent calls, so an outage does not multiply the load on Daraja.
+
+    Every call deposits `ratio` of a retry and every retry spends one; the
+    balance never exceeds `reserve`, which is also what a quiet client starts with.
+    """
+
+    def __init__(self, ratio, reserve):
+        self.ratio = ratio
+        self.reserve = reserve
+        self._balance = reserve
+        self._lock = threading.Lock()
+
+    def deposit(self):
+        with self._lock:
+            self._balance = min(self.reserve, self._balance + self.ratio)
+
+    def withdraw(self):
+        with self._lock:
+            if self._balance < 1:
+                return False
+            self._balance -= 1
+            return True
+
+
+class ConnectionPool:
+    """Keep-alive HTTP(S) connections to one host, reused last-in first-out."""
+
+    def __init__(self, base_url, size, timeout):
+        url = urlparse(base_url)
+        self._connection_class = http.client.HTTPSConnection if url.scheme == 'https' else http.client.HTTPConnection
+        self._host = url.hostname
+        self._port = url.port
+        self._timeout = timeout
+        self._idle = queue.LifoQueue(maxsize=size)
+
+    def _checkout(self):
+        try:
+            return self._idle.get_nowait(), True
+        except queue.Empty:
+            return self._connection_class(self._host, self._port, timeout=self._timeout), False
+
+    def _checkin(self, connection):
+        try:
+            self._idle.put_nowait(connection)
+        except queue.Full:
+            connection.close()
+
+    def request(self, method, path, body=None, headers=None, idempotent=True):
+        """Sends one request and returns (status, body bytes).
+
+        A reused connection the server has closed is replaced and the request
+        sent again, but only if it failed while being written or the request is
+        idempotent; otherwise the server may already be acting on it, and
+        ResponseLost is raised.
+        """
+        while True:
+            connection, reused = self._checkout()
+            try:
+                connection.request(method, path, body, headers or {})
+            except STALE_CONNECTION_ERRORS:
+                connection.close()
+                if reused:
+                    continue  # the server dropped an idle connection before reading the request
+                raise
+            except BaseException:
+                connection.close()
+                raise
+            try:
+                response = connection.getresponse()
+                data = response.read()
+            except (OSError, http.client.HTTPException) as e:
+                connection.close()
+                if reused and idempotent and isinstance(e, STALE_CONNECTION_ERRORS):
+                    continue
+                raise ResponseLost(f'{type(e).__name__}: {e}') from e
+            except BaseException:
+                connection.close()
+                raise
+            if response.will_close:
+                connection.close()
+            else:
+                self._checkin(connection)
+            return response.status, data
+
+    def close(self):
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                return
+
+
+class DarajaClient:
+    """Client for the Daraja OAuth and STK push APIs.
+
+    Calls share one keep-alive connection pool. OAuth tokens are cached per
+    station in memory and in mpesa_token_cache until MPESA_TOKEN_REFRESH_MARGIN
+    before they expire; one thread per station refreshes while the others wait
+    for its token. Token and status calls are retried on timeouts and 5xx
+    answers within a retry budget; STK pushes are never re-sent once Daraja may
+    have received them.
+    """
+
+    def __init__(self, app=None):
+        self.app = None
+        self._pool = None
+        self._budget = None
+        self._tokens = {}  # station_id -> (access_token, expires_at)
+        self._locks = {}
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        app.extensions['daraja'] = self
+
+    def _connections(self):
+        with self._lock:
+            if self._pool is None:
+                config = self.app.config
+                self._pool = ConnectionPool(config['MPESA_API_URL'], config['MPESA_HTTP_POOL_SIZE'],
+                                            config['MPESA_HTTP_TIMEOUT'])
+                self._budget = RetryBudget(config['MPESA_RETRY_BUDGET_RATIO'], config['MPESA_RETRY_BUDGET_RESERVE'])
+            return self._pool
+
+    def _station_lock(self, station_id):
+        with self._lock:
+            return self._locks.setdefault(station_id, threading.Lock())
+
+    def _call(self, method, path, payload=None, headers=None, idempotent=True):
+        """Sends a request, retrying idempotent ones within the budget; returns (status, decoded body)."""
+        pool = self._connections()
+        headers = dict(headers or {})
+        body = None
+        if payload is not None:
+            body = json.dumps(payload).encode('utf-8')
+            headers['Content-Type'] = 'application/json'
+
+        attempts = 1 + (self.app.config['MPESA_HTTP_RETRIES'] if idempotent else 0)
+        self._budget.deposit()
+        for attempt in range(attempts):
+            try:
+                status, data = pool.request(method, path, body, headers, idempotent)
+            except (OSError, http.client.HTTPException) as e:
+                error = DarajaError(f'Daraja {path} failed: {e}', sent=isinstance(e, ResponseLost))
+            else:
+                decoded = _decode(data)
+                if status not in TRANSIENT_STATUSES:
+                    return status, decoded
+                error = DarajaError(f'Daraja {path} returned HTTP {status}', status, decoded)
+            if attempt + 1 == attempts or not self._budget.withdraw():
+                raise error
+            time.sleep(self.app.config['MPESA_HTTP_RETRY_BACKOFF'] * (2 ** attempt) * random.uniform(0.5, 1.5))
+
+    # --- OAuth tokens ---
+
+    def _usable(self, expires_at):
+        margin = timedelta(seconds=self.app.config['MPESA_TOKEN_REFRESH_MARGIN'])
+        return expires_at - margin > datetime.utcnow()
+
+    def access_token(self, credentials):
+        """Returns a valid OAuth token for the credentials' station, fetching one only when needed."""
+        station_id = credentials.station_id
+        cached = self._tokens.get(station_id)
+        if cached and self._usable(cached[1]):
+            return cached[0]
+
+        with self._station_lock(station_id):
+            # Another thread may have refreshed it while this one waited
+            cached = self._tokens.get(station_id)
+            if cached and self._usable(cached[1]):
+                return cached[0]
+
+            stored = self._load_token(station_id)
+            if stored and self._usable(stored[1]):
+                self._tokens[station_id] = stored
+                return stored[0]
+
+            token, expires_at = self._fetch_token(credentials)
+            self._store_token(station_id, token, expires_at)
+            self._tokens[station_id] = (token, expires_at)
+            return token
+
+    def discard_token(self, credentials, token):
+        """Forgets a token Daraja rejected, unless it has already been replaced."""
+        station_id = credentials.station_id
+        with self._station_lock(station_id):
+            cached = self._tokens.get(station_id)
+            if cached and cached[0] == token:
+                del self._tokens[station_id]
+            table = MpesaTokenCache.__table__
+            with db.engine.begin() as conn:
+                conn.execute(delete(table).where(_station_filter(station_id), table.c.access_token == token))
+
+    def _fetch_token(self, credentials):
+        basic = base64.b64encode(f'{credentials.consumer_key}:{credentials.consumer_secret}'.encode('utf-8'))
+        status, body = self._call('GET', '/oauth/v1/generate?grant_type=client_credentials',
+                                  headers={'Authorization': 'Basic ' + basic.decode('ascii')})
+        if status != 200 or not isinstance(body, dict) or not body.get('access_token'):
+            raise DarajaError('Daraja OAuth request was rejected', status, body)
+        expires_in = int(body.get('expires_in') or 3599)
+        return body['access_token'], datetime.utcnow() + timedelta(seconds=expires_in)
+
+    def _load_token(self, station_id):
+        table = MpesaTokenCache.__table__
+        with db.engine.connect() as conn:
+            row = conn.execute(
+                select(table.c.access_token, table.c.expires_at)
+                .where(_station_filter(station_id))
+                .order_by(table.c.expires_at.desc())
+                .limit(1)
+            ).first()
+        return (row.access_token, row.expires_at) if row else None
+
+    def _store_token(self, station_id, token, expires_at):
+        table = MpesaTokenCache.__table__
+        with db.engine.begin() as conn:
+            conn.execute(delete(table).where(_station_filter(station_id)))
+            conn.execute(insert(table).values(station_id=station_id, access_token=token, token_type='Bearer',
+                                              expires_at=expires_at, created_at=datetime.utcnow()))
+
+    def _authorized_call(self, credentials, path, payload, idempotent):
+        """Calls an API with the station's token, renewing it once if Daraja rejects it."""
+        for attempt in range(2):
+            token = self.access_token(credentials)
+            status, body = self._call('POST', path, payload, {'Authorization': 'Bearer ' + token}, idempotent)
+            if status != 401 or attempt:
+                return status, body
+            self.discard_token(credentials, token)
+
+    # --- STK push ---
+
+    def _password(self, credentials, timestamp):
+        raw = f'{credentials.shortcode}{credentials.passkey}{timestamp}'.encode('utf-8')
+        return base64.b64encode(raw).decode('ascii')
+
+    def stk_push(self, credentials, amount, mobile_no, account_reference, description, callback_url):
+        """Starts an STK push and returns Daraja's acknowledgement (CheckoutRequestID, ResponseCode, ...)."""
+        timestamp = datetime.now().strftime('%Y%m%d%H%M%S')
+        phone = daraja_phone(mobile_no)
+        buy_goods = credentials.till_number and credentials.till_number != credentials.shortcode
+        payload = {
+            'BusinessShortCode': credentials.shortcode,
+            'Password': self._password(credentials, timestamp),
+            'Timestamp': timestamp,
+            'TransactionType': 'CustomerBuyGoodsOnline' if buy_goods else 'CustomerPayBillOnline',
+            'Amount': daraja_amount(amount),
+            'PartyA': phone,
+            'PartyB': credentials.till_number if buy_goods else credentials.shortcode,
+            'PhoneNumber': phone,
+            'CallBackURL': callback_url,
+            'AccountReference': str(account_reference)[:12],
+            'TransactionDesc': description[:13],
+        }
+        status, body = self._authorized_call(credentials, '/mpesa/stkpush/v1/processrequest', payload,
+                                             idempotent=False)
+        if status != 200 or not isinstance(body, dict) or body.get('ResponseCode') != '0':
+            raise DarajaError('Daraja rejected the STK push', status, body)
+        return body
+
+    def stk_query(self, credentials, checkout_request_id):
+        """Asks Daraja for the result of an STK push."""
+        timestamp = datetime.now().strftime('%Y%m%d%H%M%S')
+        payload = {
+            'BusinessShortCode': credentials.shortcode,
+            'Password': self._password(credentials, timestamp),
+            'Timestamp': timestamp,
+            'CheckoutRequestID': checkout_request_id,
+        }
+        status, body = self._authorized_call(credentials, '/mpesa/stkpushquery/v1/query', payload, idempotent=True)
+        if status != 200:
+            raise DarajaError('Daraja STK query failed', status, body)
+        return body
+
+
+def _station_filter(station_id):
+    column = MpesaTokenCache.__table__.c.station_id
+    return column.is_(None) if station_id is None else column == station_id
+
+
+def _decode(data):
+    try:
+        return json.loads(data or b'null')
+    except ValueError:
+        return data.decode('utf-8', 'replace')
+
+
+daraja = DarajaClient()
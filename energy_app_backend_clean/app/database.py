@@ -0,0 +1,135 @@
+import threading
+import time
+
+from sqlalchemy import event
+from sqlalchemy.engine import make_url
+from sqlalchemy.pool import QueuePool
+
+from app import db
+
+
+class PoolStats:
+    """Counts connection checkouts and the time requests spent waiting for one."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.checkouts = 0
+        self.wait_seconds_total = 0.0
+        self.wait_seconds_max = 0.0
+        self.timeouts = 0
+
+    def record(self, waited, timed_out=False):
+        with self._lock:
+            if timed_out:
+                self.timeouts += 1
+            else:
+                self.checkouts += 1
+            self.wait_seconds_total += waited
+            self.wait_seconds_max = max(self.wait_seconds_max, waited)
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                'checkouts': self.checkouts,
+                'checkout_timeouts': self.timeouts,
+                'wait_seconds_total': round(self.wait_seconds_total, 6),
+                'wait_seconds_max': round(self.wait_seconds_max, 6),
+                'wait_seconds_avg': round(self.wait_seconds_total / self.checkouts, 6) if self.checkouts else 0.0,
+            }
+
+
+pool_stats = PoolStats()
+
+
+class InstrumentedQueuePool(QueuePool):
+    """QueuePool that records how long each checkout waited for a free connection."""
+
+    def _do_get(self):
+        started = time.perf_counter()
+        try:
+            connection = super()._do_get()
+        except Exception:
+            pool_stats.record(time.perf_counter() - started, timed_out=True)
+            raise
+        pool_stats.record(time.perf_counter() - started)
+        return connection
+
+
+def normalize_database_url(url):
+    """Maps the URL schemes hosting providers hand out onto the installed drivers."""
+    if url.startswith('postgres://'):
+        return 'postgresql://' + url[len('postgres://'):]
+    if url.startswith('mysql://'):
+        return 'mysql+pymysql://' + url[len('mysql://'):]
+    return url
+
+
+def is_memory_sqlite(url):
+    url = make_url(url)
+    return url.get_backend_name() == 'sqlite' and url.database in (None, '', ':memory:')
+
+
+def engine_options(config):
+    """Builds SQLALCHEMY_ENGINE_OPTIONS for the configured database from the DB_* settings."""
+    url = config['SQLALCHEMY_DATABASE_URI']
+    if is_memory_sqlite(url):
+        # Flask-SQLAlchemy gives in-memory databases a single shared connection
+        return {}
+
+    options = {
+        'poolclass': InstrumentedQueuePool,
+        'pool_size': config['DB_POOL_SIZE'],
+        'max_overflow': config['DB_MAX_OVERFLOW'],
+        'pool_timeout': config['DB_POOL_TIMEOUT'],
+        'pool_pre_ping': config['DB_POOL_PRE_PING'],
+    }
+    if make_url(url).get_backend_name() == 'sqlite':
+        # pysqlite waits this long for a lock before raising "database is locked"
+        options['connect_args'] = {'timeout': config['SQLITE_BUSY_TIMEOUT_MS'] / 1000}
+    else:
+        options['pool_recycle'] = config['DB_POOL_RECYCLE']
+    return options
+
+
+def _sqlite_pragmas(config):
+    def set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        cursor.execute('PRAGMA journal_mode=WAL')
+        cursor.execute('PRAGMA synchronous=NORMAL')
+        cursor.execute(f"PRAGMA busy_timeout={int(config['SQLITE_BUSY_TIMEOUT_MS'])}")
+        cursor.execute(f"PRAGMA mmap_size={int(config['SQLITE_MMAP_SIZE'])}")
+        cursor.close()
+    return set_pragmas
+
+
+def init_database(app):
+    """Configures the engine from app.config and initializes Flask-SQLAlchemy.
+
+    SQLite file databases run in WAL mode with synchronous=NORMAL, a busy
+    timeout and memory-mapped reads, so several workers can write concurrently.
+    """
+    app.config['SQLALCHEMY_DATABASE_URI'] = normalize_database_url(app.config['SQLALCHEMY_DATABASE_URI'])
+    if 'SQLALCHEMY_ENGINE_OPTIONS' not in app.config:
+        app.config['SQLALCHEMY_ENGINE_OPTIONS'] = engine_options(app.config)
+
+    db.init_app(app)
+
+    url = app.config['SQLALCHEMY_DATABASE_URI']
+    if make_url(url).get_backend_name() == 'sqlite' and not is_memory_sqlite(url):
+        with app.app_context():
+            event.listen(db.engine, 'connect', _sqlite_pragmas(app.config))
+
+
+def database_status():
+    """Returns the pool's current occupancy and checkout wait statistics."""
+    pool = db.engine.pool
+    status = {'dialect': db.engine.dialect.name, 'pool': pool.__class__.__name__}
+    if isinstance(pool, QueuePool):
+        status.update({
+            'size': pool.size(),
+            'checked_out': pool.checkedout(),
+            'overflow': pool.overflow(),
+            'checked_in': pool.checkedin(),
+        })
+    status.update(pool_stats.snapshot())
+    return status
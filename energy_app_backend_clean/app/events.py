@@ -0,0 +1,252 @@
+import json
+import threading
+import time
+from collections import deque, namedtuple
+from datetime import datetime, timedelta
+
+from sqlalchemy import event, func, or_
+from sqlalchemy.orm import Session
+
+from app import db
+from app.models import AppEvent
+
+FeedEvent = namedtuple('FeedEvent', ['event_id', 'event_type', 'station_id', 'pump_id', 'payload'])
+
+# Rows the poller reads per query
+POLL_BATCH_SIZE = 500
+# Most skipped event ids the poller keeps watching for late commits
+MAX_PENDING_GAPS = 1000
+
+
+def publish_event(event_type, payload, pump_id=None, station_id=None):
+    """Writes an event in the current transaction; subscribers receive it once the transaction commits."""
+    payload = dict(payload, pump_id=pump_id, station_id=station_id)
+    db.session.execute(AppEvent.__table__.insert().values(
+        event_type=event_type, station_id=station_id, pump_id=pump_id,
+        payload=json.dumps(payload, default=str), created_at=datetime.utcnow()
+    ))
+    db.session.info['events_published'] = True
+
+
+def _feed_event(row):
+    return FeedEvent(row.event_id, row.event_type, row.station_id, row.pump_id, row.payload)
+
+
+def format_event(feed_event):
+    return f'id: {feed_event.event_id}\nevent: {feed_event.event_type}\ndata: {feed_event.payload}\n\n'
+
+
+class EventFeed:
+    """Fans committed app_events rows out to the SSE subscribers of this process.
+
+    One poller thread per process reads the rows newer than the last one it saw,
+    every EVENT_POLL_INTERVAL or as soon as this process commits an event, into
+    a short in-memory buffer and wakes the subscribers. Idle subscribers
+    therefore cost no queries, and events written by any worker reach all of
+    them. Reconnecting clients replay what they missed from the table.
+
+    On MySQL and PostgreSQL an id allocated earlier can commit after a later
+    one, so ids skipped by a poll are re-read for EVENT_LATE_COMMIT_WINDOW
+    seconds. Buffered events are numbered in arrival order, and subscribers
+    follow that sequence rather than the event ids, so a late event still
+    reaches them.
+    """
+
+    def __init__(self):
+        self.app = None
+        self._cond = threading.Condition()
+        self._buffer = deque()  # (seq, FeedEvent) in arrival order
+        self._seq = 0
+        self._evicted_upto = 0
+        self._last_id = None
+        self._gaps = {}  # skipped event id -> monotonic time it was skipped
+        self._poller = None
+        self._wake = threading.Event()
+        self._lock = threading.Lock()
+        self.subscribers = 0
+
+    def init_app(self, app):
+        self.app = app
+        app.extensions['event_feed'] = self
+
+    def _ensure_started(self):
+        """Starts the poller at the newest event; call from a request, which provides the app context."""
+        if self._poller is not None and self._poller.is_alive():
+            return
+        with self._lock:
+            if self._poller is None or not self._poller.is_alive():
+                if self._last_id is None:
+                    self._last_id = db.session.query(func.max(AppEvent.event_id)).scalar() or 0
+                self._poller = threading.Thread(target=self._run, name='event-feed', daemon=True)
+                self._poller.start()
+
+    def wake(self):
+        self._wake.set()
+
+    def _run(self):
+        config = self.app.config
+        pruned = time.monotonic()
+        while True:
+            self._wake.wait(config['EVENT_POLL_INTERVAL'])
+            self._wake.clear()
+            with self.app.app_context():
+                try:
+                    self._expire_gaps(config['EVENT_LATE_COMMIT_WINDOW'])
+                    newer = AppEvent.event_id > self._last_id
+                    rows = AppEvent.query \
+                        .filter(or_(newer, AppEvent.event_id.in_(list(self._gaps))) if self._gaps else newer) \
+                        .order_by(AppEvent.event_id) \
+                        .limit(POLL_BATCH_SIZE) \
+                        .all()
+                    if time.monotonic() - pruned > config['EVENT_PRUNE_INTERVAL']:
+                        pruned = time.monotonic()
+                        self._prune(config['EVENT_RETENTION'])
+                except Exception:
+                    db.session.rollback()
+                    self.app.logger.exception('Could not read new events')
+                    continue
+                finally:
+                    db.session.remove()
+            if not rows:
+                continue
+            with self._cond:
+                for row in rows:
+                    if row.event_id > self._last_id:
+                        self._note_gaps(row.event_id)
+                        self._last_id = row.event_id
+                    else:
+                        del self._gaps[row.event_id]
+                    self._seq += 1
+                    self._buffer.append((self._seq, _feed_event(row)))
+                while len(self._buffer) > config['EVENT_BUFFER_SIZE']:
+                    self._evicted_upto = self._buffer.popleft()[0]
+                self._cond.notify_all()
+            if len(rows) == POLL_BATCH_SIZE:
+                self._wake.set()
+
+    def _note_gaps(self, event_id):
+        """Remembers the ids between the last event seen and `event_id`; they may still commit."""
+        now = time.monotonic()
+        for missing in range(self._last_id + 1, min(event_id, self._last_id + 1 + MAX_PENDING_GAPS)):
+            self._gaps[missing] = now
+        while len(self._gaps) > MAX_PENDING_GAPS:
+            del self._gaps[min(self._gaps)]
+
+    def _expire_gaps(self, window):
+        """Stops watching skipped ids older than `window` seconds: rolled back, or committed too late."""
+        cutoff = time.monotonic() - window
+        for event_id in [event_id for event_id, skipped in self._gaps.items() if skipped < cutoff]:
+            del self._gaps[event_id]
+
+    def _prune(self, retention):
+        cutoff = datetime.utcnow() - timedelta(seconds=retention)
+        AppEvent.query.filter(AppEvent.created_at < cutoff).delete(synchronize_session=False)
+        db.session.commit()
+
+    def replay(self, last_event_id, limit):
+        """Returns (missed events, cursor, newest event id) for a client resuming after `last_event_id`.
+
+        The cursor is the buffer position to follow with wait_for. The events are
+        None when more than `limit` were missed; the client should then reload
+        its state. Call from the request, before streaming.
+        """
+        self._ensure_started()
+        with self._cond:
+            cursor, last_id = self._seq, self._last_id
+        if last_event_id is None or last_event_id >= last_id:
+            return [], cursor, last_id
+        rows = AppEvent.query \
+            .filter(AppEvent.event_id > last_event_id, AppEvent.event_id <= last_id) \
+            .order_by(AppEvent.event_id) \
+            .limit(limit + 1) \
+            .all()
+        if len(rows) > limit:
+            return None, cursor, last_id
+        return [_feed_event(row) for row in rows], cursor, last_id
+
+    def wait_for(self, cursor, timeout):
+        """Blocks until events past buffer position `cursor` arrive or `timeout` passes.
+
+        Returns (new events, new cursor), or None if some of them were already evicted.
+        """
+        with self._cond:
+            if self._seq <= cursor:
+                self._cond.wait(timeout)
+            if cursor < self._evicted_upto:
+                return None
+            return [feed_event for seq, feed_event in self._buffer if seq > cursor], self._seq
+
+
+event_feed = EventFeed()
+
+
+class Subscription:
+    """Iterator over the SSE stream of one client, filtered by station and pump.
+
+    It is a plain iterator rather than a generator, so the request is torn
+    down (and its database session released) before streaming starts. Each
+    blocked subscriber waits on a condition variable; under a gevent worker
+    that is a parked greenlet rather than a thread.
+    """
+
+    def __init__(self, feed, replayed, cursor, last_id, station_id=None, pump_ids=None):
+        self.feed = feed
+        self.cursor = cursor
+        self.station_id = station_id
+        self.pump_ids = pump_ids
+        self.heartbeat = feed.app.config['EVENT_HEARTBEAT_INTERVAL']
+        self._out = deque([f'retry: {feed.app.config["EVENT_RETRY_MS"]}\n\n'])
+        if replayed is None:
+            # Too much was missed to replay; the client should reload its state
+            self._out.append(f'id: {last_id}\nevent: reset\ndata: {{}}\n\n')
+        else:
+            self._queue(replayed)
+        self._closed = False
+        with feed._lock:
+            feed.subscribers += 1
+
+    def matches(self, feed_event):
+        if self.station_id is not None and feed_event.station_id != self.station_id:
+            return False
+        return not self.pump_ids or feed_event.pump_id in self.pump_ids
+
+    def _queue(self, feed_events):
+        for feed_event in feed_events:
+            if self.matches(feed_event):
+                self._out.append(format_event(feed_event))
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        while not self._out:
+            if self._closed:
+                raise StopIteration
+            waited = self.feed.wait_for(self.cursor, self.heartbeat)
+            if waited is None:
+                # Fell behind the buffer: end the stream so the client resumes from the table
+                self._closed = True
+                continue
+            feed_events, self.cursor = waited
+            if not feed_events:
+                return ': keep-alive\n\n'
+            self._queue(feed_events)
+        return self._out.popleft()
+
+    def close(self):
+        self._closed = True
+        if self.feed is not None:
+            with self.feed._lock:
+                self.feed.subscribers -= 1
+            self.feed = None
+
+
+@event.listens_for(Session, 'after_commit')
+def _wake_event_feed(session):
+    if session.info.pop('events_published', None):
+        event_feed.wake()
+
+
+@event.listens_for(Session, 'after_rollback')
+def _discard_event_flag(session):
+    session.info.pop('events_published', None)
@@ -0,0 +1,269 @@
+import csv
+import io
+import os
+from decimal import Decimal
+
+import click
+from flask import current_app
+from flask.cli import AppGroup
+
+from app import db
+from app.archive import archive_overlaps
+from app.models import Pump, SalesRecord, SalesRecordArchive, Shift, User
+from app.reconciliation import parse_range
+from app.reports import sales_report_query
+
+exports_cli = AppGroup('exports', help='Write columnar sales exports and analyse them offline.')
+
+EXPORT_COLUMNS = ('sale_id', 'sale_id_no', 'sale_time', 'amount', 'transaction_status', 'mpesa_transaction_code',
+                  'customer_mobile_no', 'pump_id', 'pump_no', 'pump_shift_id', 'shift_name', 'attendant_id',
+                  'attendant_name')
+
+FORMATS = {
+    'csv': ('text/csv', 'csv'),
+    'parquet': ('application/vnd.apache.parquet', 'parquet'),
+    'arrow': ('application/vnd.apache.arrow.stream', 'arrows'),
+}
+
+SUMMARY_DIMENSIONS = ('day', 'pump', 'attendant')
+
+
+class ExportUnavailable(Exception):
+    """The requested format needs an optional package that is not installed."""
+
+
+def _pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.compute
+        import pyarrow.csv
+        import pyarrow.ipc
+        import pyarrow.parquet
+    except ImportError:
+        raise ExportUnavailable('Parquet and Arrow exports need the pyarrow package.')
+    return pyarrow
+
+
+def arrow_schema(pa):
+    return pa.schema([
+        ('sale_id', pa.int64()),
+        ('sale_id_no', pa.string()),
+        ('sale_time', pa.timestamp('us')),
+        ('amount', pa.decimal128(12, 2)),
+        ('transaction_status', pa.string()),
+        ('mpesa_transaction_code', pa.string()),
+        ('customer_mobile_no', pa.string()),
+        ('pump_id', pa.int32()),
+        ('pump_no', pa.string()),
+        ('pump_shift_id', pa.int64()),
+        ('shift_name', pa.string()),
+        ('attendant_id', pa.int32()),
+        ('attendant_name', pa.string()),
+    ])
+
+
+def _export_columns(model):
+    return (model.sale_id, model.sale_id_no, model.sale_time, model.amount, model.transaction_status,
+            model.mpesa_transaction_code, model.customer_mobile_no, model.pump_id, Pump.pump_no,
+            model.pump_shift_id, Shift.shift_name, model.attendant_id, User.full_name)
+
+
+def iter_column_chunks(filters, chunk_size):
+    """Yields the report as {column: tuple of values} chunks of up to `chunk_size` sales.
+
+    Rows come from a server-side cursor and are transposed straight into
+    columns, oldest first; archived sales are read only if the range needs them.
+    """
+    models = [SalesRecord]
+    if archive_overlaps(filters.get('start'), filters.get('end')):
+        models.insert(0, SalesRecordArchive)
+    for model in models:
+        query = sales_report_query(**filters, model=model) \
+            .with_entities(*_export_columns(model)) \
+            .order_by(model.sale_time, model.sale_id)
+        result = db.session.execute(query.statement,
+                                    execution_options={'stream_results': True, 'yield_per': chunk_size})
+        for rows in result.partitions():
+            yield dict(zip(EXPORT_COLUMNS, zip(*rows)))
+
+
+def _csv_column(name, values):
+    if name == 'sale_time':
+        return [value.isoformat() for value in values]
+    if name == 'amount':
+        return [format(value, 'f') for value in values]
+    return values
+
+
+def stream_csv(chunks):
+    """Renders column chunks as CSV, one write per chunk."""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(EXPORT_COLUMNS)
+    for chunk in chunks:
+        writer.writerows(zip(*[_csv_column(name, chunk[name]) for name in EXPORT_COLUMNS]))
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    yield buffer.getvalue()
+
+
+class _StreamSink:
+    """Write-only file object that hands whatever pyarrow wrote so far back to the response."""
+
+    def __init__(self):
+        self._parts = []
+        self._position = 0
+        self.closed = False
+
+    def write(self, data):
+        self._parts.append(bytes(data))
+        self._position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self._position
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def drain(self):
+        data = b''.join(self._parts)
+        self._parts.clear()
+        return data
+
+
+def _record_batch(pa, schema, chunk):
+    return pa.record_batch([pa.array(chunk[field.name], type=field.type) for field in schema], schema=schema)
+
+
+def stream_parquet(chunks):
+    """Renders column chunks as a Parquet file with one row group per chunk."""
+    pa = _pyarrow()
+    schema = arrow_schema(pa)
+    sink = _StreamSink()
+    writer = pa.parquet.ParquetWriter(sink, schema, compression='zstd')
+    for chunk in chunks:
+        writer.write_batch(_record_batch(pa, schema, chunk))
+        yield sink.drain()
+    writer.close()
+    yield sink.drain()
+
+
+def stream_arrow(chunks):
+    """Renders column chunks in the Arrow IPC streaming format."""
+    pa = _pyarrow()
+    schema = arrow_schema(pa)
+    sink = _StreamSink()
+    writer = pa.ipc.new_stream(sink, schema)
+    for chunk in chunks:
+        writer.write_batch(_record_batch(pa, schema, chunk))
+        yield sink.drain()
+    writer.close()
+    yield sink.drain()
+
+
+def export_stream(export_format, filters, chunk_size):
+    """Returns the byte/str chunks of a sales export; raises ExportUnavailable without pyarrow."""
+    if export_format != 'csv':
+        _pyarrow()  # fail before the response starts
+    render = {'csv': stream_csv, 'parquet': stream_parquet, 'arrow': stream_arrow}[export_format]
+    return render(iter_column_chunks(filters, chunk_size))
+
+
+def _read_table(pa, path):
+    if path.endswith('.parquet'):
+        return pa.parquet.read_table(path)
+    if path.endswith(('.arrows', '.arrow')):
+        with pa.OSFile(path, 'rb') as source:
+            return pa.ipc.open_stream(source).read_all()
+    convert = pa.csv.ConvertOptions(column_types=arrow_schema(pa))
+    return pa.csv.read_csv(path, convert_options=convert)
+
+
+def summarize_files(paths, dimension):
+    """Aggregates exported sales files by day, pump or attendant without touching the database.
+
+    Returns groups shaped like rollup_summary's, computed with vectorized
+    Arrow kernels over the files' columns.
+    """
+    pa = _pyarrow()
+    pc = pa.compute
+    table = pa.concat_tables([_read_table(pa, path) for path in paths])
+
+    if dimension == 'day':
+        key = pc.strftime(table['sale_time'], format='%Y-%m-%d')
+    else:
+        key = pc.cast(table[f'{dimension}_id'], pa.string())
+    status = table['transaction_status']
+    # Summed as decimal128, so the totals are exact; they become floats only in the returned groups
+    amount = pc.cast(table['amount'], pa.decimal128(18, 2))
+    is_success = pc.equal(status, 'SUCCESS')
+    table = pa.table({
+        'key': key,
+        'amount': amount,
+        'success': pc.cast(is_success, pa.int64()),
+        'success_amount': pc.if_else(is_success, amount, pa.scalar(Decimal('0.00'), amount.type)),
+        'failed': pc.cast(pc.equal(status, 'FAILED'), pa.int64()),
+    })
+    grouped = table.group_by('key').aggregate([
+        ('key', 'count'), ('amount', 'sum'), ('success', 'sum'), ('success_amount', 'sum'), ('failed', 'sum'),
+    ]).sort_by('key').to_pylist()
+
+    def counters(sale_count, total_amount, success_count, success_amount, failed_count):
+        return {
+            'sale_count': sale_count,
+            'total_amount': float(total_amount),
+            'success_count': success_count,
+            'success_amount': float(success_amount),
+            'failed_count': failed_count,
+            'pending_count': sale_count - success_count - failed_count,
+        }
+
+    columns = ('key_count', 'amount_sum', 'success_sum', 'success_amount_sum', 'failed_sum')
+    groups = [dict(counters(*[row[column] for column in columns]), key=row['key']) for row in grouped]
+    totals = counters(*[sum((row[column] for row in grouped), Decimal(0) if column.endswith('amount_sum') else 0)
+                        for column in columns])
+    return {'dimension': dimension, 'groups': groups, 'totals': totals}
+
+
+@exports_cli.command('write')
+@click.argument('path')
+@click.option('--from', 'start', help='First day (ISO date or datetime) to include.')
+@click.option('--to', 'end', help='Last day to include.')
+@click.option('--pump-id', type=int)
+@click.option('--attendant-id', type=int)
+def write_command(path, start, end, pump_id, attendant_id):
+    """Export sales to PATH; .parquet, .arrows and .csv pick the format."""
+    extension = os.path.splitext(path)[1].lstrip('.')
+    formats = {ext: name for name, (_, ext) in FORMATS.items()}
+    if extension not in formats:
+        raise click.BadParameter('PATH must end in .csv, .parquet or .arrows')
+    start, end = parse_range(start, end)
+    filters = dict(pump_id=pump_id, attendant_id=attendant_id, start=start, end=end)
+    try:
+        chunks = export_stream(formats[extension], filters, current_app.config['SALES_COLUMNAR_CHUNK_SIZE'])
+        with open(path, 'w' if extension == 'csv' else 'wb') as f:
+            for data in chunks:
+                f.write(data)
+    except ExportUnavailable as e:
+        raise click.ClickException(str(e))
+    click.echo(f'Wrote {path}.')
+
+
+@exports_cli.command('summarize')
+@click.argument('paths', nargs=-1, required=True)
+@click.option('--by', 'dimension', type=click.Choice(SUMMARY_DIMENSIONS), default='day')
+def summarize_command(paths, dimension):
+    """Print daily, per-pump or per-attendant totals of exported files."""
+    try:
+        summary = summarize_files(paths, dimension)
+    except ExportUnavailable as e:
+        raise click.ClickException(str(e))
+    click.echo(f'{dimension:<12} {"sales":>8} {"amount":>14} {"paid":>8} {"paid amount":>14} {"failed":>8}')
+    for group in summary['groups'] + [dict(summary['totals'], key='total')]:
+        click.echo(f'{group["key"]:<12} {group["sale_count"]:>8} {group["total_amount"]:>14.2f} '
+                   f'{group["success_count"]:>8} {group["success_amount"]:>14.2f} {group["failed_count"]:>8}')
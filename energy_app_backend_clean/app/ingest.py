@@ -0,0 +1,214 @@
+from datetime import datetime, timezone
+from decimal import Decimal, InvalidOperation
+from types import SimpleNamespace
+
+from sqlalchemy.exc import IntegrityError
+
+from app import db
+from app.events import publish_event
+from app.models import MpesaTransaction, MpesaTransactionArchive, PumpShift, SalesRecord, SalesRecordArchive, User
+from app.payments import transaction_status_for
+from app.reconciliation import reconcile_shift
+from app.rollups import record_sales
+from app.search import index_mobile_numbers, normalize_mobile
+
+TRANSACTION_STATUSES = ('SUCCESS', 'FAILED', 'PENDING')
+
+
+class ItemError(ValueError):
+    """A batch item that cannot be ingested; its message is returned for that item."""
+
+
+def _parse_time(value):
+    if not value:
+        return datetime.utcnow()
+    try:
+        parsed = datetime.fromisoformat(str(value).replace('Z', '+00:00'))
+    except ValueError:
+        raise ItemError('Invalid sale_time.')
+    if parsed.tzinfo is not None:
+        parsed = parsed.astimezone(timezone.utc).replace(tzinfo=None)
+    return parsed
+
+
+def _parse_amount(value):
+    try:
+        amount = Decimal(str(value))
+    except (InvalidOperation, TypeError):
+        raise ItemError('Invalid amount.')
+    if not amount.is_finite() or amount <= 0:
+        raise ItemError('Invalid amount.')
+    return amount.quantize(Decimal('0.01'))
+
+
+def _parse_id(value, field):
+    if isinstance(value, bool):
+        raise ItemError(f'Invalid {field}.')
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        raise ItemError(f'Invalid {field}.')
+
+
+def _validate(item):
+    """Checks one batch item and returns its normalized sale and M-Pesa fields."""
+    if not isinstance(item, dict):
+        raise ItemError('Item must be an object.')
+    for field in ('sale_id_no', 'pump_shift_id', 'attendant_id', 'amount'):
+        if not item.get(field):
+            raise ItemError(f'Missing required field: {field}.')
+
+    sale = {
+        'sale_id_no': str(item['sale_id_no']),
+        'pump_shift_id': _parse_id(item['pump_shift_id'], 'pump_shift_id'),
+        'attendant_id': _parse_id(item['attendant_id'], 'attendant_id'),
+        'amount': _parse_amount(item['amount']),
+        'sale_time': _parse_time(item.get('sale_time')),
+        'customer_mobile_no': item.get('mobile_no'),
+        'mpesa_transaction_code': None,
+        'transaction_status': item.get('transaction_status') or 'PENDING',
+    }
+
+    mpesa = item.get('mpesa')
+    if mpesa is not None and not isinstance(mpesa, dict):
+        raise ItemError('mpesa must be an object.')
+    if mpesa:
+        if not mpesa.get('checkout_request_id') or not sale['customer_mobile_no']:
+            raise ItemError('M-Pesa results need checkout_request_id and mobile_no.')
+        result_code = mpesa.get('result_code')
+        sale['transaction_status'] = transaction_status_for(None if result_code is None else str(result_code))
+        sale['mpesa_transaction_code'] = mpesa.get('mpesa_receipt_number')
+        mpesa = {
+            'mobile_no': sale['customer_mobile_no'],
+            'amount': sale['amount'],
+            'request_time': _parse_time(mpesa.get('request_time') or item.get('sale_time')),
+            'checkout_request_id': str(mpesa['checkout_request_id']),
+            'merchant_request_id': str(mpesa.get('merchant_request_id') or mpesa['checkout_request_id']),
+            'response_code': str(mpesa.get('response_code', '0')),
+            'response_description': mpesa.get('response_description'),
+            'result_code': None if result_code is None else str(result_code),
+            'result_description': mpesa.get('result_description'),
+            'mpesa_receipt_number': mpesa.get('mpesa_receipt_number'),
+        }
+
+    if sale['transaction_status'] not in TRANSACTION_STATUSES:
+        raise ItemError('Invalid transaction_status.')
+    return sale, mpesa
+
+
+def _ingest(items):
+    results = [None] * len(items)
+    accepted = {}  # sale_id_no -> (index, sale, mpesa)
+    checkout_ids = set()
+
+    for index, item in enumerate(items):
+        try:
+            sale, mpesa = _validate(item)
+        except ItemError as e:
+            sale_id_no = item.get('sale_id_no') if isinstance(item, dict) else None
+            results[index] = {'sale_id_no': sale_id_no, 'status': 'error', 'message': str(e)}
+            continue
+        if sale['sale_id_no'] in accepted:
+            results[index] = {'sale_id_no': sale['sale_id_no'], 'status': 'error', 'message': 'Duplicate sale_id_no in batch.'}
+            continue
+        if mpesa and mpesa['checkout_request_id'] in checkout_ids:
+            results[index] = {'sale_id_no': sale['sale_id_no'], 'status': 'error', 'message': 'Duplicate checkout_request_id in batch.'}
+            continue
+        if mpesa:
+            checkout_ids.add(mpesa['checkout_request_id'])
+        accepted[sale['sale_id_no']] = (index, sale, mpesa)
+
+    if accepted:
+        # Idempotency: sales already stored are reported as existing, not inserted again.
+        # sale_id_no and checkout_request_id are unique across stations, so these checks see them all;
+        # the archive is always checked, as a sale can be resent after its month was archived
+        existing = dict(db.session.query(SalesRecord.sale_id_no, SalesRecord.sale_id)
+                        .filter(SalesRecord.sale_id_no.in_(list(accepted)))
+                        .execution_options(all_stations=True).all())
+        existing.update(db.session.query(SalesRecordArchive.sale_id_no, SalesRecordArchive.sale_id)
+                        .filter(SalesRecordArchive.sale_id_no.in_(list(accepted)))
+                        .execution_options(all_stations=True).all())
+        for sale_id_no, sale_id in existing.items():
+            index = accepted.pop(sale_id_no)[0]
+            results[index] = {'sale_id_no': sale_id_no, 'status': 'exists', 'sale_id': sale_id}
+
+    if accepted:
+        shifts = {row.pump_shift_id: row for row in db.session.query(
+            PumpShift.pump_shift_id, PumpShift.station_id, PumpShift.pump_id, PumpShift.shift_id, PumpShift.is_closed
+        ).filter(PumpShift.pump_shift_id.in_({sale['pump_shift_id'] for _, sale, _ in accepted.values()}))}
+        # An unknown attendant would fail the foreign key (and the whole batch) on MySQL and PostgreSQL
+        attendants = {user_id for (user_id,) in db.session.query(User.user_id)
+                      .filter(User.user_id.in_({sale['attendant_id'] for _, sale, _ in accepted.values()}))}
+
+        taken = {checkout for (checkout,) in db.session.query(MpesaTransaction.checkout_request_id)
+                 .filter(MpesaTransaction.checkout_request_id.in_(checkout_ids))
+                 .execution_options(all_stations=True)}
+        taken.update(checkout for (checkout,) in db.session.query(MpesaTransactionArchive.checkout_request_id)
+                     .filter(MpesaTransactionArchive.checkout_request_id.in_(checkout_ids))
+                     .execution_options(all_stations=True))
+
+        for sale_id_no, (index, sale, mpesa) in list(accepted.items()):
+            message = None
+            if sale['pump_shift_id'] not in shifts:
+                message = 'Invalid pump shift ID.'
+            elif sale['attendant_id'] not in attendants:
+                message = 'Invalid attendant ID.'
+            elif mpesa and mpesa['checkout_request_id'] in taken:
+                message = 'checkout_request_id already recorded for another sale.'
+            if message:
+                results[index] = {'sale_id_no': sale_id_no, 'status': 'error', 'message': message}
+                del accepted[sale_id_no]
+
+    if accepted:
+        sale_rows = []
+        for _, sale, _ in accepted.values():
+            sale['pump_id'] = shifts[sale['pump_shift_id']].pump_id
+            sale['station_id'] = shifts[sale['pump_shift_id']].station_id
+            sale['customer_mobile_norm'] = normalize_mobile(sale['customer_mobile_no'])
+            sale_rows.append(sale)
+
+        connection = db.session.connection()
+        connection.execute(SalesRecord.__table__.insert(), sale_rows)
+        sale_ids = dict(db.session.query(SalesRecord.sale_id_no, SalesRecord.sale_id)
+                        .filter(SalesRecord.sale_id_no.in_(list(accepted))).all())
+
+        mpesa_rows = [dict(mpesa, sale_id=sale_ids[sale_id_no], station_id=sale['station_id'])
+                      for sale_id_no, (_, sale, mpesa) in accepted.items() if mpesa]
+        if mpesa_rows:
+            connection.execute(MpesaTransaction.__table__.insert(), mpesa_rows)
+
+        index_mobile_numbers(connection, [row['customer_mobile_norm'] for row in sale_rows])
+        record_sales([(SimpleNamespace(**sale), shifts[sale['pump_shift_id']].shift_id) for sale in sale_rows])
+
+        for sale_id_no, (index, sale, mpesa) in accepted.items():
+            results[index] = {'sale_id_no': sale_id_no, 'status': 'created', 'sale_id': sale_ids[sale_id_no]}
+            publish_event('sale.created', {
+                'sale_id': sale_ids[sale_id_no], 'sale_id_no': sale_id_no, 'pump_shift_id': sale['pump_shift_id'],
+                'attendant_id': sale['attendant_id'], 'amount': float(sale['amount']),
+                'checkout_request_id': mpesa['checkout_request_id'] if mpesa else None,
+                'transaction_status': sale['transaction_status']
+            }, pump_id=sale['pump_id'], station_id=sale['station_id'])
+
+        # Sales captured offline can arrive after their shift was closed; its stored reconciliation is redone
+        for pump_shift_id in sorted({sale['pump_shift_id'] for sale in sale_rows}):
+            if shifts[pump_shift_id].is_closed:
+                reconcile_shift(pump_shift_id)
+
+    db.session.commit()
+    return results
+
+
+def ingest_sales(items):
+    """Stores a batch of offline-captured sales and their M-Pesa results in one transaction.
+
+    Items are validated together, pump shifts are resolved with one query and the
+    rows are written with executemany. Sales whose sale_id_no is already stored
+    are reported as 'exists', so a device can safely resend a batch. Returns one
+    result per item, in order.
+    """
+    try:
+        return _ingest(items)
+    except IntegrityError:
+        # A concurrent request stored some of these sales first; the retry reports them as existing
+        db.session.rollback()
+        return _ingest(items)
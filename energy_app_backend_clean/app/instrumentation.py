@@ -0,0 +1,265 @@
+import inspect
+import os
+import sys
+import threading
+import time
+from collections import Counter, defaultdict, deque
+
+from flask import Blueprint, Response, current_app, jsonify, request
+from sqlalchemy import event
+
+from app import db
+
+metrics_bp = Blueprint('metrics', __name__)
+
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+PROFILE_STACK_DEPTH = 40
+PROFILE_TOP_STACKS = 10
+
+_local = threading.local()
+
+
+class RequestStats:
+    """SQL statements and database time of the request running on this thread."""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.statements = 0
+        self.db_seconds = 0.0
+        self.status = None
+        self.streamed = False
+
+
+def current_stats():
+    return getattr(_local, 'stats', None)
+
+
+class Metrics:
+    """Per-process request and SQL counters, rendered in the Prometheus text format."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.requests = defaultdict(int)  # (endpoint, method, status) -> count
+        self.durations = {}  # endpoint -> [bucket counts, sum, count]
+        self.statements = defaultdict(int)
+        self.db_seconds = defaultdict(float)
+
+    def record(self, endpoint, method, status, seconds, stats):
+        with self._lock:
+            self.requests[(endpoint, method, status)] += 1
+            histogram = self.durations.setdefault(endpoint, [[0] * len(DURATION_BUCKETS), 0.0, 0])
+            for i, bound in enumerate(DURATION_BUCKETS):
+                if seconds <= bound:
+                    histogram[0][i] += 1
+            histogram[1] += seconds
+            histogram[2] += 1
+            self.statements[endpoint] += stats.statements
+            self.db_seconds[endpoint] += stats.db_seconds
+
+    def render(self):
+        lines = []
+        with self._lock:
+            lines += ['# HELP energy_http_requests_total Requests handled, by endpoint, method and status.',
+                      '# TYPE energy_http_requests_total counter']
+            for (endpoint, method, status), count in sorted(self.requests.items()):
+                lines.append(f'energy_http_requests_total{{endpoint="{endpoint}",method="{method}",'
+                             f'status="{status}"}} {count}')
+
+            lines += ['# HELP energy_http_request_duration_seconds Request latency, by endpoint.',
+                      '# TYPE energy_http_request_duration_seconds histogram']
+            for endpoint, (buckets, total, count) in sorted(self.durations.items()):
+                for bound, bucket_count in zip(DURATION_BUCKETS, buckets):
+                    lines.append(f'energy_http_request_duration_seconds_bucket{{endpoint="{endpoint}",'
+                                 f'le="{bound}"}} {bucket_count}')
+                lines.append(f'energy_http_request_duration_seconds_bucket{{endpoint="{endpoint}",le="+Inf"}} {count}')
+                lines.append(f'energy_http_request_duration_seconds_sum{{endpoint="{endpoint}"}} {total:.6f}')
+                lines.append(f'energy_http_request_duration_seconds_count{{endpoint="{endpoint}"}} {count}')
+
+            lines += ['# HELP energy_db_statements_total SQL statements issued while handling requests, by endpoint.',
+                      '# TYPE energy_db_statements_total counter']
+            for endpoint, count in sorted(self.statements.items()):
+                lines.append(f'energy_db_statements_total{{endpoint="{endpoint}"}} {count}')
+
+            lines += ['# HELP energy_db_statement_seconds_total Time spent executing SQL while handling requests.',
+                      '# TYPE energy_db_statement_seconds_total counter']
+            for endpoint, seconds in sorted(self.db_seconds.items()):
+                lines.append(f'energy_db_statement_seconds_total{{endpoint="{endpoint}"}} {seconds:.6f}')
+
+        from app.database import database_status
+        status = database_status()
+        gauges = [
+            ('energy_db_pool_size', 'size', 'gauge', 'Connections the pool keeps open.'),
+            ('energy_db_pool_checked_out', 'checked_out', 'gauge', 'Connections currently in use.'),
+            ('energy_db_pool_overflow', 'overflow', 'gauge', 'Connections open beyond the pool size.'),
+            ('energy_db_pool_checkouts_total', 'checkouts', 'counter', 'Connection checkouts.'),
+            ('energy_db_pool_checkout_timeouts_total', 'checkout_timeouts', 'counter',
+             'Checkouts that gave up waiting for a connection.'),
+            ('energy_db_pool_wait_seconds_total', 'wait_seconds_total', 'counter',
+             'Time spent waiting for a free connection.'),
+        ]
+        for name, key, kind, description in gauges:
+            if key in status:
+                lines += [f'# HELP {name} {description}', f'# TYPE {name} {kind}', f'{name} {status[key]}']
+        return '\n'.join(lines) + '\n'
+
+
+class SlowRequestProfiler:
+    """Samples the stacks of in-flight requests and keeps the profiles of slow ones.
+
+    One background thread wakes every PROFILE_SAMPLE_INTERVAL seconds and counts
+    the current stack of each request thread. When a request finishes slower
+    than SLOW_REQUEST_PROFILE_MS, its most frequent stacks are logged and kept
+    for /api/metrics/slow; faster requests are discarded.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._active = {}  # thread ident -> Counter of collapsed stacks
+        self._thread = None
+        self.recent = deque(maxlen=20)
+
+    def start(self, interval):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, args=(interval,),
+                                                name='slow-request-profiler', daemon=True)
+                self._thread.start()
+
+    def begin(self):
+        with self._lock:
+            self._active[threading.get_ident()] = Counter()
+
+    def end(self, seconds, threshold_ms):
+        with self._lock:
+            samples = self._active.pop(threading.get_ident(), None)
+        if not samples or seconds * 1000 < threshold_ms:
+            return None
+        profile = {
+            'endpoint': request.endpoint,
+            'method': request.method,
+            'path': request.full_path.rstrip('?'),
+            'duration_ms': round(seconds * 1000, 1),
+            'samples': sum(samples.values()),
+            'stacks': [{'stack': stack, 'samples': count}
+                       for stack, count in samples.most_common(PROFILE_TOP_STACKS)],
+        }
+        with self._lock:
+            self.recent.append(profile)
+        return profile
+
+    def _run(self, interval):
+        while True:
+            time.sleep(interval)
+            frames = sys._current_frames()
+            with self._lock:
+                for ident, samples in self._active.items():
+                    frame = frames.get(ident)
+                    if frame is not None:
+                        samples[_collapse(frame)] += 1
+
+
+def _collapse(frame):
+    """Renders a stack as 'outer;...;inner' file:function:line entries."""
+    entries = []
+    while frame is not None and len(entries) < PROFILE_STACK_DEPTH:
+        code = frame.f_code
+        entries.append(f'{os.path.basename(code.co_filename)}:{code.co_name}:{frame.f_lineno}')
+        frame = frame.f_back
+    return ';'.join(reversed(entries))
+
+
+metrics = Metrics()
+profiler = SlowRequestProfiler()
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if context is not None:
+        context._instrumentation_started = time.perf_counter()
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    stats = current_stats()
+    if stats is None:
+        return  # background work outside a request
+    stats.statements += 1
+    started = getattr(context, '_instrumentation_started', None)
+    if started is not None:
+        stats.db_seconds += time.perf_counter() - started
+
+
+def _start_request():
+    _local.stats = RequestStats()
+    if current_app.config['SLOW_REQUEST_PROFILE_MS']:
+        profiler.begin()
+
+
+def _finish_response(response):
+    stats = current_stats()
+    if stats is None:
+        return response
+    stats.status = response.status_code
+    stats.streamed = inspect.isgenerator(response.response)
+    if current_app.config['SERVER_TIMING_HEADER']:
+        elapsed = (time.perf_counter() - stats.started) * 1000
+        response.headers.add('Server-Timing', f'db;dur={stats.db_seconds * 1000:.2f};desc="{stats.statements} queries"')
+        response.headers.add('Server-Timing', f'app;dur={elapsed:.2f}')
+    return response
+
+
+def _finish_request(exc):
+    stats = current_stats()
+    if stats is None:
+        return
+    if stats.streamed:
+        # stream_with_context tears the request down again once the body has been sent;
+        # record it then, so exports are measured in full
+        stats.streamed = False
+        return
+    _local.stats = None
+    seconds = time.perf_counter() - stats.started
+    status = 500 if exc is not None or stats.status is None else stats.status
+    metrics.record(request.endpoint or 'unmatched', request.method, status, seconds, stats)
+
+    threshold = current_app.config['SLOW_REQUEST_PROFILE_MS']
+    if threshold:
+        profile = profiler.end(seconds, threshold)
+        if profile:
+            current_app.logger.warning(
+                'Slow request %s %s took %.0f ms (%d queries); hottest stack: %s',
+                profile['method'], profile['path'], profile['duration_ms'], stats.statements,
+                profile['stacks'][0]['stack'] if profile['stacks'] else 'none'
+            )
+
+
+def init_instrumentation(app):
+    """Registers request instrumentation when INSTRUMENTATION_ENABLED is set.
+
+    Counts and times every SQL statement through engine events, times each
+    route, adds Server-Timing headers, serves the counters at /api/metrics and,
+    with SLOW_REQUEST_PROFILE_MS, profiles slow requests. Counters are per process.
+    """
+    if not app.config['INSTRUMENTATION_ENABLED']:
+        return
+
+    with app.app_context():
+        event.listen(db.engine, 'before_cursor_execute', _before_cursor_execute)
+        event.listen(db.engine, 'after_cursor_execute', _after_cursor_execute)
+
+    app.before_request(_start_request)
+    app.after_request(_finish_response)
+    app.teardown_request(_finish_request)
+    app.register_blueprint(metrics_bp)
+
+    if app.config['SLOW_REQUEST_PROFILE_MS']:
+        profiler.start(app.config['PROFILE_SAMPLE_INTERVAL'])
+
+
+@metrics_bp.route('/api/metrics', methods=['GET'])
+def prometheus_metrics():
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+
+@metrics_bp.route('/api/metrics/slow', methods=['GET'])
+def slow_requests():
+    # Most recent slow-request profiles, newest first
+    return jsonify(list(reversed(profiler.recent))), 200
@@ -1,6 +1,6 @@
-'''
 from app import db, bcrypt
 from datetime import datetime
+from sqlalchemy import DDL, event
 
 class UserRole(db.Model):
     __tablename__ = 'user_roles'
@@ -28,16 +28,58 @@ class User(db.Model):
     def check_password(self, password):
         return bcrypt.check_password_hash(self.password_hash, password)
 
-class Pump(db.Model):
+class Station(db.Model):
+    __tablename__ = 'stations'
+    station_id = db.Column(db.Integer, primary_key=True)
+    station_code = db.Column(db.String(20), unique=True, nullable=False) # e.g. STN001, NRB-001
+    station_name = db.Column(db.String(100), nullable=False)
+    city = db.Column(db.String(100))
+    county = db.Column(db.String(50))
+    region = db.Column(db.String(50))
+    # Each station may have its own till; blank fields fall back to the settings table
+    mpesa_till_number = db.Column(db.String(20))
+    mpesa_shortcode = db.Column(db.String(20))
+    mpesa_passkey = db.Column(db.String(255))
+    mpesa_consumer_key = db.Column(db.String(100))
+    mpesa_consumer_secret = db.Column(db.String(100))
+    is_active = db.Column(db.Boolean, default=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    pumps = db.relationship('Pump', backref='station', lazy=True)
+
+class StationScoped:
+    # Rows that belong to one station; requests scoped to a station only see theirs (app/stations.py)
+    pass
+
+class Pump(StationScoped, db.Model):
     __tablename__ = 'pumps'
     pump_id = db.Column(db.Integer, primary_key=True)
-    pump_no = db.Column(db.String(10), unique=True, nullable=False)
+    station_id = db.Column(db.Integer, db.ForeignKey('stations.station_id'), nullable=True)
+    pump_no = db.Column(db.String(10), nullable=False)
     pump_name = db.Column(db.String(50), nullable=False)
     is_active = db.Column(db.Boolean, default=True)
     
     shifts = db.relationship('PumpShift', backref='pump', lazy=True)
     sales = db.relationship('SalesRecord', backref='pump', lazy=True)
 
+    __table_args__ = (
+        # Pump numbers repeat across stations
+        db.Index('uq_pumps_station_pump_no', 'station_id', 'pump_no', unique=True),
+        # NULL station_ids never collide above, so pumps without a station get their own index
+        # (see MYSQL_UNASSIGNED_PUMP_GUARD for MySQL)
+        db.Index('uq_pumps_unassigned_pump_no', 'pump_no', unique=True,
+                 sqlite_where=db.text('station_id IS NULL'),
+                 postgresql_where=db.text('station_id IS NULL')).ddl_if(dialect=('sqlite', 'postgresql')),
+    )
+
+# The same generated-column guard as MYSQL_OPEN_SHIFT_GUARD, holding pump_no only while station_id is NULL
+MYSQL_UNASSIGNED_PUMP_GUARD = (
+    'ALTER TABLE pumps ADD COLUMN unassigned_pump_no VARCHAR(10) AS (IF(station_id IS NULL, pump_no, NULL)) STORED',
+    'CREATE UNIQUE INDEX uq_pumps_unassigned_pump_no ON pumps (unassigned_pump_no)',
+)
+for statement in MYSQL_UNASSIGNED_PUMP_GUARD:
+    event.listen(Pump.__table__, 'after_create', DDL(statement).execute_if(dialect='mysql'))
+
 class Shift(db.Model):
     __tablename__ = 'shifts'
     shift_id = db.Column(db.Integer, primary_key=True)
@@ -45,9 +87,10 @@ class Shift(db.Model):
     
     pump_shifts = db.relationship('PumpShift', backref='shift', lazy=True)
 
-class PumpShift(db.Model):
+class PumpShift(StationScoped, db.Model):
     __tablename__ = 'pump_shifts'
     pump_shift_id = db.Column(db.Integer, primary_key=True)
+    station_id = db.Column(db.Integer, db.ForeignKey('stations.station_id'), nullable=True) # the pump's station
     pump_id = db.Column(db.Integer, db.ForeignKey('pumps.pump_id'), nullable=False)
     shift_id = db.Column(db.Integer, db.ForeignKey('shifts.shift_id'), nullable=False)
     opening_attendant_id = db.Column(db.Integer, db.ForeignKey('users.user_id'), nullable=False)
@@ -60,9 +103,27 @@ class PumpShift(db.Model):
     
     sales = db.relationship('SalesRecord', backref='pump_shift', lazy=True)
 
-class SalesRecord(db.Model):
+    __table_args__ = (
+        db.Index('ix_pump_shifts_pump_open', 'pump_id', 'is_closed', 'opening_time'),
+        db.Index('ix_pump_shifts_station_opening', 'station_id', 'opening_time'),
+        # At most one open shift per pump (see MYSQL_OPEN_SHIFT_GUARD for MySQL)
+        db.Index('uq_pump_shifts_one_open', 'pump_id', unique=True,
+                 sqlite_where=db.text('is_closed = 0'),
+                 postgresql_where=db.text('NOT is_closed')).ddl_if(dialect=('sqlite', 'postgresql')),
+    )
+
+# MySQL lacks partial indexes, so a stored generated column holds pump_id only while the shift is open
+MYSQL_OPEN_SHIFT_GUARD = (
+    'ALTER TABLE pump_shifts ADD COLUMN open_pump_id INT AS (IF(COALESCE(is_closed, 0), NULL, pump_id)) STORED',
+    'CREATE UNIQUE INDEX uq_pump_shifts_one_open ON pump_shifts (open_pump_id)',
+)
+for statement in MYSQL_OPEN_SHIFT_GUARD:
+    event.listen(PumpShift.__table__, 'after_create', DDL(statement).execute_if(dialect='mysql'))
+
+class SalesRecord(StationScoped, db.Model):
     __tablename__ = 'sales_records'
     sale_id = db.Column(db.Integer, primary_key=True)
+    station_id = db.Column(db.Integer, db.ForeignKey('stations.station_id'), nullable=True)
     sale_id_no = db.Column(db.String(50), unique=True, nullable=False)
     pump_shift_id = db.Column(db.Integer, db.ForeignKey('pump_shifts.pump_shift_id'), nullable=False)
     pump_id = db.Column(db.Integer, db.ForeignKey('pumps.pump_id'), nullable=False)
@@ -70,14 +131,26 @@ class SalesRecord(db.Model):
     sale_time = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
     amount = db.Column(db.Numeric(10, 2), nullable=False)
     customer_mobile_no = db.Column(db.String(15), nullable=True)
+    customer_mobile_norm = db.Column(db.String(15), nullable=True) # subscriber digits, set by app/search.py
     mpesa_transaction_code = db.Column(db.String(50), nullable=True)
     transaction_status = db.Column(db.String(50), nullable=False) # e.g., SUCCESS, PENDING, FAILED
     
     mpesa_transactions = db.relationship('MpesaTransaction', backref='sale', lazy=True)
 
-class MpesaTransaction(db.Model):
+    __table_args__ = (
+        db.Index('ix_sales_records_sale_time', 'sale_time', 'sale_id'),
+        db.Index('ix_sales_records_station_time', 'station_id', 'sale_time', 'sale_id'),
+        db.Index('ix_sales_records_pump_time', 'pump_id', 'sale_time'),
+        db.Index('ix_sales_records_attendant_time', 'attendant_id', 'sale_time'),
+        db.Index('ix_sales_records_pump_shift', 'pump_shift_id'),
+        db.Index('ix_sales_records_customer_mobile', 'customer_mobile_no'),
+        db.Index('ix_sales_records_mobile_norm_time', 'customer_mobile_norm', 'sale_time'),
+    )
+
+class MpesaTransaction(StationScoped, db.Model):
     __tablename__ = 'mpesa_transactions'
     transaction_id = db.Column(db.Integer, primary_key=True)
+    station_id = db.Column(db.Integer, db.ForeignKey('stations.station_id'), nullable=True)
     sale_id = db.Column(db.Integer, db.ForeignKey('sales_records.sale_id'), nullable=True)
     mobile_no = db.Column(db.String(15), nullable=False)
     amount = db.Column(db.Numeric(10, 2), nullable=False)
@@ -90,76 +163,152 @@ class MpesaTransaction(db.Model):
     result_description = db.Column(db.Text)
     mpesa_receipt_number = db.Column(db.String(50), nullable=True)
 
+    __table_args__ = (
+        db.Index('uq_mpesa_transactions_checkout', 'checkout_request_id', unique=True),
+        db.Index('ix_mpesa_transactions_sale', 'sale_id'),
+        db.Index('ix_mpesa_transactions_station_time', 'station_id', 'request_time'),
+        # Redelivered callbacks are recognised by their receipt number
+        db.Index('ix_mpesa_transactions_receipt', 'mpesa_receipt_number'),
+    )
+
 class Setting(db.Model):
     __tablename__ = 'settings'
     setting_key = db.Column(db.String(50), primary_key=True)
     setting_value = db.Column(db.String(255))
 
+class AppEvent(db.Model):
+    __tablename__ = 'app_events'
+    # Shift and sale changes streamed to dashboards by /api/events/stream (app/events.py)
+    event_id = db.Column(db.Integer, primary_key=True)
+    event_type = db.Column(db.String(50), nullable=False)
+    station_id = db.Column(db.Integer, nullable=True)
+    pump_id = db.Column(db.Integer, nullable=True)
+    payload = db.Column(db.Text, nullable=False)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+    __table_args__ = (db.Index('ix_app_events_created', 'created_at'),)
+
+class MpesaTokenCache(db.Model):
+    __tablename__ = 'mpesa_token_cache'
+    # Daraja OAuth tokens shared by all workers (app/daraja.py); station_id NULL is the default credentials
+    id = db.Column(db.Integer, primary_key=True)
+    station_id = db.Column(db.Integer, nullable=True)
+    access_token = db.Column(db.Text, nullable=False)
+    token_type = db.Column(db.String(50), default='Bearer')
+    expires_at = db.Column(db.DateTime, nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    __table_args__ = (
+        db.Index('ix_mpesa_token_cache_station', 'station_id'),
+    )
+
+class MobileSearchToken(db.Model):
+    __tablename__ = 'mobile_search_tokens'
+    # Every suffix of each distinct normalized customer number; a substring search is a prefix range scan
+    token = db.Column(db.String(15), primary_key=True)
+    mobile_norm = db.Column(db.String(15), primary_key=True)
+
+class SalesRollup(StationScoped, db.Model):
+    __tablename__ = 'sales_rollups'
+    station_id = db.Column(db.Integer, primary_key=True, autoincrement=False, default=0) # 0 for sales without a station
+    dimension = db.Column(db.String(20), primary_key=True) # pump, pump_shift, shift, attendant, hour, day
+    # Day of the sales counted in the row ('%Y-%m-%d'), or their hour for the hour dimension,
+    # so any dimension can be totalled over a date range
+    period_key = db.Column(db.String(13), primary_key=True)
+    group_key = db.Column(db.String(50), primary_key=True)
+    sale_count = db.Column(db.Integer, nullable=False, default=0)
+    total_amount = db.Column(db.Numeric(14, 2), nullable=False, default=0)
+    success_count = db.Column(db.Integer, nullable=False, default=0)
+    success_amount = db.Column(db.Numeric(14, 2), nullable=False, default=0)
+    failed_count = db.Column(db.Integer, nullable=False, default=0)
+
+class ShiftReconciliation(db.Model):
+    __tablename__ = 'shift_reconciliations'
+    # Computed by app/reconciliation.py when the pump shift is closed, as of closing time
+    pump_shift_id = db.Column(db.Integer, db.ForeignKey('pump_shifts.pump_shift_id'), primary_key=True)
+    meter_volume = db.Column(db.Numeric(12, 2), nullable=True) # closing minus opening meter reading
+    sale_count = db.Column(db.Integer, nullable=False, default=0)
+    total_amount = db.Column(db.Numeric(14, 2), nullable=False, default=0)
+    mpesa_collected = db.Column(db.Numeric(14, 2), nullable=False, default=0) # SUCCESS sales
+    failed_count = db.Column(db.Integer, nullable=False, default=0)
+    failed_amount = db.Column(db.Numeric(14, 2), nullable=False, default=0)
+    pending_count = db.Column(db.Integer, nullable=False, default=0)
+    pending_amount = db.Column(db.Numeric(14, 2), nullable=False, default=0)
+    computed_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+class SalesRecordArchive(StationScoped, db.Model):
+    __tablename__ = 'sales_records_archive'
+    # Sales of closed shifts moved out of sales_records by app/archive.py, tagged with their month
+    sale_id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    station_id = db.Column(db.Integer, db.ForeignKey('stations.station_id'), nullable=True)
+    sale_id_no = db.Column(db.String(50), nullable=False)
+    pump_shift_id = db.Column(db.Integer, db.ForeignKey('pump_shifts.pump_shift_id'), nullable=False)
+    pump_id = db.Column(db.Integer, db.ForeignKey('pumps.pump_id'), nullable=False)
+    attendant_id = db.Column(db.Integer, db.ForeignKey('users.user_id'), nullable=False)
+    sale_time = db.Column(db.DateTime, nullable=False)
+    amount = db.Column(db.Numeric(10, 2), nullable=False)
+    customer_mobile_no = db.Column(db.String(15), nullable=True)
+    customer_mobile_norm = db.Column(db.String(15), nullable=True)
+    mpesa_transaction_code = db.Column(db.String(50), nullable=True)
+    transaction_status = db.Column(db.String(50), nullable=False)
+    archive_month = db.Column(db.String(7), nullable=False) # YYYY-MM of sale_time
+
+    __table_args__ = (
+        db.Index('uq_sales_records_archive_sale_id_no', 'sale_id_no', unique=True),
+        db.Index('ix_sales_records_archive_sale_time', 'sale_time', 'sale_id'),
+        db.Index('ix_sales_records_archive_station_time', 'station_id', 'sale_time', 'sale_id'),
+        db.Index('ix_sales_records_archive_pump_time', 'pump_id', 'sale_time'),
+        db.Index('ix_sales_records_archive_attendant_time', 'attendant_id', 'sale_time'),
+        db.Index('ix_sales_records_archive_pump_shift', 'pump_shift_id'),
+        db.Index('ix_sales_records_archive_mobile_norm_time', 'customer_mobile_norm', 'sale_time'),
+        db.Index('ix_sales_records_archive_month', 'archive_month'),
+    )
+
+class MpesaTransactionArchive(StationScoped, db.Model):
+    __tablename__ = 'mpesa_transactions_archive'
+    # M-Pesa transactions of the archived sales
+    transaction_id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    station_id = db.Column(db.Integer, nullable=True)
+    sale_id = db.Column(db.Integer, nullable=True)
+    mobile_no = db.Column(db.String(15), nullable=False)
+    amount = db.Column(db.Numeric(10, 2), nullable=False)
+    request_time = db.Column(db.DateTime, nullable=False)
+    checkout_request_id = db.Column(db.String(100), nullable=False)
+    merchant_request_id = db.Column(db.String(100), nullable=False)
+    response_code = db.Column(db.String(10), nullable=False)
+    response_description = db.Column(db.Text)
+    result_code = db.Column(db.String(10), nullable=True)
+    result_description = db.Column(db.Text)
+    mpesa_receipt_number = db.Column(db.String(50), nullable=True)
+    archive_month = db.Column(db.String(7), nullable=False)
+
+    __table_args__ = (
+        db.Index('uq_mpesa_transactions_archive_checkout', 'checkout_request_id', unique=True),
+        db.Index('ix_mpesa_transactions_archive_sale', 'sale_id'),
+        db.Index('ix_mpesa_transactions_archive_station_time', 'station_id', 'request_time'),
+        db.Index('ix_mpesa_transactions_archive_receipt', 'mpesa_receipt_number'),
+        db.Index('ix_mpesa_transactions_archive_month', 'archive_month'),
+    )
+
+class ArchivedMonth(db.Model):
+    __tablename__ = 'archived_months'
+    # One row per month with archived sales; reports read the archive only for ranges these cover
+    archive_month = db.Column(db.String(7), primary_key=True)
+    sale_count = db.Column(db.Integer, nullable=False, default=0)
+    first_sale_time = db.Column(db.DateTime, nullable=True)
+    last_sale_time = db.Column(db.DateTime, nullable=True)
+    archived_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+class SchemaMeta(db.Model):
+    __tablename__ = 'schema_meta'
+    # A single row (id 1) holding the schema and seed version applied by app/bootstrap.py
+    id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    version = db.Column(db.Integer, nullable=False)
+    applied_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
 # Helper function to initialize the database with default data
 def initialize_db(app):
+    """Creates or upgrades the schema and seeds the default data, unless the database is already current."""
+    from app.bootstrap import bootstrap_database
     with app.app_context():
-        db.create_all()
-        
-        # Check and insert default roles
-        if not UserRole.query.filter_by(role_name='Admin').first():
-            db.session.add_all([
-                UserRole(role_name='Admin'),
-                UserRole(role_name='Pump Attendant')
-            ])
-            db.session.commit()
-
-        # Check and insert default shifts
-        if not Shift.query.filter_by(shift_name='Day Shift').first():
-            db.session.add_all([
-                Shift(shift_name='Day Shift'),
-                Shift(shift_name='Night Shift')
-            ])
-            db.session.commit()
-
-        # Check and insert default pumps
-        if not Pump.query.filter_by(pump_no='P1').first():
-            db.session.add_all([
-                Pump(pump_no='P1', pump_name='Pump One'),
-                Pump(pump_no='P2', pump_name='Pump Two'),
-                Pump(pump_no='P3', pump_name='Pump Three')
-            ])
-            db.session.commit()
-
-        # Check and insert default Admin user
-        if not User.query.filter_by(username='admin').first():
-            admin_role = UserRole.query.filter_by(role_name='Admin').first()
-            admin_user = User(
-                full_name='System Administrator', 
-                username='admin', 
-                mobile_no='0700123456', 
-                role_id=admin_role.role_id
-            )
-            admin_user.set_password('admin123') # Set a default password
-            db.session.add(admin_user)
-            db.session.commit()
-            
-        # Check and insert default Pump Attendant user
-        if not User.query.filter_by(username='attendant1').first():
-            attendant_role = UserRole.query.filter_by(role_name='Pump Attendant').first()
-            attendant_user = User(
-                full_name='John Doe', 
-                username='attendant1', 
-                mobile_no='0711223344', 
-                role_id=attendant_role.role_id
-            )
-            attendant_user.set_password('pass123') # Set a default password
-            db.session.add(attendant_user)
-            db.session.commit()
-
-        # Check and insert default settings
-        default_settings = {
-            'mpesa_till_number': '174379',
-            'mpesa_consumer_key': 'mock_key',
-            'mpesa_consumer_secret': 'mock_secret',
-            'mpesa_passkey': 'mock_passkey'
-        }
-        for key, value in default_settings.items():
-            if not Setting.query.filter_by(setting_key=key).first():
-                db.session.add(Setting(setting_key=key, setting_value=value))
-        db.session.commit()
-'''
+        bootstrap_database()
@@ -0,0 +1,396 @@
+import heapq
+import random
+import threading
+import time
+import uuid
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+
+import click
+from flask import current_app
+from flask.cli import AppGroup
+from sqlalchemy.exc import OperationalError
+
+from app import db
+from app.daraja import DarajaError, daraja, station_credentials
+from app.events import publish_event
+from app.models import MpesaTransaction, PumpShift, SalesRecord
+from app.rollups import record_sale, record_settlement
+
+# Simulated M-Pesa outcomes: (result_code, result_description)
+SIMULATED_OUTCOMES = [
+    ('0', 'The transaction was successful.'),
+    ('1001', 'The customer has insufficient funds in Mpesa account.'),
+    ('1032', 'Failed cancelled by customer.'),
+    ('1000', 'An error occurred during the transaction.'),
+]
+
+mpesa_cli = AppGroup('mpesa', help='Reconcile live M-Pesa payments with Daraja.')
+
+CallbackResult = namedtuple('CallbackResult', ['checkout_request_id', 'result_code', 'result_description',
+                                               'mpesa_receipt_number'])
+
+# Live STK requests are recorded under a provisional checkout request id until Daraja acknowledges the push
+PROVISIONAL_CHECKOUT_PREFIX = 'pending-'
+# Result code recorded when Daraja never accepted the push
+STK_PUSH_FAILED = '-1'
+
+# Driver messages for deadlocks and lock timeouts (SQLite, MySQL, PostgreSQL)
+LOCK_ERROR_MARKERS = ('database is locked', 'deadlock', 'lock wait timeout', 'could not serialize')
+
+
+def transaction_status_for(result_code):
+    """Maps an M-Pesa result code to a sales record status."""
+    if result_code is None:
+        return 'PENDING'
+    return 'SUCCESS' if str(result_code) == '0' else 'FAILED'
+
+
+def simulate_stk_result():
+    """Randomly picks a callback outcome, as the real M-Pesa API would send."""
+    result_code, result_description = random.choice(SIMULATED_OUTCOMES)
+    mpesa_receipt_number = None
+    if result_code == '0':
+        mpesa_receipt_number = 'NF' + str(random.randint(100000, 999999))
+    return result_code, result_description, mpesa_receipt_number
+
+
+def is_lock_contention(error):
+    """True for deadlocks and lock timeouts, which are safe to retry from the start."""
+    message = str(getattr(error, 'orig', error)).lower()
+    return any(marker in message for marker in LOCK_ERROR_MARKERS)
+
+
+def run_in_transaction(work):
+    """Runs `work()` and commits, retrying the whole unit on lock contention.
+
+    `work` must only stage changes in db.session, so a retry can replay it after
+    a rollback; its return value is passed through.
+    """
+    attempts = current_app.config['PAYMENT_TX_RETRIES'] + 1
+    for attempt in range(attempts):
+        try:
+            result = work()
+            db.session.commit()
+            return result
+        except OperationalError as e:
+            db.session.rollback()
+            if not is_lock_contention(e) or attempt == attempts - 1:
+                raise
+            time.sleep(current_app.config['PAYMENT_TX_RETRY_BACKOFF'] * (2 ** attempt) * random.uniform(0.5, 1.5))
+
+
+def record_stk_request(pump_shift, sale_id_no, attendant_id, amount, mobile_no,
+                       checkout_request_id, merchant_request_id, response_code, response_description):
+    """Stores a pending sale and its linked M-Pesa request in one transaction.
+
+    Returns the new sale id. Raises IntegrityError if sale_id_no is already taken.
+    """
+    def work():
+        sale = SalesRecord(
+            station_id=pump_shift.station_id,
+            sale_id_no=sale_id_no,
+            pump_shift_id=pump_shift.pump_shift_id,
+            pump_id=pump_shift.pump_id,
+            attendant_id=attendant_id,
+            amount=amount,
+            customer_mobile_no=mobile_no,
+            transaction_status='PENDING'
+        )
+        db.session.add(sale)
+        db.session.flush()
+
+        db.session.add(MpesaTransaction(
+            station_id=pump_shift.station_id,
+            sale_id=sale.sale_id,
+            mobile_no=mobile_no,
+            amount=amount,
+            request_time=datetime.utcnow(),
+            checkout_request_id=checkout_request_id,
+            merchant_request_id=merchant_request_id,
+            response_code=response_code,
+            response_description=response_description
+        ))
+        record_sale(sale, pump_shift.shift_id)
+        publish_event('sale.created', {
+            'sale_id': sale.sale_id, 'sale_id_no': sale_id_no, 'pump_shift_id': pump_shift.pump_shift_id,
+            'attendant_id': attendant_id, 'amount': float(amount), 'checkout_request_id': checkout_request_id,
+            'transaction_status': 'PENDING'
+        }, pump_id=pump_shift.pump_id, station_id=pump_shift.station_id)
+        return sale.sale_id
+
+    return run_in_transaction(work)
+
+
+def provisional_checkout_id():
+    """A placeholder checkout request id for a sale recorded before its STK push is sent."""
+    return PROVISIONAL_CHECKOUT_PREFIX + uuid.uuid4().hex
+
+
+def confirm_stk_request(provisional_id, checkout_request_id, merchant_request_id, response_code,
+                        response_description):
+    """Replaces a provisional checkout request id with the one Daraja acknowledged the push with."""
+    mpesa = MpesaTransaction.__table__
+
+    def work():
+        db.session.execute(
+            mpesa.update()
+                .where(mpesa.c.checkout_request_id == provisional_id)
+                .values(checkout_request_id=checkout_request_id, merchant_request_id=merchant_request_id,
+                        response_code=response_code, response_description=response_description)
+        )
+
+    run_in_transaction(work)
+
+
+def _apply_settlement(checkout_request_id, result_code, result_description, mpesa_receipt_number):
+    mpesa = MpesaTransaction.__table__
+    sales = SalesRecord.__table__
+
+    # Claim the transaction: only the first result for a checkout request is applied
+    claimed = db.session.execute(
+        mpesa.update()
+            .where(mpesa.c.checkout_request_id == checkout_request_id, mpesa.c.result_code.is_(None))
+            .values(result_code=result_code, result_description=result_description,
+                    mpesa_receipt_number=mpesa_receipt_number)
+    ).rowcount
+    if not claimed:
+        exists = db.session.query(mpesa.c.transaction_id).filter(mpesa.c.checkout_request_id == checkout_request_id).first()
+        return False if exists else None
+
+    sale = db.session.query(
+        SalesRecord.sale_id, SalesRecord.station_id, SalesRecord.pump_id, SalesRecord.pump_shift_id, SalesRecord.attendant_id,
+        SalesRecord.sale_time, SalesRecord.amount, PumpShift.shift_id
+    ).join(MpesaTransaction, MpesaTransaction.sale_id == SalesRecord.sale_id) \
+        .join(PumpShift, SalesRecord.pump_shift_id == PumpShift.pump_shift_id) \
+        .filter(MpesaTransaction.checkout_request_id == checkout_request_id) \
+        .first()
+    if sale:
+        transaction_status = transaction_status_for(result_code)
+        updated = db.session.execute(
+            sales.update()
+                .where(sales.c.sale_id == sale.sale_id, sales.c.transaction_status == 'PENDING')
+                .values(transaction_status=transaction_status, mpesa_transaction_code=mpesa_receipt_number)
+        ).rowcount
+        if updated:
+            record_settlement(SimpleNamespace(**sale._asdict(), transaction_status=transaction_status), sale.shift_id)
+            publish_event('sale.settled', {
+                'sale_id': sale.sale_id, 'pump_shift_id': sale.pump_shift_id, 'amount': float(sale.amount),
+                'checkout_request_id': checkout_request_id, 'transaction_status': transaction_status,
+                'result_code': result_code, 'mpesa_receipt_number': mpesa_receipt_number
+            }, pump_id=sale.pump_id, station_id=sale.station_id)
+    return True
+
+
+def settle_transaction(checkout_request_id, result_code, result_description, mpesa_receipt_number=None):
+    """Applies a callback result to the M-Pesa transaction and its sales record in one transaction.
+
+    Returns True if the result was applied, False if the transaction was already
+    settled, and None if the checkout request is unknown.
+    """
+    result_code = None if result_code is None else str(result_code)
+    applied = run_in_transaction(
+        lambda: _apply_settlement(checkout_request_id, result_code, result_description, mpesa_receipt_number)
+    )
+    if applied:
+        settlements.notify(checkout_request_id)
+    return applied
+
+
+def settle_batch(results):
+    """Applies a batch of CallbackResults in one transaction.
+
+    Returns (applied, unknown): the checkout request ids applied, and those with
+    no recorded STK request yet, which the caller may retry later. Redeliveries
+    are skipped: a result is dropped when an earlier one in the batch has the
+    same checkout request or receipt number, when its receipt is already
+    recorded, or when its transaction is already settled.
+    """
+    unique, checkouts, receipts = [], set(), set()
+    for result in results:
+        receipt = result.mpesa_receipt_number
+        if result.checkout_request_id in checkouts or (receipt and receipt in receipts):
+            continue
+        checkouts.add(result.checkout_request_id)
+        if receipt:
+            receipts.add(receipt)
+        unique.append(result)
+
+    def work():
+        recorded = set()
+        if receipts:
+            recorded = {row.mpesa_receipt_number for row in db.session.query(MpesaTransaction.mpesa_receipt_number)
+                        .filter(MpesaTransaction.mpesa_receipt_number.in_(receipts))
+                        .execution_options(all_stations=True)}
+        applied, unknown = [], []
+        for result in unique:
+            if result.mpesa_receipt_number in recorded:
+                continue
+            result_code = None if result.result_code is None else str(result.result_code)
+            outcome = _apply_settlement(result.checkout_request_id, result_code, result.result_description,
+                                        result.mpesa_receipt_number)
+            if outcome:
+                applied.append(result.checkout_request_id)
+            elif outcome is None:
+                unknown.append(result.checkout_request_id)
+        return applied, unknown
+
+    applied, unknown = run_in_transaction(work)
+    for checkout_request_id in applied:
+        settlements.notify(checkout_request_id)
+    return applied, unknown
+
+
+def reconcile_pending(older_than, limit):
+    """Queries Daraja for live STK pushes still unsettled after `older_than` seconds and applies the results.
+
+    This recovers sales whose callback never arrived or was dropped. Daraja's
+    query does not return the receipt number, so those sales are settled
+    without one. Returns counts of 'settled' requests, ones Daraja reports as
+    'processing' or could not be asked about, and 'unconfirmed' ones whose push
+    was never acknowledged (they still carry a provisional id and need a
+    manual check).
+    """
+    mpesa = MpesaTransaction.__table__
+    cutoff = datetime.utcnow() - timedelta(seconds=older_than)
+    rows = db.session.query(MpesaTransaction.checkout_request_id, MpesaTransaction.station_id) \
+        .filter(mpesa.c.result_code.is_(None), mpesa.c.request_time < cutoff) \
+        .order_by(MpesaTransaction.request_time) \
+        .limit(limit) \
+        .execution_options(all_stations=True) \
+        .all()
+
+    counts = {'settled': 0, 'processing': 0, 'unconfirmed': 0}
+    for row in rows:
+        if row.checkout_request_id.startswith(PROVISIONAL_CHECKOUT_PREFIX):
+            current_app.logger.warning('STK request %s was never acknowledged by Daraja', row.checkout_request_id)
+            counts['unconfirmed'] += 1
+            continue
+        try:
+            body = daraja.stk_query(station_credentials(row.station_id), row.checkout_request_id)
+        except DarajaError as e:
+            # Daraja answers 500 while the customer has not responded yet
+            current_app.logger.info('STK query for %s: %s (%s)', row.checkout_request_id, e, e.body)
+            counts['processing'] += 1
+            continue
+        result_code = body.get('ResultCode') if isinstance(body, dict) else None
+        if result_code is None:
+            counts['processing'] += 1
+            continue
+        if settle_transaction(row.checkout_request_id, result_code, body.get('ResultDesc')):
+            counts['settled'] += 1
+    return counts
+
+
+@mpesa_cli.command('reconcile')
+@click.option('--older-than', type=int, help='Seconds an STK push may stay unsettled; '
+                                             'defaults to MPESA_RECONCILE_AFTER.')
+@click.option('--limit', type=int, default=500, show_default=True, help='Most requests queried per run.')
+def reconcile_command(older_than, limit):
+    """Settle live STK pushes whose callback never arrived, by asking Daraja for their result."""
+    if not current_app.config['MPESA_LIVE']:
+        raise click.ClickException('Only live STK pushes can be queried; set MPESA_LIVE=1.')
+    counts = reconcile_pending(older_than or current_app.config['MPESA_RECONCILE_AFTER'], limit)
+    click.echo(f"Settled {counts['settled']}, still processing {counts['processing']}, "
+               f"never acknowledged {counts['unconfirmed']}.")
+
+
+class SettlementPool:
+    """Settles pending STK pushes off the request thread.
+
+    Simulated callbacks are held on a single timer thread until they are due and
+    then handed to a small worker pool for the database write, so the number of
+    payments in flight is not bound by WSGI workers or pool threads.
+    """
+
+    def __init__(self, app=None):
+        self.app = None
+        self._executor = None
+        self._timer = None
+        self._queue = []
+        self._seq = 0
+        self._cond = threading.Condition()
+        self._waiters = {}
+        self._waiters_lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        app.extensions['settlements'] = self
+
+    def _ensure_started(self):
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(
+                max_workers=self.app.config['MPESA_SETTLEMENT_WORKERS'],
+                thread_name_prefix='mpesa-settle'
+            )
+        if self._timer is None or not self._timer.is_alive():
+            self._timer = threading.Thread(target=self._run_timer, name='mpesa-settle-timer', daemon=True)
+            self._timer.start()
+
+    def schedule_simulation(self, checkout_request_id, delay):
+        """Schedules a simulated callback for a checkout request after `delay` seconds."""
+        with self._cond:
+            self._ensure_started()
+            self._seq += 1
+            heapq.heappush(self._queue, (time.monotonic() + delay, self._seq, checkout_request_id))
+            self._cond.notify()
+
+    def _run_timer(self):
+        while True:
+            with self._cond:
+                while not self._queue or self._queue[0][0] > time.monotonic():
+                    timeout = self._queue[0][0] - time.monotonic() if self._queue else None
+                    self._cond.wait(timeout)
+                _, _, checkout_request_id = heapq.heappop(self._queue)
+            self._executor.submit(self._settle_simulated, checkout_request_id)
+
+    def _settle_simulated(self, checkout_request_id):
+        with self.app.app_context():
+            try:
+                settle_transaction(checkout_request_id, *simulate_stk_result())
+            except Exception:
+                db.session.rollback()
+                self.app.logger.exception('Failed to settle checkout request %s', checkout_request_id)
+            finally:
+                db.session.remove()
+
+    def _waiter(self, checkout_request_id):
+        with self._waiters_lock:
+            return self._waiters.setdefault(checkout_request_id, [threading.Event(), 0])
+
+    def notify(self, checkout_request_id):
+        """Wakes any status requests long-polling on this checkout request."""
+        with self._waiters_lock:
+            waiter = self._waiters.get(checkout_request_id)
+        if waiter:
+            waiter[0].set()
+
+    def wait(self, checkout_request_id, timeout, is_settled):
+        """Blocks until `is_settled()` is true or `timeout` seconds pass.
+
+        Settlements in this process wake the waiter immediately; the database is
+        re-checked periodically for results settled by other workers.
+        """
+        waiter = self._waiter(checkout_request_id)
+        with self._waiters_lock:
+            waiter[1] += 1
+        try:
+            deadline = time.monotonic() + timeout
+            while not is_settled():
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                waiter[0].wait(min(remaining, self.app.config['MPESA_STATUS_POLL_INTERVAL']))
+            return True
+        finally:
+            with self._waiters_lock:
+                waiter[1] -= 1
+                if waiter[1] == 0:
+                    self._waiters.pop(checkout_request_id, None)
+
+
+settlements = SettlementPool()
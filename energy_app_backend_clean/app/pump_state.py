@@ -0,0 +1,80 @@
+import hashlib
+import json
+import threading
+import time
+
+from app import db
+from app.models import Pump, PumpShift
+
+
+def load_pump_state():
+    """Returns every active pump (of the request's station) with its open shift, computed in a single query."""
+    open_shift_id = db.session.query(PumpShift.pump_shift_id) \
+        .filter(PumpShift.pump_id == Pump.pump_id, PumpShift.is_closed == False) \
+        .order_by(PumpShift.opening_time.desc()) \
+        .limit(1) \
+        .correlate(Pump) \
+        .scalar_subquery()
+
+    rows = db.session.query(Pump.pump_id, Pump.pump_no, Pump.pump_name, Pump.station_id,
+                            open_shift_id.label('current_shift_id')) \
+        .filter(Pump.is_active == True) \
+        .order_by(Pump.pump_id) \
+        .all()
+
+    return [{
+        'pump_id': row.pump_id,
+        'pump_no': row.pump_no,
+        'pump_name': row.pump_name,
+        'station_id': row.station_id,
+        'is_shift_open': row.current_shift_id is not None,
+        'current_shift_id': row.current_shift_id
+    } for row in rows]
+
+
+class PumpStateSnapshot:
+    """In-process cache of the rendered /api/pumps body and its ETag, one per station scope.
+
+    Shift writes in this process invalidate their station's snapshot (and the
+    fleet-wide one) immediately; the TTL bounds how long a worker can serve
+    state changed by another worker.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries = {}  # station_id -> (body, etag, expires); None is the fleet-wide view
+        self._generations = {}
+        self._epoch = 0  # bumped when every snapshot is dropped
+
+    def get(self, ttl, station_id=None):
+        """Returns (body, etag) for the station, rebuilding the snapshot if it is missing or expired.
+
+        Call it in a request scoped to `station_id`, which load_pump_state's query is limited to.
+        """
+        with self._lock:
+            entry = self._entries.get(station_id)
+            if entry is not None and time.monotonic() < entry[2]:
+                return entry[0], entry[1]
+            generation = (self._epoch, self._generations.get(station_id, 0))
+
+        body = json.dumps(load_pump_state()).encode('utf-8')
+        etag = hashlib.sha1(body).hexdigest()
+        with self._lock:
+            # Don't store a snapshot that an invalidation raced past while it was loading
+            if generation == (self._epoch, self._generations.get(station_id, 0)):
+                self._entries[station_id] = (body, etag, time.monotonic() + ttl)
+        return body, etag
+
+    def invalidate(self, station_id=None):
+        """Drops the station's snapshot and the fleet-wide one; every snapshot when `station_id` is None."""
+        with self._lock:
+            if station_id is None:
+                self._epoch += 1
+                self._entries.clear()
+                return
+            for scope in (station_id, None):
+                self._generations[scope] = self._generations.get(scope, 0) + 1
+                self._entries.pop(scope, None)
+
+
+pump_state = PumpStateSnapshot()
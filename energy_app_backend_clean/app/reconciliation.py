@@ -0,0 +1,132 @@
+from datetime import datetime, timedelta
+
+from sqlalchemy import case, func
+
+from app import db
+from app.archive import archive_overlaps
+from app.models import PumpShift, SalesRecord, SalesRecordArchive, ShiftReconciliation
+from app.rollups import refresh_pump_shift_rollup
+
+SUMMARY_COLUMNS = ('sale_count', 'total_amount', 'mpesa_collected', 'success_count',
+                   'failed_count', 'failed_amount', 'pending_count', 'pending_amount')
+
+
+def _count_when(model, status):
+    return func.sum(case((model.transaction_status == status, 1), else_=0))
+
+
+def _amount_when(model, status):
+    return func.sum(case((model.transaction_status == status, model.amount), else_=0))
+
+
+def _sale_totals(model, *criteria):
+    """Per-shift sale totals of `model` by transaction status, grouped by pump_shift_id."""
+    return db.session.query(
+        model.pump_shift_id.label('pump_shift_id'),
+        func.count(model.sale_id).label('sale_count'),
+        func.sum(model.amount).label('total_amount'),
+        _amount_when(model, 'SUCCESS').label('mpesa_collected'),
+        _count_when(model, 'SUCCESS').label('success_count'),
+        _count_when(model, 'FAILED').label('failed_count'),
+        _amount_when(model, 'FAILED').label('failed_amount'),
+        _count_when(model, 'PENDING').label('pending_count'),
+        _amount_when(model, 'PENDING').label('pending_amount'),
+    ).filter(*criteria).group_by(model.pump_shift_id)
+
+
+def reconciliation_rows(*criteria, include_archive=False):
+    """Returns the reconciliation of every pump shift matching `criteria`, computed in a single query.
+
+    With `include_archive`, archived sales of those shifts are added in.
+    """
+    shift_ids = db.session.query(PumpShift.pump_shift_id).filter(*criteria).scalar_subquery()
+    totals = _sale_totals(SalesRecord, SalesRecord.pump_shift_id.in_(shift_ids))
+    if include_archive:
+        archived = _sale_totals(SalesRecordArchive, SalesRecordArchive.pump_shift_id.in_(shift_ids))
+        both = totals.union_all(archived).subquery()
+        totals = db.session.query(
+            both.c.pump_shift_id.label('pump_shift_id'),
+            *[func.sum(both.c[column]).label(column) for column in SUMMARY_COLUMNS]
+        ).group_by(both.c.pump_shift_id)
+    totals = totals.subquery()
+    return db.session.query(
+        PumpShift.pump_shift_id, PumpShift.station_id, PumpShift.pump_id, PumpShift.shift_id, PumpShift.opening_time,
+        PumpShift.closing_time, PumpShift.is_closed, PumpShift.opening_meter_reading,
+        PumpShift.closing_meter_reading,
+        *[func.coalesce(totals.c[column], 0).label(column) for column in SUMMARY_COLUMNS]
+    ).outerjoin(totals, totals.c.pump_shift_id == PumpShift.pump_shift_id) \
+        .filter(*criteria) \
+        .order_by(PumpShift.opening_time, PumpShift.pump_id) \
+        .all()
+
+
+def serialize_reconciliation(row):
+    meter_volume = None
+    if row.opening_meter_reading is not None and row.closing_meter_reading is not None:
+        meter_volume = float(row.closing_meter_reading - row.opening_meter_reading)
+    return {
+        'pump_shift_id': row.pump_shift_id,
+        'station_id': row.station_id,
+        'pump_id': row.pump_id,
+        'shift_id': row.shift_id,
+        'opening_time': row.opening_time.isoformat(),
+        'closing_time': row.closing_time.isoformat() if row.closing_time else None,
+        'is_closed': bool(row.is_closed),
+        'meter_volume': meter_volume,
+        'sale_count': int(row.sale_count),
+        'total_amount': float(row.total_amount),
+        'mpesa_collected': float(row.mpesa_collected),
+        'failed_count': int(row.failed_count),
+        'failed_amount': float(row.failed_amount),
+        'pending_count': int(row.pending_count),
+        'pending_amount': float(row.pending_amount),
+    }
+
+
+def reconcile_shift(pump_shift_id):
+    """Computes and stores a closed shift's reconciliation; call in the transaction that closes it.
+
+    The summary and the shift's sales rollup rows come from aggregate
+    queries, so closing a shift never loads its individual sales.
+    """
+    db.session.flush()
+    row = reconciliation_rows(PumpShift.pump_shift_id == pump_shift_id)[0]
+    summary = serialize_reconciliation(row)
+
+    db.session.query(ShiftReconciliation).filter_by(pump_shift_id=pump_shift_id).delete()
+    db.session.execute(ShiftReconciliation.__table__.insert(), [dict(
+        {column: getattr(row, column) for column in SUMMARY_COLUMNS if column != 'success_count'},
+        pump_shift_id=pump_shift_id,
+        meter_volume=summary['meter_volume'],
+        computed_at=datetime.utcnow()
+    )])
+    refresh_pump_shift_rollup(pump_shift_id)
+    return summary
+
+
+def parse_range(start, end):
+    """Parses ISO from/to bounds into a half-open datetime range; a date-only `end` includes that day."""
+    start_time = datetime.fromisoformat(start) if start else None
+    end_time = None
+    if end:
+        end_time = datetime.fromisoformat(end)
+        if len(end) == 10:
+            end_time += timedelta(days=1)
+    return start_time, end_time
+
+
+def reconcile_range(start=None, end=None):
+    """Reconciles every pump shift opened in [start, end) with one query, with station-wide totals."""
+    criteria = []
+    if start:
+        criteria.append(PumpShift.opening_time >= start)
+    if end:
+        criteria.append(PumpShift.opening_time < end)
+    # A shift opened at the end of the range has sales after it
+    include_archive = archive_overlaps(start, end + timedelta(days=1) if end else None)
+    shifts = [serialize_reconciliation(row) for row in reconciliation_rows(*criteria, include_archive=include_archive)]
+    totals = {column: sum(shift[column] for shift in shifts)
+              for column in ('sale_count', 'total_amount', 'mpesa_collected', 'failed_count',
+                             'failed_amount', 'pending_count', 'pending_amount')}
+    totals['meter_volume'] = sum(shift['meter_volume'] or 0 for shift in shifts)
+    return {'shifts': shifts, 'totals': totals}
@@ -0,0 +1,240 @@
+import threading
+import time
+
+import click
+from flask import current_app
+from flask.cli import AppGroup
+from sqlalchemy import String, cast, event
+from sqlalchemy.orm import Session
+
+from app import db
+from app.models import Pump, SalesRollup, Setting, Shift, Station, User, UserRole
+from app.stations import current_station_id
+
+reference_cli = AppGroup('reference', help='Manage the reference data cache.')
+
+REDIS_KEY = 'energy_app:reference:{}:version'
+
+
+def _load_pumps():
+    return [{'id': p.pump_id, 'name': p.pump_name, 'no': p.pump_no, 'station_id': p.station_id,
+             'is_active': p.is_active}
+            for p in Pump.query.order_by(Pump.pump_id).all()]
+
+
+def _load_shifts():
+    return [{'shift_id': s.shift_id, 'shift_name': s.shift_name}
+            for s in Shift.query.order_by(Shift.shift_id).all()]
+
+
+def _load_roles():
+    return {role.role_id: role.role_name for role in UserRole.query.all()}
+
+
+def _load_settings():
+    return {setting.setting_key: setting.setting_value for setting in Setting.query.all()}
+
+
+def _load_attendants_with_sales():
+    # The attendant rollups hold one row per attendant and day with sales,
+    # so this reads far fewer rows than a DISTINCT over every sale
+    sold = db.session.query(SalesRollup.group_key).filter(SalesRollup.dimension == 'attendant')
+    rows = db.session.query(User.user_id, User.full_name) \
+        .filter(cast(User.user_id, String).in_(sold.scalar_subquery())) \
+        .order_by(User.user_id) \
+        .all()
+    return [{'id': row.user_id, 'name': row.full_name} for row in rows]
+
+
+def _load_stations():
+    return {station.station_id: {
+        'code': station.station_code,
+        'name': station.station_name,
+        'is_active': station.is_active is not False,
+        'mpesa_till_number': station.mpesa_till_number,
+        'mpesa_shortcode': station.mpesa_shortcode,
+        'mpesa_passkey': station.mpesa_passkey,
+        'mpesa_consumer_key': station.mpesa_consumer_key,
+        'mpesa_consumer_secret': station.mpesa_consumer_secret,
+    } for station in Station.query.all()}
+
+
+LOADERS = {
+    'pumps': _load_pumps,
+    'shifts': _load_shifts,
+    'roles': _load_roles,
+    'settings': _load_settings,
+    'attendants': _load_attendants_with_sales,
+    'stations': _load_stations,
+}
+
+# Datasets read from station-scoped tables, cached separately for each station
+STATION_DATASETS = ('pumps', 'attendants')
+
+# Datasets to invalidate when rows of these models are written through the ORM
+DEPENDENTS = {
+    Pump: ('pumps',),
+    Shift: ('shifts',),
+    UserRole: ('roles',),
+    Setting: ('settings',),
+    User: ('attendants',),
+    Station: ('stations',),
+}
+
+
+class VersionBackendError(Exception):
+    """The shared version store could not be reached."""
+
+
+class LocalVersions:
+    """Dataset versions for a single process."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._versions = {}
+
+    def get(self, names):
+        with self._lock:
+            return [self._versions.get(name, 0) for name in names]
+
+    def bump(self, names):
+        with self._lock:
+            for name in names:
+                self._versions[name] = self._versions.get(name, 0) + 1
+
+
+class RedisVersions:
+    """Dataset versions shared by every worker through a Redis-compatible server."""
+
+    def __init__(self, url):
+        try:
+            import redis
+        except ImportError:
+            raise RuntimeError('REFERENCE_CACHE_REDIS_URL is set but the redis package is not installed.')
+        self._errors = (redis.RedisError, OSError)
+        self._client = redis.Redis.from_url(url, socket_timeout=0.5, socket_connect_timeout=0.5)
+
+    def get(self, names):
+        try:
+            return [int(value or 0) for value in self._client.mget([REDIS_KEY.format(name) for name in names])]
+        except self._errors as e:
+            raise VersionBackendError(str(e))
+
+    def bump(self, names):
+        try:
+            pipeline = self._client.pipeline()
+            for name in names:
+                pipeline.incr(REDIS_KEY.format(name))
+            pipeline.execute()
+        except self._errors as e:
+            raise VersionBackendError(str(e))
+
+
+class ReferenceDataCache:
+    """Versioned in-process cache of rarely changing tables.
+
+    An entry is served while it is younger than REFERENCE_CACHE_TTL and its
+    version still matches the backend's. ORM writes to the source tables bump
+    the version when they commit; with REFERENCE_CACHE_REDIS_URL the versions
+    live in Redis, so a write in one worker reloads the data in all of them.
+    STATION_DATASETS are cached per station scope, so each station loads only
+    its own rows.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries = {}  # (name, station_id) -> (version, value, expires)
+        self.backend = LocalVersions()
+
+    def init_app(self, app):
+        url = app.config['REFERENCE_CACHE_REDIS_URL']
+        self.backend = RedisVersions(url) if url else LocalVersions()
+
+    def get(self, name):
+        return self.get_many(name)[0]
+
+    def get_many(self, *names):
+        """Returns the datasets `names`, checking all their versions in one backend round trip."""
+        try:
+            versions = self.backend.get(names)
+        except VersionBackendError as e:
+            current_app.logger.warning('Reference cache versions unavailable, relying on TTL: %s', e)
+            versions = [None] * len(names)
+
+        now = time.monotonic()
+        station_id = current_station_id()
+        values = []
+        for name, version in zip(names, versions):
+            key = (name, station_id if name in STATION_DATASETS else None)
+            with self._lock:
+                entry = self._entries.get(key)
+            if entry and entry[2] > now and (version is None or entry[0] == version):
+                values.append(entry[1])
+                continue
+            value = LOADERS[name]()
+            with self._lock:
+                self._entries[key] = (version, value, now + current_app.config['REFERENCE_CACHE_TTL'])
+            values.append(value)
+        return values
+
+    def invalidate(self, *names):
+        names = names or tuple(LOADERS)
+        with self._lock:
+            for key in [key for key in self._entries if key[0] in names]:
+                del self._entries[key]
+        try:
+            self.backend.bump(names)
+        except VersionBackendError as e:
+            current_app.logger.warning('Could not publish reference cache invalidation: %s', e)
+
+
+reference_data = ReferenceDataCache()
+
+
+def get_setting(key, default=None):
+    return reference_data.get('settings').get(key, default)
+
+
+def note_attendant_sales(attendant_ids):
+    """Invalidates the attendant list on commit if it lacks any of `attendant_ids`.
+
+    Sales reach it through the rollups rather than an ORM write to a source
+    table, so record_sale and record_sales call this before their upsert.
+    """
+    known = {attendant['id'] for attendant in reference_data.get('attendants')}
+    if not set(attendant_ids) <= known:
+        db.session.info.setdefault('reference_changes', set()).add('attendants')
+
+
+@event.listens_for(Session, 'after_flush')
+def _collect_reference_writes(session, flush_context):
+    changed = session.info.setdefault('reference_changes', set())
+    for instance in list(session.new) + list(session.dirty) + list(session.deleted):
+        changed.update(DEPENDENTS.get(type(instance), ()))
+
+
+@event.listens_for(Session, 'after_commit')
+def _invalidate_reference_writes(session):
+    changed = session.info.pop('reference_changes', None)
+    if changed:
+        reference_data.invalidate(*changed)
+
+
+@event.listens_for(Session, 'after_rollback')
+def _discard_reference_writes(session):
+    session.info.pop('reference_changes', None)
+
+
+@reference_cli.command('invalidate')
+@click.argument('names', nargs=-1)
+def invalidate_command(names):
+    """Drop cached reference data after editing it outside the app (all datasets by default).
+
+    Running workers only hear of this through REFERENCE_CACHE_REDIS_URL; without
+    it they pick the change up within REFERENCE_CACHE_TTL.
+    """
+    unknown = set(names) - set(LOADERS)
+    if unknown:
+        raise click.BadParameter(f'unknown datasets: {", ".join(sorted(unknown))}')
+    reference_data.invalidate(*names)
+    click.echo(f'Invalidated {", ".join(names or LOADERS)}.')
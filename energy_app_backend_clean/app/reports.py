@@ -0,0 +1,144 @@
+import base64
+import json
+from datetime import datetime
+
+from sqlalchemy import and_, or_
+
+from app import db
+from app.archive import archive_bounds, archive_overlaps
+from app.models import User, Pump, PumpShift, SalesRecord, SalesRecordArchive, Shift
+from app.search import matching_numbers
+
+def _report_columns(model):
+    return (
+        model.sale_id,
+        model.sale_id_no,
+        model.amount,
+        model.sale_time,
+        model.customer_mobile_no,
+        model.mpesa_transaction_code,
+        model.transaction_status,
+        Pump.pump_no,
+        Pump.pump_name,
+        Shift.shift_name,
+        User.full_name.label('attendant_name'),
+    )
+
+
+def sales_report_query(pump_id=None, attendant_id=None, mobile_no=None, shift_id=None, start=None, end=None,
+                       model=SalesRecord):
+    """Builds the column-only sales report query; one statement returns every field of a row.
+
+    `model` is SalesRecord for recent sales or SalesRecordArchive for archived ones.
+    """
+    query = db.session.query(*_report_columns(model)) \
+        .join(PumpShift, model.pump_shift_id == PumpShift.pump_shift_id) \
+        .join(Shift, PumpShift.shift_id == Shift.shift_id) \
+        .join(Pump, model.pump_id == Pump.pump_id) \
+        .join(User, model.attendant_id == User.user_id)
+
+    if pump_id:
+        query = query.filter(model.pump_id == pump_id)
+    if attendant_id:
+        query = query.filter(model.attendant_id == attendant_id)
+    if mobile_no:
+        # Search by mobile number (partial match, any of the 07xx/2547xx forms)
+        numbers = matching_numbers(mobile_no)
+        if numbers is not None:
+            query = query.filter(model.customer_mobile_norm.in_(db.session.query(numbers.c.mobile_norm)))
+        else:
+            query = query.filter(model.customer_mobile_no.like(f'%{mobile_no}%'))
+    if shift_id:
+        query = query.filter(PumpShift.shift_id == shift_id)
+    if start:
+        query = query.filter(model.sale_time >= start)
+    if end:
+        query = query.filter(model.sale_time < end)
+
+    return query
+
+
+def encode_cursor(sale_time, sale_id):
+    """Encodes a (sale_time, sale_id) position as an opaque cursor string."""
+    raw = f'{sale_time.isoformat()}|{sale_id}'
+    return base64.urlsafe_b64encode(raw.encode('utf-8')).decode('ascii')
+
+
+def decode_cursor(cursor):
+    """Decodes a cursor from encode_cursor; raises ValueError if it is malformed."""
+    try:
+        raw = base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8')
+        sale_time, sale_id = raw.split('|')
+        return datetime.fromisoformat(sale_time), int(sale_id)
+    except (UnicodeError, ValueError, TypeError) as e:
+        raise ValueError('Invalid cursor.') from e
+
+
+def sales_page(query, limit, after=None, model=SalesRecord):
+    """Returns up to `limit` rows after the (sale_time, sale_id) keyset position, newest first."""
+    if after is not None:
+        sale_time, sale_id = after
+        query = query.filter(or_(
+            model.sale_time < sale_time,
+            and_(model.sale_time == sale_time, model.sale_id < sale_id)
+        ))
+    return query.order_by(model.sale_time.desc(), model.sale_id.desc()).limit(limit).all()
+
+
+def report_page(filters, limit, after=None):
+    """Returns one newest-first page of the report over recent and archived sales.
+
+    `filters` are sales_report_query keyword arguments. The archive is only
+    queried when the range reaches it and the recent sales don't already fill
+    the page with newer rows, so day-to-day pages never touch it.
+    """
+    rows = sales_page(sales_report_query(**filters), limit, after)
+    if not archive_overlaps(filters.get('start'), filters.get('end')):
+        return rows
+    if len(rows) == limit and rows[-1].sale_time > archive_bounds()[1]:
+        return rows
+    archived = sales_page(sales_report_query(**filters, model=SalesRecordArchive), limit, after, SalesRecordArchive)
+    return sorted(rows + archived, key=lambda row: (row.sale_time, row.sale_id), reverse=True)[:limit]
+
+
+def iter_sales_rows(filters, chunk_size):
+    """Yields every row of the report one keyset page at a time, so memory stays flat."""
+    after = None
+    while True:
+        rows = report_page(filters, chunk_size, after)
+        yield from rows
+        if len(rows) < chunk_size:
+            return
+        after = (rows[-1].sale_time, rows[-1].sale_id)
+
+
+def serialize_sale_row(row):
+    return {
+        'sale_id': row.sale_id,
+        'sale_id_no': row.sale_id_no,
+        'amount': float(row.amount),
+        'sale_time': row.sale_time.isoformat(),
+        'customer_mobile_no': row.customer_mobile_no,
+        'mpesa_transaction_code': row.mpesa_transaction_code,
+        'transaction_status': row.transaction_status,
+        'pump_no': row.pump_no,
+        'pump_name': row.pump_name,
+        'shift_name': row.shift_name,
+        'attendant_name': row.attendant_name
+    }
+
+
+def stream_ndjson(rows):
+    """Renders rows as newline-delimited JSON, one sale per line."""
+    for row in rows:
+        yield json.dumps(serialize_sale_row(row)) + '\n'
+
+
+def stream_json_array(rows):
+    """Renders rows as a single JSON array, written out incrementally."""
+    yield '['
+    first = True
+    for row in rows:
+        yield ('' if first else ',') + json.dumps(serialize_sale_row(row))
+        first = False
+    yield ']'
@@ -0,0 +1,292 @@
+from datetime import timedelta
+
+import click
+from flask.cli import AppGroup
+from sqlalchemy import String, case, cast, func
+
+from app import db
+from app.models import User, Pump, PumpShift, SalesRecord, SalesRecordArchive, SalesRollup, Shift
+from app.reference import note_attendant_sales
+
+# Dimensions kept as running totals, and the period formats used for time buckets
+DIMENSIONS = ('pump', 'pump_shift', 'shift', 'attendant', 'hour', 'day')
+PERIOD_FORMATS = {'hour': '%Y-%m-%dT%H', 'day': '%Y-%m-%d'}
+
+COUNTER_COLUMNS = ('sale_count', 'total_amount', 'success_count', 'success_amount', 'failed_count')
+
+# Rollup station_id of sales without a station; it is part of the primary key, so it cannot be NULL
+NO_STATION = 0
+
+# Rollup rows per upsert statement, well under SQLite's bound-parameter limit
+UPSERT_CHUNK_SIZE = 500
+
+rollups_cli = AppGroup('rollups', help='Maintain pre-aggregated sales rollups.')
+
+
+def _station_key(sale):
+    return sale.station_id or NO_STATION
+
+
+def _period(dimension):
+    """The period the rows of a dimension are bucketed by: hours for the hour dimension, days for the rest."""
+    return 'hour' if dimension == 'hour' else 'day'
+
+
+def _group_keys(sale, shift_id):
+    """Returns the (dimension, period_key, group_key) triples a sale contributes to."""
+    hour = sale.sale_time.strftime(PERIOD_FORMATS['hour'])
+    day = sale.sale_time.strftime(PERIOD_FORMATS['day'])
+    return [
+        ('pump', day, str(sale.pump_id)),
+        ('pump_shift', day, str(sale.pump_shift_id)),
+        ('shift', day, str(shift_id)),
+        ('attendant', day, str(sale.attendant_id)),
+        ('hour', hour, hour),
+        ('day', day, day),
+    ]
+
+
+def _upsert(rows):
+    """Adds each row's counters onto its rollup row, creating missing rows, in one upsert statement."""
+    table = SalesRollup.__table__
+    dialect = db.session.get_bind().dialect.name
+
+    if dialect in ('sqlite', 'postgresql'):
+        if dialect == 'sqlite':
+            from sqlalchemy.dialects.sqlite import insert
+        else:
+            from sqlalchemy.dialects.postgresql import insert
+        stmt = insert(table).values(rows)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=['station_id', 'dimension', 'period_key', 'group_key'],
+            set_={column: table.c[column] + stmt.excluded[column] for column in COUNTER_COLUMNS}
+        )
+        db.session.execute(stmt)
+    elif dialect == 'mysql':
+        from sqlalchemy.dialects.mysql import insert
+        stmt = insert(table).values(rows)
+        stmt = stmt.on_duplicate_key_update({column: table.c[column] + stmt.inserted[column] for column in COUNTER_COLUMNS})
+        db.session.execute(stmt)
+    else:
+        for row in rows:
+            rollup = db.session.get(SalesRollup, (row['station_id'], row['dimension'], row['period_key'],
+                                                  row['group_key']))
+            if rollup is None:
+                db.session.add(SalesRollup(**row))
+            else:
+                for column in COUNTER_COLUMNS:
+                    setattr(rollup, column, getattr(rollup, column) + row[column])
+
+
+def _increment(station_id, keys, **deltas):
+    """Adds the same `deltas` to the station's rollup rows for every key in `keys`."""
+    _upsert([
+        dict({column: 0 for column in COUNTER_COLUMNS}, station_id=station_id, dimension=dimension,
+             period_key=period_key, group_key=group_key, **deltas)
+        for dimension, period_key, group_key in keys
+    ])
+
+
+def _sale_deltas(sale):
+    deltas = {'sale_count': 1, 'total_amount': sale.amount}
+    if sale.transaction_status == 'SUCCESS':
+        deltas.update(success_count=1, success_amount=sale.amount)
+    elif sale.transaction_status == 'FAILED':
+        deltas['failed_count'] = 1
+    return deltas
+
+
+def record_sale(sale, shift_id):
+    """Counts a newly inserted sale; call inside the transaction that inserts it."""
+    note_attendant_sales([sale.attendant_id])
+    _increment(_station_key(sale), _group_keys(sale, shift_id), **_sale_deltas(sale))
+
+
+def record_sales(sales):
+    """Counts a batch of newly inserted sales with a single upsert.
+
+    `sales` are (sale, shift_id) pairs; sale only needs the SalesRecord attributes.
+    """
+    note_attendant_sales({sale.attendant_id for sale, _ in sales})
+    totals = {}
+    for sale, shift_id in sales:
+        deltas = _sale_deltas(sale)
+        station_id = _station_key(sale)
+        for dimension, period_key, group_key in _group_keys(sale, shift_id):
+            row = totals.setdefault((station_id, dimension, period_key, group_key),
+                                    {column: 0 for column in COUNTER_COLUMNS})
+            for column, delta in deltas.items():
+                row[column] += delta
+    rows = [dict(row, station_id=station_id, dimension=dimension, period_key=period_key, group_key=group_key)
+            for (station_id, dimension, period_key, group_key), row in totals.items()]
+    for start in range(0, len(rows), UPSERT_CHUNK_SIZE):
+        _upsert(rows[start:start + UPSERT_CHUNK_SIZE])
+
+
+def record_settlement(sale, shift_id):
+    """Counts a pending sale that has just been settled as SUCCESS or FAILED."""
+    if sale.transaction_status == 'SUCCESS':
+        _increment(_station_key(sale), _group_keys(sale, shift_id), success_count=1, success_amount=sale.amount)
+    elif sale.transaction_status == 'FAILED':
+        _increment(_station_key(sale), _group_keys(sale, shift_id), failed_count=1)
+
+
+def _period_expression(column, dimension):
+    dialect = db.session.get_bind().dialect.name
+    if dialect == 'mysql':
+        return func.date_format(column, PERIOD_FORMATS[dimension])
+    if dialect == 'postgresql':
+        return func.to_char(column, 'YYYY-MM-DD"T"HH24' if dimension == 'hour' else 'YYYY-MM-DD')
+    return func.strftime(PERIOD_FORMATS[dimension], column)
+
+
+def _key_expression(dimension, model):
+    if dimension in PERIOD_FORMATS:
+        return _period_expression(model.sale_time, dimension)
+    column = {
+        'pump': model.pump_id,
+        'pump_shift': model.pump_shift_id,
+        'shift': PumpShift.shift_id,
+        'attendant': model.attendant_id,
+    }[dimension]
+    return cast(column, String)
+
+
+def _aggregate_rows(dimension, *criteria, model=SalesRecord):
+    """Aggregates sales_records (or `model`) into per-station, per-period rollup rows for one dimension
+    with a single GROUP BY."""
+    station_id = func.coalesce(model.station_id, NO_STATION).label('station_id')
+    period = _period_expression(model.sale_time, _period(dimension)).label('period_key')
+    key = _key_expression(dimension, model).label('group_key')
+    is_success = model.transaction_status == 'SUCCESS'
+    query = db.session.query(
+        station_id,
+        period,
+        key,
+        func.count(model.sale_id),
+        func.coalesce(func.sum(model.amount), 0),
+        func.coalesce(func.sum(case((is_success, 1), else_=0)), 0),
+        func.coalesce(func.sum(case((is_success, model.amount), else_=0)), 0),
+        func.coalesce(func.sum(case((model.transaction_status == 'FAILED', 1), else_=0)), 0),
+    )
+    if dimension == 'shift':
+        query = query.join(PumpShift, model.pump_shift_id == PumpShift.pump_shift_id)
+    query = query.filter(*criteria).group_by(station_id, period, key)
+    return [
+        dict(zip(('station_id', 'period_key', 'group_key') + COUNTER_COLUMNS, row), dimension=dimension)
+        for row in query
+    ]
+
+
+def _merge_rows(rows):
+    """Sums rollup rows that share a station, period and group key."""
+    merged = {}
+    for row in rows:
+        identity = (row['station_id'], row['period_key'], row['group_key'])
+        total = merged.get(identity)
+        if total is None:
+            merged[identity] = dict(row)
+        else:
+            for column in COUNTER_COLUMNS:
+                total[column] += row[column]
+    return list(merged.values())
+
+
+def refresh_pump_shift_rollup(pump_shift_id):
+    """Recomputes one shift's rollup rows from its sales, e.g. when the shift is closed."""
+    db.session.query(SalesRollup).filter_by(dimension='pump_shift', group_key=str(pump_shift_id)).delete()
+    rows = _aggregate_rows('pump_shift', SalesRecord.pump_shift_id == pump_shift_id)
+    if rows:
+        db.session.execute(SalesRollup.__table__.insert(), rows)
+
+
+def rebuild_rollups():
+    """Replaces every rollup with totals recomputed from sales history; returns the number of groups."""
+    db.session.query(SalesRollup).delete()
+    count = 0
+    for dimension in DIMENSIONS:
+        # Archived sales still count towards the totals
+        rows = _merge_rows(_aggregate_rows(dimension) + _aggregate_rows(dimension, model=SalesRecordArchive))
+        if rows:
+            db.session.execute(SalesRollup.__table__.insert(), rows)
+        count += len(rows)
+    db.session.commit()
+    return count
+
+
+def _labels(dimension, keys):
+    """Looks up display names for the groups of id-keyed dimensions."""
+    ids = [int(key) for key in keys]
+    if not ids:
+        return {}
+    if dimension == 'pump':
+        rows = db.session.query(Pump.pump_id, Pump.pump_name).filter(Pump.pump_id.in_(ids))
+    elif dimension == 'attendant':
+        rows = db.session.query(User.user_id, User.full_name).filter(User.user_id.in_(ids))
+    elif dimension == 'shift':
+        rows = db.session.query(Shift.shift_id, Shift.shift_name).filter(Shift.shift_id.in_(ids))
+    else:
+        return {}
+    return {str(row[0]): row[1] for row in rows}
+
+
+def serialize_rollup(rollup, label=None):
+    return {
+        'key': rollup.group_key,
+        'label': label,
+        'sale_count': rollup.sale_count,
+        'total_amount': float(rollup.total_amount),
+        'success_count': rollup.success_count,
+        'success_amount': float(rollup.success_amount),
+        'failed_count': rollup.failed_count,
+        'pending_count': rollup.sale_count - rollup.success_count - rollup.failed_count
+    }
+
+
+def period_bounds(dimension, start=None, end=None):
+    """Converts a half-open [start, end) datetime range into inclusive period_key bounds for a dimension.
+
+    Rows are whole hours or days, so the range is widened to the periods it
+    touches; either bound may be None.
+    """
+    period_format = PERIOD_FORMATS[_period(dimension)]
+    first = start.strftime(period_format) if start else None
+    last = (end - timedelta(microseconds=1)).strftime(period_format) if end else None
+    return first, last
+
+
+def rollup_summary(dimension, start=None, end=None):
+    """Returns per-group totals for a dimension plus their grand total, read from the rollups only.
+
+    `start`/`end` are datetimes bounding the sales counted (as parse_range
+    returns them), rounded out to the hours of the hour dimension and to days
+    otherwise. A request scoped to a station reads that station's rows;
+    otherwise the stations' rows are summed into fleet-wide totals.
+    """
+    query = db.session.query(
+        SalesRollup.group_key,
+        *[func.sum(getattr(SalesRollup, column)).label(column) for column in COUNTER_COLUMNS]
+    ).filter(SalesRollup.dimension == dimension).group_by(SalesRollup.group_key)
+    first, last = period_bounds(dimension, start, end)
+    if first:
+        query = query.filter(SalesRollup.period_key >= first)
+    if last:
+        query = query.filter(SalesRollup.period_key <= last)
+    rollups = query.order_by(SalesRollup.group_key).all()
+
+    labels = {} if dimension in PERIOD_FORMATS or dimension == 'pump_shift' else \
+        _labels(dimension, [r.group_key for r in rollups])
+    groups = [serialize_rollup(r, labels.get(r.group_key)) for r in rollups]
+
+    totals = {column: sum(group[column] for group in groups)
+              for column in ('sale_count', 'total_amount', 'success_count', 'success_amount',
+                             'failed_count', 'pending_count')}
+    return {'dimension': dimension, 'groups': groups, 'totals': totals}
+
+
+@rollups_cli.command('rebuild')
+def rebuild_command():
+    """Backfill all sales rollups from existing sales history."""
+    db.create_all()
+    count = rebuild_rollups()
+    click.echo(f'Rebuilt {count} rollup groups.')
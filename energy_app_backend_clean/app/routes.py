@@ -1,10 +1,30 @@
-from flask import Blueprint, request, jsonify, current_app
+from flask import Blueprint, Response, request, jsonify, current_app, g, stream_with_context, url_for
 from app import db
-from app.models import User, Pump, PumpShift, SalesRecord, MpesaTransaction, UserRole, Shift
+from app.models import User, Pump, PumpShift, MpesaTransaction
+from app.auth import PasswordCheckBusy, authenticate, issue_token, login_required, principals
+from app.callbacks import callback_queue
+from app.daraja import DarajaError, daraja, daraja_amount, daraja_phone, station_credentials
+from app.database import database_status
+from app.events import Subscription, event_feed, publish_event
+from app.exports import FORMATS as EXPORT_FORMATS, ExportUnavailable, export_stream
+from app.ingest import ingest_sales
+from app.pump_state import pump_state
+from app.payments import (
+    STK_PUSH_FAILED, CallbackResult, confirm_stk_request, provisional_checkout_id, record_stk_request,
+    settlements, settle_batch, settle_transaction, transaction_status_for
+)
+from app.reports import (
+    report_page, iter_sales_rows, encode_cursor, decode_cursor,
+    serialize_sale_row, stream_ndjson, stream_json_array
+)
+from app.reference import reference_data
+from app.reconciliation import parse_range, reconcile_range, reconcile_shift
+from app.rollups import DIMENSIONS, rollup_summary
+from app.stations import current_station_id
 from datetime import datetime
+from sqlalchemy.exc import IntegrityError
+import sqlite3
 import uuid
-import time
-import random
 
 main = Blueprint('main', __name__)
 
@@ -16,11 +36,23 @@ def get_current_shift(pump_id):
 
 def get_user_role(user_id):
     """Gets the role name for a given user ID."""
-    user = User.query.get(user_id)
-    if user:
-        return user.role.role_name
+    principal = principals.get(user_id)
+    if principal:
+        return principal.role
     return None
 
+def report_filters():
+    """Reads the sales report filters from the query string; raises ValueError for a bad ?from=/?to=."""
+    start, end = parse_range(request.args.get('from'), request.args.get('to'))
+    return dict(
+        pump_id=request.args.get('pump_id', type=int),
+        attendant_id=request.args.get('attendant_id', type=int),
+        mobile_no=request.args.get('mobile_no'),
+        shift_id=request.args.get('shift_id', type=int),
+        start=start,
+        end=end
+    )
+
 # --- Authentication Routes ---
 
 @main.route('/api/login', methods=['POST'])
@@ -29,45 +61,54 @@ def login():
     username = data.get('username')
     password = data.get('password')
 
-    user = User.query.filter_by(username=username).first()
+    try:
+        principal = authenticate(username, password)
+    except PasswordCheckBusy:
+        return jsonify({'status': 'error', 'message': 'Server busy, please retry.'}), 503
 
-    if user and user.check_password(password):
-        role_name = get_user_role(user.user_id)
+    if principal and principal.is_active:
         return jsonify({
             'status': 'success',
             'message': 'Login successful',
+            'token': issue_token(principal),
             'user': {
-                'user_id': user.user_id,
-                'full_name': user.full_name,
-                'username': user.username,
-                'role': role_name
+                'user_id': principal.user_id,
+                'full_name': principal.full_name,
+                'username': principal.username,
+                'role': principal.role
             }
         }), 200
     else:
         return jsonify({'status': 'error', 'message': 'Invalid credentials'}), 401
 
+@main.route('/api/session', methods=['GET'])
+@login_required
+def current_session():
+    # Validates a session token without a password check and hands back a renewed token
+    principal = g.principal
+    return jsonify({
+        'status': 'success',
+        'token': issue_token(principal),
+        'user': {
+            'user_id': principal.user_id,
+            'full_name': principal.full_name,
+            'username': principal.username,
+            'role': principal.role
+        }
+    }), 200
+
 # --- Pump and Shift Management Routes (Admin/Attendant) ---
 
 @main.route('/api/pumps', methods=['GET'])
 def get_pumps():
-    pumps = Pump.query.filter_by(is_active=True).all()
-    result = []
-    for pump in pumps:
-        current_shift = get_current_shift(pump.pump_id)
-        result.append({
-            'pump_id': pump.pump_id,
-            'pump_no': pump.pump_no,
-            'pump_name': pump.pump_name,
-            'is_shift_open': current_shift is not None,
-            'current_shift_id': current_shift.pump_shift_id if current_shift else None
-        })
-    return jsonify(result), 200
+    body, etag = pump_state.get(current_app.config['PUMP_STATE_TTL'], current_station_id())
+    response = Response(body, mimetype='application/json')
+    response.set_etag(etag)
+    return response.make_conditional(request)
 
 @main.route('/api/shifts', methods=['GET'])
 def get_shifts():
-    shifts = Shift.query.all()
-    result = [{'shift_id': s.shift_id, 'shift_name': s.shift_name} for s in shifts]
-    return jsonify(result), 200
+    return jsonify(reference_data.get('shifts')), 200
 
 @main.route('/api/shift/open', methods=['POST'])
 def open_shift():
@@ -77,17 +118,34 @@ def open_shift():
     attendant_id = data.get('attendant_id')
     opening_meter_reading = data.get('opening_meter_reading')
 
+    # Only pumps of the request's station are found
+    pump = db.session.get(Pump, pump_id) if pump_id else None
+    if not pump:
+        return jsonify({'status': 'error', 'message': 'Invalid pump ID.'}), 400
+
     if get_current_shift(pump_id):
         return jsonify({'status': 'error', 'message': 'Shift is already open for this pump.'}), 400
 
     new_shift = PumpShift(
+        station_id=pump.station_id,
         pump_id=pump_id,
         shift_id=shift_id,
         opening_attendant_id=attendant_id,
         opening_meter_reading=opening_meter_reading
     )
     db.session.add(new_shift)
-    db.session.commit()
+    try:
+        db.session.flush()
+        publish_event('shift.opened', {
+            'pump_shift_id': new_shift.pump_shift_id, 'shift_id': shift_id, 'attendant_id': attendant_id,
+            'opening_meter_reading': opening_meter_reading
+        }, pump_id=pump_id, station_id=pump.station_id)
+        db.session.commit()
+    except IntegrityError:
+        # uq_pump_shifts_one_open: another request opened a shift for this pump first
+        db.session.rollback()
+        return jsonify({'status': 'error', 'message': 'Shift is already open for this pump.'}), 400
+    pump_state.invalidate(pump.station_id)
 
     return jsonify({
         'status': 'success',
@@ -111,9 +169,19 @@ def close_shift():
     shift.closing_time = datetime.utcnow()
     shift.closing_meter_reading = closing_meter_reading
     shift.is_closed = True
+    reconciliation = reconcile_shift(shift.pump_shift_id)
+    publish_event('shift.closed', {
+        'pump_shift_id': shift.pump_shift_id, 'shift_id': shift.shift_id, 'attendant_id': closing_attendant_id,
+        'reconciliation': reconciliation
+    }, pump_id=shift.pump_id, station_id=shift.station_id)
     db.session.commit()
+    pump_state.invalidate(shift.station_id)
 
-    return jsonify({'status': 'success', 'message': 'Shift closed successfully'}), 200
+    return jsonify({
+        'status': 'success',
+        'message': 'Shift closed successfully',
+        'reconciliation': reconciliation
+    }), 200
 
 # --- Sales and M-Pesa Simulation Routes ---
 
@@ -129,92 +197,190 @@ def stk_push_simulation():
     if not all([mobile_no, amount, sale_id_no, pump_shift_id, attendant_id]):
         return jsonify({'status': 'error', 'message': 'Missing required fields for STK Push.'}), 400
 
-    # 1. Simulate STK Push Request
-    checkout_request_id = str(uuid.uuid4())
-    merchant_request_id = str(uuid.uuid4())
-    
-    # Simulate a successful request to M-Pesa API
-    response_code = '0'
-    response_description = 'Success. Request accepted for processing.'
-
-    # 2. Log the M-Pesa Transaction Request
-    mpesa_req = MpesaTransaction(
-        mobile_no=mobile_no,
-        amount=amount,
-        request_time=datetime.utcnow(),
-        checkout_request_id=checkout_request_id,
-        merchant_request_id=merchant_request_id,
-        response_code=response_code,
-        response_description=response_description
-    )
-    db.session.add(mpesa_req)
-    db.session.commit()
-
-    # 3. Simulate the M-Pesa Callback (Payment Confirmation)
-    # This would normally be a separate endpoint, but for simulation, we'll run it inline after a delay.
-    time.sleep(current_app.config['MPESA_SIMULATION_DELAY'])
-
-    # Randomly determine transaction outcome for simulation
-    outcome = random.choice(['SUCCESS', 'INSUFFICIENT_FUNDS', 'CANCELLED', 'OTHER_ERROR'])
-
-    if outcome == 'SUCCESS':
-        result_code = '0'
-        result_description = 'The transaction was successful.'
-        mpesa_receipt_number = 'NF' + str(random.randint(100000, 999999))
-        transaction_status = 'SUCCESS'
-    elif outcome == 'INSUFFICIENT_FUNDS':
-        result_code = '1001'
-        result_description = 'The customer has insufficient funds in Mpesa account.'
-        mpesa_receipt_number = None
-        transaction_status = 'FAILED'
-    elif outcome == 'CANCELLED':
-        result_code = '1032'
-        result_description = 'Failed cancelled by customer.'
-        mpesa_receipt_number = None
-        transaction_status = 'FAILED'
-    else: # OTHER_ERROR
-        result_code = '1000'
-        result_description = 'An error occurred during the transaction.'
-        mpesa_receipt_number = None
-        transaction_status = 'FAILED'
-
-    # 4. Update M-Pesa Transaction Log
-    mpesa_req.result_code = result_code
-    mpesa_req.result_description = result_description
-    mpesa_req.mpesa_receipt_number = mpesa_receipt_number
-    db.session.commit()
-
-    # 5. Create Sales Record
-    pump_shift = PumpShift.query.get(pump_shift_id)
+    pump_shift = db.session.get(PumpShift, pump_shift_id)
     if not pump_shift:
         return jsonify({'status': 'error', 'message': 'Invalid pump shift ID.'}), 400
 
-    new_sale = SalesRecord(
-        sale_id_no=sale_id_no,
-        pump_shift_id=pump_shift_id,
-        pump_id=pump_shift.pump_id,
-        attendant_id=attendant_id,
-        amount=amount,
-        customer_mobile_no=mobile_no,
-        mpesa_transaction_code=mpesa_receipt_number,
-        transaction_status=transaction_status
+    live = current_app.config['MPESA_LIVE']
+    if live:
+        # Daraja charges whole shillings only; the sale must record exactly what the customer pays
+        try:
+            daraja_amount(amount)
+        except ValueError:
+            return jsonify({'status': 'error', 'message': 'M-Pesa amounts must be whole shillings.'}), 400
+        try:
+            daraja_phone(mobile_no)
+        except ValueError:
+            return jsonify({'status': 'error', 'message': 'Invalid mobile number.'}), 400
+        # Daraja's ids are only known after the push, which is sent once the pending sale is committed
+        checkout_request_id = provisional_checkout_id()
+        merchant_request_id = ''
+        response_code = ''
+        response_description = 'Sending the STK push.'
+    else:
+        checkout_request_id = str(uuid.uuid4())
+        merchant_request_id = str(uuid.uuid4())
+        # Simulate a successful request to M-Pesa API
+        response_code = '0'
+        response_description = 'Success. Request accepted for processing.'
+
+    # 1. Record the pending sale and the M-Pesa Transaction Request
+    try:
+        sale_id = record_stk_request(
+            pump_shift, sale_id_no, attendant_id, amount, mobile_no,
+            checkout_request_id, merchant_request_id, response_code, response_description
+        )
+    except IntegrityError:
+        db.session.rollback()
+        return jsonify({'status': 'error', 'message': 'A sale with this sale_id_no already exists.'}), 409
+
+    # 2. Send the STK Push to Daraja; the result arrives later through /api/mpesa/callback
+    if live:
+        provisional_id = checkout_request_id
+        callback_url = current_app.config['MPESA_CALLBACK_URL'] or url_for('main.mpesa_callback', _external=True)
+        try:
+            result = daraja.stk_push(station_credentials(pump_shift.station_id), amount, mobile_no, sale_id_no,
+                                     'Fuel payment', callback_url)
+        except (ValueError, DarajaError) as e:
+            if getattr(e, 'sent', False):
+                # Daraja may have prompted the customer: keep the sale PENDING for `flask mpesa reconcile`
+                current_app.logger.error('No answer to the STK Push for sale %s (%s): %s',
+                                         sale_id_no, provisional_id, e)
+                return jsonify({'status': 'error', 'sale_id': sale_id, 'transaction_status': 'PENDING',
+                                'message': 'M-Pesa did not confirm the payment request; '
+                                           'check with the customer before retrying.'}), 504
+            current_app.logger.warning('STK Push for sale %s failed: %s (%s)', sale_id_no, e, getattr(e, 'body', None))
+            settle_transaction(provisional_id, STK_PUSH_FAILED, f'STK push failed: {e}')
+            return jsonify({'status': 'error', 'message': 'M-Pesa could not start the payment; retry with a new sale_id_no.',
+                            'sale_id': sale_id, 'transaction_status': 'FAILED'}), 502
+        checkout_request_id = result['CheckoutRequestID']
+        merchant_request_id = result.get('MerchantRequestID') or ''
+        try:
+            confirm_stk_request(provisional_id, checkout_request_id, merchant_request_id, result['ResponseCode'],
+                                result.get('ResponseDescription'))
+        except Exception:
+            db.session.rollback()
+            # The customer has been prompted: keep both ids in the log so the sale can be matched by hand
+            current_app.logger.exception('Could not record checkout request %s for sale %s (%s)',
+                                         checkout_request_id, sale_id, provisional_id)
+            return jsonify({'status': 'error', 'message': 'The payment was started but could not be recorded.',
+                            'sale_id': sale_id, 'checkout_request_id': checkout_request_id}), 500
+
+    # 3. Simulated results are settled in the background
+    elif current_app.config['MPESA_SIMULATE_CALLBACKS']:
+        settlements.schedule_simulation(checkout_request_id, current_app.config['MPESA_SIMULATION_DELAY'])
+
+    return jsonify({
+        'status': 'success',
+        'message': 'STK Push initiated. Poll the status endpoint for the result.',
+        'checkout_request_id': checkout_request_id,
+        'merchant_request_id': merchant_request_id,
+        'transaction_status': 'PENDING',
+        'sale_id': sale_id
+    }), 202
+
+@main.route('/api/mpesa/status/<checkout_request_id>', methods=['GET'])
+def stk_push_status(checkout_request_id):
+    # Optional long-poll: ?wait=<seconds> holds the request until the result arrives
+    wait = min(request.args.get('wait', 0, type=float), current_app.config['MPESA_STATUS_MAX_WAIT'])
+
+    def current_result_code():
+        db.session.rollback()  # end any open transaction so other workers' commits are visible
+        return db.session.query(MpesaTransaction.result_code).filter_by(checkout_request_id=checkout_request_id).scalar()
+
+    if wait > 0:
+        settlements.wait(checkout_request_id, wait, lambda: current_result_code() is not None)
+
+    db.session.expire_all()
+    mpesa_txn = MpesaTransaction.query.filter_by(checkout_request_id=checkout_request_id).first()
+    if not mpesa_txn:
+        return jsonify({'status': 'error', 'message': 'Unknown checkout request ID.'}), 404
+
+    return jsonify({
+        'status': 'success',
+        'checkout_request_id': mpesa_txn.checkout_request_id,
+        'transaction_status': transaction_status_for(mpesa_txn.result_code),
+        'result_code': mpesa_txn.result_code,
+        'result_description': mpesa_txn.result_description,
+        'sale_id': mpesa_txn.sale_id,
+        'mpesa_receipt_number': mpesa_txn.mpesa_receipt_number
+    }), 200
+
+@main.route('/api/mpesa/callback', methods=['POST'])
+def mpesa_callback():
+    # Daraja STK callback: {"Body": {"stkCallback": {...}}}
+    data = request.get_json(silent=True) or {}
+    callback = data.get('Body', {}).get('stkCallback', {})
+    checkout_request_id = callback.get('CheckoutRequestID')
+    result_code = callback.get('ResultCode')
+
+    if not checkout_request_id or result_code is None:
+        return jsonify({'ResultCode': 1, 'ResultDesc': 'Rejected: malformed callback'}), 400
+
+    items = callback.get('CallbackMetadata', {}).get('Item', [])
+    metadata = {item.get('Name'): item.get('Value') for item in items}
+
+    result = CallbackResult(
+        checkout_request_id,
+        result_code,
+        callback.get('ResultDesc'),
+        metadata.get('MpesaReceiptNumber')
     )
-    db.session.add(new_sale)
-    db.session.commit()
-    
-    # Link the Mpesa transaction to the sales record
-    mpesa_req.sale_id = new_sale.sale_id
-    db.session.commit()
+    # Acknowledge at once; the callback worker applies queued results in batches
+    try:
+        callback_queue.submit(result)
+    except sqlite3.Error:
+        current_app.logger.exception('Could not journal the callback for %s; applying it now', checkout_request_id)
+        if settle_batch([result])[1]:
+            current_app.logger.warning('No STK request recorded for checkout request %s', checkout_request_id)
+    return jsonify({'ResultCode': 0, 'ResultDesc': 'Accepted'}), 200
+
+@main.route('/api/sales/batch', methods=['POST'])
+def ingest_sales_batch():
+    # Offline-synced devices upload queued sales (and their M-Pesa results) in one request
+    data = request.get_json(silent=True) or {}
+    items = data.get('sales')
+    if not isinstance(items, list) or not items:
+        return jsonify({'status': 'error', 'message': "'sales' must be a non-empty list."}), 400
+    if len(items) > current_app.config['SALES_BATCH_MAX_ITEMS']:
+        return jsonify({
+            'status': 'error',
+            'message': f"At most {current_app.config['SALES_BATCH_MAX_ITEMS']} sales per batch."
+        }), 413
 
+    results = ingest_sales(items)
+    counts = {status: sum(1 for r in results if r['status'] == status) for status in ('created', 'exists', 'error')}
     return jsonify({
         'status': 'success',
-        'message': 'STK Push initiated and transaction simulated.',
-        'transaction_status': transaction_status,
-        'result_description': result_description,
-        'sale_id': new_sale.sale_id,
-        'mpesa_receipt_number': mpesa_receipt_number
+        'created': counts['created'],
+        'existing': counts['exists'],
+        'failed': counts['error'],
+        'results': results
     }), 200
 
+# --- Live Events ---
+
+@main.route('/api/events/stream', methods=['GET'])
+def event_stream():
+    # Server-sent events for shift and sale changes of the request's station, optionally for some pumps:
+    # ?station_id=1&pump_id=1,2. Clients resume with Last-Event-ID (or ?last_event_id=).
+    try:
+        pump_ids = {int(p) for p in request.args.get('pump_id', '').split(',') if p.strip()}
+        last_event_id = request.headers.get('Last-Event-ID') or request.args.get('last_event_id')
+        last_event_id = int(last_event_id) if last_event_id else None
+    except ValueError:
+        return jsonify({'status': 'error', 'message': 'pump_id and last_event_id must be integers.'}), 400
+
+    if event_feed.subscribers >= current_app.config['EVENT_MAX_SUBSCRIBERS']:
+        return jsonify({'status': 'error', 'message': 'Too many live subscribers, retry later.'}), 503
+
+    replayed, cursor, last_id = event_feed.replay(last_event_id, current_app.config['EVENT_REPLAY_LIMIT'])
+    subscription = Subscription(event_feed, replayed, cursor, last_id, current_station_id(), pump_ids)
+    return Response(subscription, mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'
+    })
+
 # --- Admin and Reporting Routes ---
 
 @main.route('/api/admin/users', methods=['GET', 'POST', 'PUT', 'DELETE'])
@@ -222,6 +388,7 @@ def manage_users():
     # Simplified user management for demonstration
     if request.method == 'GET':
         users = User.query.all()
+        roles = reference_data.get('roles')
         result = []
         for user in users:
             result.append({
@@ -229,22 +396,23 @@ def manage_users():
                 'full_name': user.full_name,
                 'username': user.username,
                 'mobile_no': user.mobile_no,
-                'role': user.role.role_name,
+                'role': roles.get(user.role_id),
                 'is_active': user.is_active
             })
         return jsonify(result), 200
     
     elif request.method == 'POST':
         data = request.get_json()
-        role = UserRole.query.filter_by(role_name=data.get('role')).first()
-        if not role:
+        role_id = next((role_id for role_id, name in reference_data.get('roles').items()
+                        if name == data.get('role')), None)
+        if role_id is None:
             return jsonify({'status': 'error', 'message': 'Invalid role name.'}), 400
             
         new_user = User(
             full_name=data.get('full_name'),
             username=data.get('username'),
             mobile_no=data.get('mobile_no'),
-            role_id=role.role_id
+            role_id=role_id
         )
         new_user.set_password(data.get('password'))
         db.session.add(new_user)
@@ -257,43 +425,85 @@ def manage_users():
 
 @main.route('/api/reports/sales', methods=['GET'])
 def get_sales_records():
-    # Filtering and searching logic
-    pump_id = request.args.get('pump_id', type=int)
-    attendant_id = request.args.get('attendant_id', type=int)
-    mobile_no = request.args.get('mobile_no')
-    shift_id = request.args.get('shift_id', type=int)
-    
-    query = SalesRecord.query.join(PumpShift).join(User, SalesRecord.attendant_id == User.user_id).join(Pump).join(Shift)
-
-    if pump_id:
-        query = query.filter(SalesRecord.pump_id == pump_id)
-    if attendant_id:
-        query = query.filter(SalesRecord.attendant_id == attendant_id)
-    if mobile_no:
-        # Search by mobile number (partial match)
-        query = query.filter(SalesRecord.customer_mobile_no.like(f'%{mobile_no}%'))
-    if shift_id:
-        query = query.filter(PumpShift.shift_id == shift_id)
-
-    sales = query.order_by(SalesRecord.sale_time.desc()).all()
-    
-    result = []
-    for sale in sales:
-        result.append({
-            'sale_id': sale.sale_id,
-            'sale_id_no': sale.sale_id_no,
-            'amount': float(sale.amount),
-            'sale_time': sale.sale_time.isoformat(),
-            'customer_mobile_no': sale.customer_mobile_no,
-            'mpesa_transaction_code': sale.mpesa_transaction_code,
-            'transaction_status': sale.transaction_status,
-            'pump_no': sale.pump.pump_no,
-            'pump_name': sale.pump.pump_name,
-            'shift_name': sale.pump_shift.shift.shift_name,
-            'attendant_name': sale.attendant.full_name
-        })
-        
-    return jsonify(result), 200
+    # Filtering and searching logic; ?from=&to= also decide whether archived sales are read
+    try:
+        filters = report_filters()
+    except ValueError:
+        return jsonify({'status': 'error', 'message': "'from' and 'to' must be ISO dates or datetimes."}), 400
+
+    limit = request.args.get('limit', type=int)
+    cursor = request.args.get('cursor')
+    after = None
+    if cursor:
+        try:
+            after = decode_cursor(cursor)
+        except ValueError:
+            return jsonify({'status': 'error', 'message': 'Invalid cursor.'}), 400
+
+    # Paged mode: ?limit=N[&cursor=...] returns one keyset page and the cursor for the next
+    if limit or cursor:
+        limit = max(1, min(limit or current_app.config['SALES_REPORT_MAX_PAGE_SIZE'],
+                           current_app.config['SALES_REPORT_MAX_PAGE_SIZE']))
+        rows = report_page(filters, limit, after)
+        next_cursor = encode_cursor(rows[-1].sale_time, rows[-1].sale_id) if len(rows) == limit else None
+        return jsonify({
+            'sales': [serialize_sale_row(row) for row in rows],
+            'next_cursor': next_cursor
+        }), 200
+
+    # Export modes stream keyset chunks, so a full history never sits in memory
+    rows = iter_sales_rows(filters, current_app.config['SALES_EXPORT_CHUNK_SIZE'])
+    if request.args.get('format') == 'ndjson':
+        return Response(stream_with_context(stream_ndjson(rows)), mimetype='application/x-ndjson'), 200
+    return Response(stream_with_context(stream_json_array(rows)), mimetype='application/json'), 200
+
+@main.route('/api/reports/sales/export', methods=['GET'])
+def export_sales():
+    # Columnar export for accountants: ?format=csv|parquet|arrow plus the sales report filters
+    export_format = request.args.get('format', 'csv')
+    if export_format not in EXPORT_FORMATS:
+        return jsonify({'status': 'error', 'message': "'format' must be csv, parquet or arrow."}), 400
+    try:
+        filters = report_filters()
+    except ValueError:
+        return jsonify({'status': 'error', 'message': "'from' and 'to' must be ISO dates or datetimes."}), 400
+
+    try:
+        chunks = export_stream(export_format, filters, current_app.config['SALES_COLUMNAR_CHUNK_SIZE'])
+    except ExportUnavailable as e:
+        return jsonify({'status': 'error', 'message': str(e)}), 501
+
+    mimetype, extension = EXPORT_FORMATS[export_format]
+    period = '-'.join(value for value in (request.args.get('from'), request.args.get('to')) if value) or 'all'
+    return Response(stream_with_context(chunks), mimetype=mimetype, headers={
+        'Content-Disposition': f'attachment; filename=sales-{period}.{extension}'
+    })
+
+@main.route('/api/reports/summary', methods=['GET'])
+def get_sales_summary():
+    # Totals per pump, pump_shift, shift, attendant, hour or day, served from sales_rollups
+    dimension = request.args.get('by', 'pump')
+    if dimension not in DIMENSIONS:
+        return jsonify({'status': 'error', 'message': f"'by' must be one of: {', '.join(DIMENSIONS)}."}), 400
+
+    # ?from=&to= are rounded out to whole hours (by=hour) or days (every other dimension)
+    try:
+        start, end = parse_range(request.args.get('from'), request.args.get('to'))
+    except ValueError:
+        return jsonify({'status': 'error', 'message': "'from' and 'to' must be ISO dates or datetimes."}), 400
+
+    summary = rollup_summary(dimension, start=start, end=end)
+    return jsonify(summary), 200
+
+@main.route('/api/reports/reconciliation', methods=['GET'])
+def get_reconciliation():
+    # Meter volume against sales and M-Pesa takings for every pump shift opened in ?from=&to=
+    try:
+        start, end = parse_range(request.args.get('from'), request.args.get('to'))
+    except ValueError:
+        return jsonify({'status': 'error', 'message': "'from' and 'to' must be ISO dates or datetimes."}), 400
+
+    return jsonify(reconcile_range(start, end)), 200
 
 # --- Utility Routes ---
 
@@ -301,22 +511,17 @@ def get_sales_records():
 def status():
     return jsonify({'status': 'ok', 'message': 'Energy App Backend is running'}), 200
 
+@main.route('/api/status/db', methods=['GET'])
+def database_status_route():
+    # Pool occupancy and how long requests have waited for a connection
+    return jsonify({'status': 'ok', 'database': database_status()}), 200
+
 @main.route('/api/filters', methods=['GET'])
 def get_filters():
-    # Get all unique attendants who have made sales
-    attendants = db.session.query(User.user_id, User.full_name).join(SalesRecord, User.user_id == SalesRecord.attendant_id).distinct().all()
-    attendant_list = [{'id': a.user_id, 'name': a.full_name} for a in attendants]
-    
-    # Get all pumps
-    pumps = Pump.query.all()
-    pump_list = [{'id': p.pump_id, 'name': p.pump_name, 'no': p.pump_no} for p in pumps]
-    
-    # Get all shifts
-    shifts = Shift.query.all()
-    shift_list = [{'id': s.shift_id, 'name': s.shift_name} for s in shifts]
-    
+    # Attendants who have made sales, pumps and shifts, all from the reference data cache
+    attendants, pumps, shifts = reference_data.get_many('attendants', 'pumps', 'shifts')
     return jsonify({
-        'attendants': attendant_list,
-        'pumps': pump_list,
-        'shifts': shift_list
+        'attendants': attendants,
+        'pumps': [{'id': p['id'], 'name': p['name'], 'no': p['no']} for p in pumps],
+        'shifts': [{'id': s['shift_id'], 'name': s['shift_name']} for s in shifts]
     }), 200
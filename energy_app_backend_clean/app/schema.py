@@ -0,0 +1,172 @@
+import click
+from flask.cli import AppGroup
+from sqlalchemy import func, inspect
+from sqlalchemy.schema import CreateColumn
+
+from app import db
+from app.models import Pump, PumpShift, SalesRollup, MYSQL_OPEN_SHIFT_GUARD, MYSQL_UNASSIGNED_PUMP_GUARD
+
+schema_cli = AppGroup('schema', help='Upgrade the schema of an existing database.')
+
+ONE_OPEN_SHIFT_INDEX = 'uq_pump_shifts_one_open'
+UNASSIGNED_PUMP_NO_INDEX = 'uq_pumps_unassigned_pump_no'
+
+# Tables computed from sales history; they are recreated, then rebuilt, when their primary key changes
+DERIVED_TABLES = (SalesRollup.__table__,)
+
+
+def pumps_with_several_open_shifts():
+    """Returns the pump ids that currently have more than one open shift."""
+    rows = db.session.query(PumpShift.pump_id) \
+        .filter(PumpShift.is_closed == False) \
+        .group_by(PumpShift.pump_id) \
+        .having(func.count(PumpShift.pump_shift_id) > 1) \
+        .all()
+    return [row.pump_id for row in rows]
+
+
+def duplicate_unassigned_pump_numbers():
+    """Returns the pump numbers shared by several pumps without a station."""
+    rows = db.session.query(Pump.pump_no) \
+        .filter(Pump.station_id == None) \
+        .group_by(Pump.pump_no) \
+        .having(func.count(Pump.pump_id) > 1) \
+        .execution_options(all_stations=True) \
+        .all()
+    return [row.pump_no for row in rows]
+
+
+def upgrade_columns():
+    """Adds model columns missing from tables that already exist; returns 'table.column' names.
+
+    Only nullable columns can be added this way; they start out NULL and are
+    filled by their own backfill command.
+    """
+    engine = db.engine
+    inspector = inspect(engine)
+    added = []
+    with engine.begin() as conn:
+        for table in db.metadata.sorted_tables:
+            if not inspector.has_table(table.name):
+                continue
+            existing = {column['name'] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name in existing or not column.nullable:
+                    continue
+                spec = CreateColumn(column).compile(dialect=engine.dialect)
+                conn.exec_driver_sql(f'ALTER TABLE {table.name} ADD COLUMN {spec}')
+                added.append(f'{table.name}.{column.name}')
+    return added
+
+
+def upgrade_derived_tables():
+    """Recreates the derived tables whose primary key has columns the database lacks; returns their names."""
+    engine = db.engine
+    inspector = inspect(engine)
+    recreated = []
+    for table in DERIVED_TABLES:
+        if not inspector.has_table(table.name):
+            continue
+        existing = {column['name'] for column in inspector.get_columns(table.name)}
+        if all(column.name in existing for column in table.primary_key.columns):
+            continue
+        table.drop(engine)
+        table.create(engine)
+        recreated.append(table.name)
+    return recreated
+
+
+def upgrade_indexes():
+    """Creates the model indexes missing from tables that already exist.
+
+    db.create_all only creates whole tables, so databases created before the
+    indexes were declared need this once. Returns (created, skipped) index names;
+    the one-open-shift and unassigned pump number constraints are skipped while
+    existing data violates them.
+    """
+    engine = db.engine
+    inspector = inspect(engine)
+    created, skipped = [], []
+
+    blocked = {ONE_OPEN_SHIFT_INDEX: pumps_with_several_open_shifts(),
+               UNASSIGNED_PUMP_NO_INDEX: duplicate_unassigned_pump_numbers()}
+    for table in db.metadata.sorted_tables:
+        if not inspector.has_table(table.name):
+            continue
+        existing = {index['name'] for index in inspector.get_indexes(table.name)}
+        for index in table.indexes:
+            if index.name in existing:
+                continue
+            if blocked.get(index.name):
+                skipped.append(index.name)
+                continue
+            index.create(engine)
+            # ddl_if may have skipped it for this dialect
+            if index.name in {i['name'] for i in inspect(engine).get_indexes(table.name)}:
+                created.append(index.name)
+
+    if engine.dialect.name == 'mysql':
+        guards = ((PumpShift.__tablename__, ONE_OPEN_SHIFT_INDEX, MYSQL_OPEN_SHIFT_GUARD),
+                  (Pump.__tablename__, UNASSIGNED_PUMP_NO_INDEX, MYSQL_UNASSIGNED_PUMP_GUARD))
+        for table_name, name, statements in guards:
+            if not inspector.has_table(table_name):
+                continue
+            if name in {index['name'] for index in inspector.get_indexes(table_name)}:
+                continue
+            if blocked[name]:
+                skipped.append(name)
+            else:
+                with engine.begin() as conn:
+                    for statement in statements:
+                        conn.exec_driver_sql(statement)
+                created.append(name)
+
+    return created, skipped
+
+
+@schema_cli.command('upgrade')
+def upgrade_command():
+    """Add missing tables, columns, indexes and constraints to an existing database."""
+    from app.rollups import rebuild_rollups
+    from app.search import backfill_search_index
+    db.create_all()
+    recreated = upgrade_derived_tables()
+    for name in recreated:
+        click.echo(f'Recreated {name}.')
+    for name in upgrade_columns():
+        click.echo(f'Added column {name}')
+    _report_indexes()
+    if recreated:
+        click.echo(f'Rebuilt {rebuild_rollups()} rollup groups.')
+    click.echo(f'Indexed the customer numbers of {backfill_search_index()} sales.')
+
+
+@schema_cli.command('bootstrap')
+@click.option('--force', is_flag=True, help='Re-apply the upgrades and seeds even if the version is current.')
+def bootstrap_command(force):
+    """Create or upgrade the schema and seed default data, unless the database is already current."""
+    from app.bootstrap import SCHEMA_VERSION, applied_version, bootstrap_database
+    if bootstrap_database(force):
+        click.echo(f'Bootstrapped the database to schema version {applied_version()}.')
+    else:
+        click.echo(f'Schema version {applied_version()} is current (this release expects {SCHEMA_VERSION}).')
+
+
+@schema_cli.command('upgrade-indexes')
+def upgrade_indexes_command():
+    """Add missing indexes and constraints to an existing database."""
+    _report_indexes()
+
+
+def _report_indexes():
+    created, skipped = upgrade_indexes()
+    for name in created:
+        click.echo(f'Created {name}')
+    if ONE_OPEN_SHIFT_INDEX in skipped:
+        click.echo(f'Skipped {ONE_OPEN_SHIFT_INDEX}: pumps {pumps_with_several_open_shifts()} have '
+                   'more than one open shift. Close the extra shifts and re-run.')
+    if UNASSIGNED_PUMP_NO_INDEX in skipped:
+        click.echo(f'Skipped {UNASSIGNED_PUMP_NO_INDEX}: pump numbers {duplicate_unassigned_pump_numbers()} '
+                   'are used by several pumps without a station. Renumber or assign them and re-run.')
+    if not created and not skipped:
+        click.echo('All indexes are up to date.')
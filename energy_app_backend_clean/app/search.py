@@ -0,0 +1,148 @@
+import re
+
+import click
+from flask.cli import AppGroup
+from sqlalchemy import and_, event, inspect, or_
+
+from app import db
+from app.models import MobileSearchToken, SalesRecord
+
+search_cli = AppGroup('search', help='Maintain the customer mobile number search index.')
+
+# Numbers are stored by subscriber digits, so 0712345678, 254712345678 and +254 712 345 678 all match
+COUNTRY_CODE = '254'
+SUBSCRIBER_DIGITS = 9
+NATIONAL_PREFIXES = ('07', '01')
+
+# Sorts after every digit, so [q, q + RANGE_END) covers all tokens starting with q
+RANGE_END = ':'
+
+BACKFILL_CHUNK_SIZE = 5000
+
+
+def normalize_mobile(mobile_no):
+    """Returns the subscriber digits of a stored customer number, or None."""
+    digits = re.sub(r'\D', '', mobile_no or '')
+    if digits.startswith(COUNTRY_CODE) and len(digits) > SUBSCRIBER_DIGITS:
+        digits = digits[len(COUNTRY_CODE):]
+    elif digits.startswith('0') and len(digits) == SUBSCRIBER_DIGITS + 1:
+        digits = digits[1:]
+    return digits or None
+
+
+def normalize_search(term):
+    """Returns the (digits, anchored) patterns a partial number typed into a search matches.
+
+    Anchored patterns must start the subscriber digits. A leading 254 or 0 is
+    only dropped as a prefix; unless the term is a whole number or starts with
+    +, its digits are also matched anywhere as typed.
+
+    >>> normalize_search('+254 712')
+    [('712', True)]
+    >>> normalize_search('0712345678')
+    [('712345678', True)]
+    >>> normalize_search('0789')
+    [('0789', False), ('789', True)]
+    >>> normalize_search('2547')
+    [('2547', False), ('7', True)]
+    >>> normalize_search('345')
+    [('345', False)]
+    """
+    digits = re.sub(r'\D', '', term or '')
+    if digits.startswith(COUNTRY_CODE) and len(digits) > len(COUNTRY_CODE):
+        national = digits[len(COUNTRY_CODE):]
+        whole = len(digits) == len(COUNTRY_CODE) + SUBSCRIBER_DIGITS
+    elif digits.startswith(NATIONAL_PREFIXES):
+        national = digits[1:]
+        whole = len(digits) == SUBSCRIBER_DIGITS + 1
+    else:
+        return [(digits, False)] if digits else []
+    if whole or (term or '').lstrip().startswith('+'):
+        return [(national, True)]
+    return [(digits, False), (national, True)]
+
+
+def suffix_tokens(mobile_norm):
+    return [{'token': mobile_norm[i:], 'mobile_norm': mobile_norm} for i in range(len(mobile_norm))]
+
+
+def index_mobile_numbers(connection, numbers):
+    """Adds the search tokens for `numbers`, ignoring ones already indexed."""
+    rows = [row for number in set(filter(None, numbers)) for row in suffix_tokens(number)]
+    if not rows:
+        return
+    table = MobileSearchToken.__table__
+    dialect = connection.dialect.name
+    if dialect == 'sqlite':
+        from sqlalchemy.dialects.sqlite import insert
+        stmt = insert(table).on_conflict_do_nothing()
+    elif dialect == 'postgresql':
+        from sqlalchemy.dialects.postgresql import insert
+        stmt = insert(table).on_conflict_do_nothing()
+    else:
+        stmt = table.insert().prefix_with('IGNORE')
+    connection.execute(stmt, rows)
+
+
+def matching_numbers(term):
+    """Returns a subquery of normalized numbers matching `term`, or None if it has no digits."""
+    patterns = normalize_search(term)
+    if not patterns:
+        return None
+    token = MobileSearchToken.token
+    conditions = []
+    for digits, anchored in patterns:
+        condition = and_(token >= digits, token < digits + RANGE_END)
+        if anchored:
+            # The whole number is the token starting at its first digit
+            condition = and_(condition, token == MobileSearchToken.mobile_norm)
+        conditions.append(condition)
+    return db.session.query(MobileSearchToken.mobile_norm) \
+        .filter(or_(*conditions)) \
+        .distinct() \
+        .subquery()
+
+
+@event.listens_for(SalesRecord, 'before_insert')
+def _normalize_on_insert(mapper, connection, target):
+    target.customer_mobile_norm = normalize_mobile(target.customer_mobile_no)
+    index_mobile_numbers(connection, [target.customer_mobile_norm])
+
+
+@event.listens_for(SalesRecord, 'before_update')
+def _normalize_on_update(mapper, connection, target):
+    if inspect(target).attrs.customer_mobile_no.history.has_changes():
+        _normalize_on_insert(mapper, connection, target)
+
+
+def backfill_search_index():
+    """Normalizes and indexes sales recorded before the search index existed; returns the row count."""
+    count = 0
+    while True:
+        rows = db.session.query(SalesRecord.sale_id, SalesRecord.customer_mobile_no) \
+            .filter(SalesRecord.customer_mobile_norm == None, SalesRecord.customer_mobile_no != None) \
+            .limit(BACKFILL_CHUNK_SIZE) \
+            .all()
+        if not rows:
+            break
+        # Numbers without digits are stored as '' so they are not picked up again
+        updates = [{'b_sale_id': row.sale_id, 'b_norm': normalize_mobile(row.customer_mobile_no) or ''}
+                   for row in rows]
+        table = SalesRecord.__table__
+        db.session.execute(
+            table.update()
+                .where(table.c.sale_id == db.bindparam('b_sale_id'))
+                .values(customer_mobile_norm=db.bindparam('b_norm')),
+            updates
+        )
+        index_mobile_numbers(db.session.connection(), [u['b_norm'] for u in updates])
+        db.session.commit()
+        count += len(rows)
+    return count
+
+
+@search_cli.command('backfill')
+def backfill_command():
+    """Index the customer numbers of existing sales."""
+    count = backfill_search_index()
+    click.echo(f'Indexed {count} sales.')
@@ -0,0 +1,148 @@
+import click
+from flask import g, has_request_context, jsonify, request
+from flask.cli import AppGroup
+from sqlalchemy import event, select, update
+from sqlalchemy.orm import Session, with_loader_criteria
+
+from app import db
+from app.models import (
+    MpesaTransaction, MpesaTransactionArchive, Pump, PumpShift, SalesRecord, SalesRecordArchive, Station,
+    StationScoped
+)
+
+stations_cli = AppGroup('stations', help='Manage stations and assign existing data to them.')
+
+STATION_HEADER = 'X-Station-ID'
+
+
+def current_station_id():
+    """The station the current request is scoped to, or None for fleet-wide access and outside requests."""
+    if has_request_context():
+        return g.get('station_id')
+    return None
+
+
+def _load_station_context():
+    # X-Station-ID (or ?station_id=) scopes the whole request to one station
+    g.station_id = None
+    value = request.headers.get(STATION_HEADER) or request.args.get('station_id')
+    if not value:
+        return None
+    try:
+        station_id = int(value)
+    except ValueError:
+        return jsonify({'status': 'error', 'message': 'station_id must be an integer.'}), 400
+
+    from app.reference import reference_data
+    station = reference_data.get('stations').get(station_id)
+    if station is None or not station['is_active']:
+        return jsonify({'status': 'error', 'message': 'Unknown station.'}), 404
+    g.station_id = station_id
+    return None
+
+
+def init_stations(app):
+    app.before_request(_load_station_context)
+
+
+@event.listens_for(Session, 'do_orm_execute')
+def _limit_to_station(execute_state):
+    """Adds `station_id = :station` for every station-scoped model in the ORM SELECTs of a scoped request.
+
+    The per-station indexes lead with station_id, so a station's queries read
+    its own rows only. Pass execution_options(all_stations=True) for lookups
+    that must see every station, such as checks on globally unique keys.
+    """
+    if not execute_state.is_select or execute_state.is_column_load or execute_state.is_relationship_load:
+        return
+    if execute_state.execution_options.get('all_stations'):
+        return
+    station_id = current_station_id()
+    if station_id is None:
+        return
+    execute_state.statement = execute_state.statement.options(*[
+        with_loader_criteria(model, model.station_id == station_id, include_aliases=True)
+        for model in StationScoped.__subclasses__()
+    ])
+
+
+def assign_pumps(station_id, pump_ids=None):
+    """Assigns pumps without a station, and the history recorded on them, to `station_id`.
+
+    `pump_ids` limits it to those pumps (which may already belong to another
+    station); by default every unassigned pump is moved. Returns the number of
+    rows updated per table.
+    """
+    pumps = Pump.__table__
+    shifts = PumpShift.__table__
+    sales = SalesRecord.__table__
+    sales_archive = SalesRecordArchive.__table__
+    counts = {}
+
+    pump_filter = pumps.c.pump_id.in_(pump_ids) if pump_ids else pumps.c.station_id.is_(None)
+    selected = [row.pump_id for row in db.session.execute(select(pumps.c.pump_id).where(pump_filter))]
+    if not selected:
+        return counts
+    counts['pumps'] = db.session.execute(
+        update(pumps).where(pumps.c.pump_id.in_(selected)).values(station_id=station_id)
+    ).rowcount
+    for table in (shifts, sales, sales_archive):
+        counts[table.name] = db.session.execute(
+            update(table).where(table.c.pump_id.in_(selected)).values(station_id=station_id)
+        ).rowcount
+    for table, sale_table in ((MpesaTransaction.__table__, sales), (MpesaTransactionArchive.__table__, sales_archive)):
+        sale_ids = select(sale_table.c.sale_id).where(sale_table.c.pump_id.in_(selected))
+        counts[table.name] = db.session.execute(
+            update(table).where(table.c.sale_id.in_(sale_ids)).values(station_id=station_id)
+        ).rowcount
+    db.session.commit()
+    return counts
+
+
+@stations_cli.command('add')
+@click.argument('code')
+@click.argument('name')
+@click.option('--till-number')
+@click.option('--shortcode')
+@click.option('--passkey')
+@click.option('--consumer-key')
+@click.option('--consumer-secret')
+def add_command(code, name, till_number, shortcode, passkey, consumer_key, consumer_secret):
+    """Add a station; M-Pesa options left out use the settings table's credentials."""
+    db.create_all()
+    station = Station(station_code=code, station_name=name, mpesa_till_number=till_number,
+                      mpesa_shortcode=shortcode, mpesa_passkey=passkey, mpesa_consumer_key=consumer_key,
+                      mpesa_consumer_secret=consumer_secret)
+    db.session.add(station)
+    db.session.commit()
+    click.echo(f'Added station {station.station_id} ({code}).')
+
+
+@stations_cli.command('list')
+def list_command():
+    """List the stations and their pump counts."""
+    for station in Station.query.order_by(Station.station_id):
+        state = 'active' if station.is_active else 'inactive'
+        click.echo(f'{station.station_id:>4} {station.station_code:<12} {station.station_name:<30} '
+                   f'{len(station.pumps):>3} pumps, {state}')
+
+
+@stations_cli.command('assign')
+@click.argument('station_id', type=int)
+@click.option('--pump-id', 'pump_ids', type=int, multiple=True, help='Pump to move; repeat for several.')
+def assign_command(station_id, pump_ids):
+    """Assign pumps (all unassigned ones by default) and their shifts, sales and payments to a station.
+
+    Run it once per station after `flask schema upgrade` on a single-station
+    database; the sales rollups are rebuilt afterwards.
+    """
+    from app.rollups import rebuild_rollups
+    if db.session.get(Station, station_id) is None:
+        raise click.BadParameter(f'no station {station_id}')
+    counts = assign_pumps(station_id, pump_ids)
+    if not counts:
+        click.echo('No pumps to assign.')
+        return
+    for table, count in counts.items():
+        click.echo(f'{table}: {count} rows.')
+    click.echo(f'Rebuilt {rebuild_rollups()} rollup groups.')
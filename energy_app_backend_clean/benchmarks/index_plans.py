@@ -0,0 +1,122 @@
+"""Shows the query plans and timings of the hot lookups before and after the model indexes.
+
+Seeds a SQLite database with a large sales_records table (1M rows by default),
+runs each hot query without the secondary indexes, creates them through
+app.schema.upgrade_indexes and runs the queries again.
+
+    python -m benchmarks.index_plans [--rows 1000000] [--db /tmp/energy_bench.db]
+"""
+import argparse
+import os
+import time
+
+from app import create_app, db
+from app.schema import upgrade_indexes
+from benchmarks.seed import seed
+from config import Config
+
+HOT_QUERIES = {
+    'open shift for pump': (
+        'SELECT pump_shift_id FROM pump_shifts WHERE pump_id = :pump_id AND is_closed = 0 '
+        'ORDER BY opening_time DESC LIMIT 1', {'pump_id': 7}),
+    'latest sales for pump': (
+        'SELECT sale_id FROM sales_records WHERE pump_id = :pump_id '
+        'ORDER BY sale_time DESC LIMIT 50', {'pump_id': 7}),
+    'latest sales for attendant': (
+        'SELECT sale_id FROM sales_records WHERE attendant_id = :attendant_id '
+        'ORDER BY sale_time DESC LIMIT 50', {'attendant_id': 3}),
+    'keyset page': (
+        'SELECT sale_id FROM sales_records WHERE sale_time < :sale_time '
+        'ORDER BY sale_time DESC, sale_id DESC LIMIT 50', {'sale_time': '2025-06-01 00:00:00'}),
+    'sales for customer': (
+        'SELECT sale_id FROM sales_records WHERE customer_mobile_no = :mobile_no', {'mobile_no': None}),
+    'sales in shift': (
+        'SELECT count(*) FROM sales_records WHERE pump_shift_id = :pump_shift_id', {'pump_shift_id': 100}),
+    'transaction by checkout id': (
+        'SELECT transaction_id FROM mpesa_transactions WHERE checkout_request_id = :checkout_request_id',
+        {'checkout_request_id': None}),
+}
+
+
+def bench_config(path):
+    class BenchConfig(Config):
+        SQLALCHEMY_DATABASE_URI = f'sqlite:///{path}'
+    return BenchConfig
+
+
+def measure(conn, repeat):
+    """Returns {query name: (plan, best time in ms)}."""
+    results = {}
+    for name, (sql, params) in HOT_QUERIES.items():
+        statement = db.text(sql)
+        plan = ' | '.join(row[-1] for row in conn.execute(db.text('EXPLAIN QUERY PLAN ' + sql), params))
+        best = float('inf')
+        for _ in range(repeat):
+            started = time.perf_counter()
+            conn.execute(statement, params).fetchall()
+            best = min(best, time.perf_counter() - started)
+        results[name] = (plan, best * 1000)
+    return results
+
+
+def report(before, after):
+    for name in HOT_QUERIES:
+        plan_before, ms_before = before[name]
+        plan_after, ms_after = after[name]
+        print(f'\n{name}')
+        print(f'  before {ms_before:10.3f} ms  {plan_before}')
+        print(f'  after  {ms_after:10.3f} ms  {plan_after}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rows', type=int, default=1_000_000)
+    parser.add_argument('--db', default='/tmp/energy_index_bench.db')
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+    if args.rows < 1:
+        parser.error('--rows must be at least 1')
+
+    if os.path.exists(args.db):
+        os.remove(args.db)
+    app = create_app(bench_config(args.db))
+
+    with app.app_context():
+        # Create the tables as they were before the secondary indexes were declared
+        for table in db.metadata.sorted_tables:
+            table.create(db.engine)
+
+        started = time.perf_counter()
+        with db.engine.begin() as conn:
+            for table in db.metadata.sorted_tables:
+                for index in table.indexes:
+                    conn.exec_driver_sql(f'DROP INDEX IF EXISTS {index.name}')
+            checkout_ids = seed(conn, args.rows)
+            conn.exec_driver_sql('ANALYZE')
+        print(f'Seeded {args.rows} sales in {time.perf_counter() - started:.1f}s')
+
+        HOT_QUERIES['transaction by checkout id'][1]['checkout_request_id'] = checkout_ids[len(checkout_ids) // 2]
+        with db.engine.connect() as conn:
+            HOT_QUERIES['sales for customer'][1]['mobile_no'] = conn.execute(db.text(
+                'SELECT customer_mobile_no FROM sales_records WHERE sale_id = :sale_id'), {'sale_id': args.rows // 2}
+            ).scalar()
+
+        with db.engine.connect() as conn:
+            before = measure(conn, args.repeat)
+
+        started = time.perf_counter()
+        created, skipped = upgrade_indexes()
+        with db.engine.begin() as conn:
+            conn.exec_driver_sql('ANALYZE')
+        print(f'Created {len(created)} indexes in {time.perf_counter() - started:.1f}s: {", ".join(created)}')
+        if skipped:
+            print(f'Skipped: {", ".join(skipped)}')
+
+        with db.engine.connect() as conn:
+            after = measure(conn, args.repeat)
+
+    report(before, after)
+
+
+if __name__ == '__main__':
+    main()
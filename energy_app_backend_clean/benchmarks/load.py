@@ -0,0 +1,404 @@
+"""Load test for the HTTP API against a seeded database and a mock Daraja.
+
+Seeds a SQLite database with a realistic sales history (1M sales by default),
+serves the app on a threaded local server, and drives login, pump state,
+STK push and report requests at a fixed concurrency. M-Pesa results are
+delivered to /api/mpesa/callback by benchmarks.mock_daraja, as Daraja would.
+Prints p50/p95/p99 latency, throughput and SQL statements per request, and can
+save the results as a baseline or compare them against a saved one.
+
+    python -m benchmarks.load [--sales 1000000] [--requests 500] [--concurrency 16]
+                              [--save baseline] [--compare baseline]
+
+With --base-url the scenarios run against an already running server (for
+example gunicorn on a seeded database) and statement counts are not reported.
+With --live-daraja the in-process app sends its STK pushes to the mock through
+app.daraja, so OAuth, pooling and callbacks are exercised end to end.
+"""
+import argparse
+import http.client
+import json
+import logging
+import os
+import platform
+import random
+import sys
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from urllib.parse import urlparse
+
+from flask import request
+from sqlalchemy import event
+from sqlalchemy.exc import OperationalError
+from werkzeug.serving import make_server
+
+from app import bcrypt, create_app, db
+from app.models import initialize_db
+from app.rollups import rebuild_rollups
+from benchmarks import seed
+from benchmarks.mock_daraja import MockDaraja
+from config import Config
+
+BASELINE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baselines')
+PASSWORD = 'pass123'
+SCENARIOS = ('login', 'pumps', 'stk_push', 'reports', 'reports_mobile', 'summary')
+
+
+def load_config(path, daraja_url=None):
+    class LoadConfig(Config):
+        SQLALCHEMY_DATABASE_URI = f'sqlite:///{path}'
+        # Results arrive from the mock Daraja instead of the in-process simulation
+        MPESA_SIMULATE_CALLBACKS = False
+        MPESA_LIVE = daraja_url is not None
+        MPESA_API_URL = daraja_url or Config.MPESA_API_URL
+    return LoadConfig
+
+
+def prepare_database(app, path, sales):
+    """Seeds `path` unless it already holds a seeded database of at least `sales` sales."""
+    with app.app_context():
+        if os.path.exists(path):
+            try:
+                count = db.session.execute(db.text('SELECT count(*) FROM sales_records')).scalar()
+            except OperationalError:
+                count = 0
+            db.session.remove()
+            if count >= sales:
+                print(f'Reusing {path} ({count} sales)')
+                return
+            db.engine.dispose()
+            for suffix in ('', '-wal', '-shm'):
+                if os.path.exists(path + suffix):
+                    os.remove(path + suffix)
+
+        started = time.perf_counter()
+        db.create_all()
+        password_hash = bcrypt.generate_password_hash(PASSWORD).decode('utf-8')
+        with db.engine.begin() as conn:
+            seed.seed(conn, sales, password_hash)
+    initialize_db(app)
+    with app.app_context():
+        rebuild_rollups()
+        with db.engine.begin() as conn:
+            conn.exec_driver_sql('ANALYZE')
+    print(f'Seeded {sales} sales in {time.perf_counter() - started:.1f}s')
+
+
+class StatementCounter:
+    """Counts the SQL statements each endpoint issues, per request."""
+
+    def __init__(self):
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self.totals = defaultdict(lambda: [0, 0])  # endpoint -> [requests, statements]
+
+    def install(self, app):
+        with app.app_context():
+            event.listen(db.engine, 'before_cursor_execute', self._count)
+        app.before_request(self._start)
+        # Paged reports are not streamed, so teardown sees every statement of the request
+        app.teardown_request(self._finish)
+
+    def _count(self, *args):
+        if getattr(self._local, 'statements', None) is not None:
+            self._local.statements += 1
+
+    def _start(self):
+        self._local.statements = 0
+
+    def _finish(self, exc):
+        statements, self._local.statements = self._local.statements, None
+        if statements is None:
+            return
+        with self._lock:
+            totals = self.totals[request.endpoint]
+            totals[0] += 1
+            totals[1] += statements
+
+    def per_request(self, endpoint):
+        with self._lock:
+            requests, statements = self.totals.get(endpoint, (0, 0))
+        return round(statements / requests, 2) if requests else None
+
+    def reset(self):
+        with self._lock:
+            self.totals.clear()
+
+
+class Client:
+    """One keep-alive connection per worker thread."""
+
+    def __init__(self, base_url):
+        self.url = urlparse(base_url)
+        self._local = threading.local()
+
+    def _connection(self):
+        if getattr(self._local, 'connection', None) is None:
+            self._local.connection = http.client.HTTPConnection(self.url.hostname, self.url.port, timeout=60)
+        return self._local.connection
+
+    def request(self, method, path, body=None, headers=None):
+        headers = dict(headers or {})
+        data = None
+        if body is not None:
+            data = json.dumps(body).encode('utf-8')
+            headers['Content-Type'] = 'application/json'
+        for attempt in range(2):
+            connection = self._connection()
+            try:
+                connection.request(method, path, data, headers)
+                response = connection.getresponse()
+                payload = response.read()
+                return response.status, payload
+            except (http.client.HTTPException, OSError):
+                connection.close()
+                self._local.connection = None
+                if attempt:
+                    raise
+
+
+class Scenarios:
+    """Builds the requests of each scenario from the state of the seeded database."""
+
+    def __init__(self, client, daraja, callback_url, live_daraja=False):
+        self.client = client
+        self.daraja = daraja
+        self.callback_url = callback_url
+        self.live_daraja = live_daraja
+        self.run_id = datetime.now().strftime('%Y%m%d%H%M%S')
+
+        status, body = client.request('POST', '/api/login', {'username': 'attendant1', 'password': PASSWORD})
+        if status != 200:
+            raise SystemExit(f'Login failed ({status}); is the database seeded?')
+        self.attendant_id = json.loads(body)['user']['user_id']
+
+        status, body = client.request('GET', '/api/pumps')
+        pumps = json.loads(body)
+        self.pump_ids = [pump['pump_id'] for pump in pumps]
+        self.open_shifts = [pump['current_shift_id'] for pump in pumps if pump['current_shift_id']]
+        if not self.open_shifts:
+            raise SystemExit('No open pump shifts to record STK pushes against.')
+
+    def login(self, i):
+        return self.client.request('POST', '/api/login', {
+            'username': f'attendant{i % seed.ATTENDANTS + 1}', 'password': PASSWORD})
+
+    def pumps(self, i):
+        return self.client.request('GET', '/api/pumps')
+
+    def stk_push(self, i):
+        mobile = f'07{random.randrange(10 ** 8):08d}'
+        amount = random.randint(100, 5000)
+        status, body = self.client.request('POST', '/api/mpesa/stk_push', {
+            'mobile_no': mobile, 'amount': amount, 'sale_id_no': f'LOAD-{self.run_id}-{i}',
+            'pump_shift_id': random.choice(self.open_shifts), 'attendant_id': self.attendant_id})
+        if status == 202 and not self.live_daraja:
+            # The app simulated the push, so ask the mock for the callback Daraja would send
+            self.daraja.schedule_callback(json.loads(body)['checkout_request_id'], '', self.callback_url,
+                                          amount, '254' + mobile[1:])
+        return status, body
+
+    def reports(self, i):
+        return self.client.request('GET', f'/api/reports/sales?limit=50&pump_id={random.choice(self.pump_ids)}')
+
+    def reports_mobile(self, i):
+        return self.client.request('GET', f'/api/reports/sales?limit=50&mobile_no={random.randrange(10000):04d}')
+
+    def summary(self, i):
+        return self.client.request('GET', '/api/reports/summary?by=day')
+
+
+ENDPOINTS = {
+    'login': 'main.login',
+    'pumps': 'main.get_pumps',
+    'stk_push': 'main.stk_push_simulation',
+    'reports': 'main.get_sales_records',
+    'reports_mobile': 'main.get_sales_records',
+    'summary': 'main.get_sales_summary',
+}
+
+
+def percentile(ordered, fraction):
+    if not ordered:
+        return None
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def run_scenario(name, send, requests, concurrency, counter):
+    """Sends `requests` requests from `concurrency` threads; returns the scenario's measurements."""
+    if counter:
+        counter.reset()
+    latencies, errors = [], defaultdict(int)
+    lock = threading.Lock()
+
+    def one(i):
+        started = time.perf_counter()
+        try:
+            status, _ = send(i)
+        except (http.client.HTTPException, OSError) as e:
+            status = type(e).__name__
+        elapsed = time.perf_counter() - started
+        with lock:
+            latencies.append(elapsed)
+            if status not in (200, 202, 304):
+                errors[str(status)] += 1
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(one, range(requests)))
+    duration = time.perf_counter() - started
+
+    latencies.sort()
+    return {
+        'requests': requests,
+        'errors': dict(errors),
+        'throughput_rps': round(requests / duration, 1),
+        'p50_ms': round(percentile(latencies, 0.50) * 1000, 2),
+        'p95_ms': round(percentile(latencies, 0.95) * 1000, 2),
+        'p99_ms': round(percentile(latencies, 0.99) * 1000, 2),
+        'queries_per_request': counter.per_request(ENDPOINTS[name]) if counter else None,
+    }
+
+
+def wait_for_callbacks(daraja, timeout):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        stats = dict(daraja.stats)
+        if stats['callbacks_sent'] + stats['callbacks_failed'] >= stats['callbacks_scheduled']:
+            break
+        time.sleep(0.2)
+    return dict(daraja.stats)
+
+
+def print_results(results):
+    print(f'\n{"scenario":<16}{"req/s":>9}{"p50 ms":>10}{"p95 ms":>10}{"p99 ms":>10}{"queries":>9}  errors')
+    for name, r in results.items():
+        queries = '-' if r['queries_per_request'] is None else f'{r["queries_per_request"]:g}'
+        errors = ', '.join(f'{status}: {count}' for status, count in r['errors'].items()) or '-'
+        print(f'{name:<16}{r["throughput_rps"]:>9}{r["p50_ms"]:>10}{r["p95_ms"]:>10}{r["p99_ms"]:>10}'
+              f'{queries:>9}  {errors}')
+
+
+def compare(results, baseline, tolerance):
+    """Prints the changes against a baseline; returns the regressions found."""
+    regressions = []
+    print(f'\nAgainst baseline from {baseline["meta"]["date"]} (tolerance {tolerance:.0%}):')
+    for name, r in results.items():
+        base = baseline['scenarios'].get(name)
+        if not base:
+            continue
+        notes = []
+        if r['p95_ms'] > base['p95_ms'] * (1 + tolerance):
+            notes.append(f'p95 {base["p95_ms"]} -> {r["p95_ms"]} ms')
+        if r['throughput_rps'] < base['throughput_rps'] * (1 - tolerance):
+            notes.append(f'throughput {base["throughput_rps"]} -> {r["throughput_rps"]} req/s')
+        if None not in (r['queries_per_request'], base['queries_per_request']) \
+                and r['queries_per_request'] > base['queries_per_request']:
+            notes.append(f'queries {base["queries_per_request"]:g} -> {r["queries_per_request"]:g} per request')
+        if notes:
+            regressions.append(name)
+        print(f'  {name:<16}{"REGRESSED: " + "; ".join(notes) if notes else "ok"}')
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sales', type=int, default=1_000_000)
+    parser.add_argument('--db', default='/tmp/energy_load.db')
+    parser.add_argument('--requests', type=int, default=500, help='requests per scenario')
+    parser.add_argument('--login-requests', type=int, default=50,
+                        help='requests for the login scenario, which is bound by bcrypt')
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS))
+    parser.add_argument('--base-url', help='run against this server instead of an in-process one')
+    parser.add_argument('--callback-delay', type=float, default=0.5)
+    parser.add_argument('--live-daraja', action='store_true',
+                        help='send STK pushes to the mock through the Daraja client')
+    parser.add_argument('--save', metavar='NAME', help='save the results as baselines/NAME.json')
+    parser.add_argument('--compare', metavar='NAME', help='compare against baselines/NAME.json')
+    parser.add_argument('--tolerance', type=float, default=0.2)
+    args = parser.parse_args()
+
+    names = [name.strip() for name in args.scenarios.split(',') if name.strip()]
+    unknown = set(names) - set(SCENARIOS)
+    if unknown:
+        parser.error(f'unknown scenarios: {", ".join(sorted(unknown))}')
+
+    if args.live_daraja and args.base_url:
+        parser.error('--live-daraja needs the in-process server')
+
+    daraja = MockDaraja(callback_delay=args.callback_delay).start()
+    server = counter = None
+    base_url = args.base_url
+    if not base_url:
+        app = create_app(load_config(args.db, daraja.url if args.live_daraja else None))
+        prepare_database(app, args.db, args.sales)
+        counter = StatementCounter()
+        counter.install(app)
+        logging.getLogger('werkzeug').setLevel(logging.WARNING)
+        server = make_server('127.0.0.1', 0, app, threaded=True)
+        threading.Thread(target=server.serve_forever, name='load-server', daemon=True).start()
+        base_url = f'http://127.0.0.1:{server.server_port}'
+        app.config['MPESA_CALLBACK_URL'] = base_url + '/api/mpesa/callback'
+
+    client = Client(base_url)
+    scenarios = Scenarios(client, daraja, base_url + '/api/mpesa/callback', args.live_daraja)
+
+    results = {}
+    for name in names:
+        requests = args.login_requests if name == 'login' else args.requests
+        print(f'Running {name}: {requests} requests at concurrency {args.concurrency}')
+        results[name] = run_scenario(name, getattr(scenarios, name), requests, args.concurrency, counter)
+    print_results(results)
+
+    if 'stk_push' in results:
+        if counter:
+            counter.reset()
+        stats = wait_for_callbacks(daraja, args.callback_delay + 30)
+        line = f'\nCallbacks delivered: {stats["callbacks_sent"]}, failed: {stats["callbacks_failed"]}'
+        if args.live_daraja:
+            line += f', OAuth token requests: {stats["oauth"]}'
+        if counter and counter.per_request('main.mpesa_callback') is not None:
+            line += f', {counter.per_request("main.mpesa_callback"):g} queries per callback'
+        print(line)
+
+    daraja.stop()
+    if server:
+        server.shutdown()
+
+    document = {
+        'meta': {
+            'date': datetime.now().isoformat(timespec='seconds'),
+            'sales': None if args.base_url else args.sales,
+            'base_url': args.base_url,
+            'requests': args.requests,
+            'login_requests': args.login_requests,
+            'concurrency': args.concurrency,
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpus': os.cpu_count(),
+        },
+        'scenarios': results,
+    }
+
+    regressions = []
+    if args.compare:
+        with open(os.path.join(BASELINE_DIR, args.compare + '.json')) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+
+    if args.save:
+        os.makedirs(BASELINE_DIR, exist_ok=True)
+        path = os.path.join(BASELINE_DIR, args.save + '.json')
+        with open(path, 'w') as f:
+            json.dump(document, f, indent=2)
+        print(f'Saved {path}')
+
+    if regressions:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
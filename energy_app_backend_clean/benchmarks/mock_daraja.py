@@ -0,0 +1,197 @@
+"""A local stand-in for the Safaricom Daraja API.
+
+Serves the OAuth, STK push and STK query endpoints and delivers Daraja-shaped
+result callbacks to the CallBackURL after a delay, so payment flows can be
+exercised without network access or sandbox credentials.
+
+    python -m benchmarks.mock_daraja [--port 8089] [--callback-delay 2] [--success-rate 0.8]
+"""
+import argparse
+import base64
+import json
+import random
+import threading
+import time
+import urllib.request
+import uuid
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse
+
+FAILURES = [
+    (1, 'The balance is insufficient for the transaction.'),
+    (1032, 'Request cancelled by user.'),
+    (1037, 'DS timeout user cannot be reached.'),
+]
+
+
+class MockDaraja:
+    """Runs the mock API on a background thread; `url` is its base address."""
+
+    def __init__(self, host='127.0.0.1', port=0, callback_delay=2.0, success_rate=0.8,
+                 token_ttl=3599, latency=0.0):
+        self.callback_delay = callback_delay
+        self.success_rate = success_rate
+        self.token_ttl = token_ttl
+        self.latency = latency
+        self.stats = {'oauth': 0, 'stk_push': 0, 'stk_query': 0,
+                      'callbacks_scheduled': 0, 'callbacks_sent': 0, 'callbacks_failed': 0}
+        self.results = {}
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer((host, port), self._handler())
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self._server.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, name='mock-daraja', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def _count(self, key):
+        with self._lock:
+            self.stats[key] += 1
+
+    def schedule_callback(self, checkout_request_id, merchant_request_id, callback_url, amount=1, phone=None):
+        """Decides the outcome of a push and POSTs it to `callback_url` after callback_delay."""
+        if random.random() < self.success_rate:
+            result_code, result_desc = 0, 'The service request is processed successfully.'
+        else:
+            result_code, result_desc = random.choice(FAILURES)
+        callback = {
+            'MerchantRequestID': merchant_request_id,
+            'CheckoutRequestID': checkout_request_id,
+            'ResultCode': result_code,
+            'ResultDesc': result_desc,
+        }
+        if result_code == 0:
+            callback['CallbackMetadata'] = {'Item': [
+                {'Name': 'Amount', 'Value': amount},
+                {'Name': 'MpesaReceiptNumber', 'Value': 'MK' + uuid.uuid4().hex[:8].upper()},
+                {'Name': 'TransactionDate', 'Value': int(datetime.now().strftime('%Y%m%d%H%M%S'))},
+                {'Name': 'PhoneNumber', 'Value': phone},
+            ]}
+        with self._lock:
+            self.results[checkout_request_id] = callback
+            self.stats['callbacks_scheduled'] += 1
+        timer = threading.Timer(self.callback_delay, self._deliver, args=(callback_url, {'Body': {'stkCallback': callback}}))
+        timer.daemon = True
+        timer.start()
+
+    def _deliver(self, callback_url, payload):
+        request = urllib.request.Request(
+            callback_url, data=json.dumps(payload).encode('utf-8'),
+            headers={'Content-Type': 'application/json'}, method='POST'
+        )
+        try:
+            with urllib.request.urlopen(request, timeout=10) as response:
+                response.read()
+            self._count('callbacks_sent')
+        except OSError:
+            self._count('callbacks_failed')
+
+    def _handler(self):
+        mock = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, format, *args):
+                pass
+
+            def _send(self, status, body):
+                data = json.dumps(body).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def _body(self):
+                length = int(self.headers.get('Content-Length') or 0)
+                return json.loads(self.rfile.read(length) or b'{}')
+
+            def _authorized(self):
+                return self.headers.get('Authorization', '').startswith('Bearer mock-')
+
+            def do_GET(self):
+                if mock.latency:
+                    time.sleep(mock.latency)
+                path = urlparse(self.path).path
+                if path == '/oauth/v1/generate':
+                    auth = self.headers.get('Authorization', '')
+                    if not auth.startswith('Basic ') or ':' not in base64.b64decode(auth[6:]).decode('utf-8', 'replace'):
+                        return self._send(400, {'errorCode': '400.008.01', 'errorMessage': 'Invalid Authentication passed'})
+                    mock._count('oauth')
+                    return self._send(200, {'access_token': 'mock-' + uuid.uuid4().hex, 'expires_in': str(mock.token_ttl)})
+                if path == '/stats':
+                    return self._send(200, mock.stats)
+                self._send(404, {'errorMessage': 'Not found'})
+
+            def do_POST(self):
+                if mock.latency:
+                    time.sleep(mock.latency)
+                path = urlparse(self.path).path
+                body = self._body()
+                if path == '/mpesa/stkpush/v1/processrequest':
+                    if not self._authorized():
+                        return self._send(401, {'errorCode': '404.001.03', 'errorMessage': 'Invalid Access Token'})
+                    mock._count('stk_push')
+                    checkout_request_id = 'ws_CO_' + uuid.uuid4().hex
+                    merchant_request_id = uuid.uuid4().hex[:12]
+                    mock.schedule_callback(checkout_request_id, merchant_request_id, body.get('CallBackURL'),
+                                           body.get('Amount', 1), body.get('PhoneNumber'))
+                    return self._send(200, {
+                        'MerchantRequestID': merchant_request_id,
+                        'CheckoutRequestID': checkout_request_id,
+                        'ResponseCode': '0',
+                        'ResponseDescription': 'Success. Request accepted for processing',
+                        'CustomerMessage': 'Success. Request accepted for processing',
+                    })
+                if path == '/mpesa/stkpushquery/v1/query':
+                    if not self._authorized():
+                        return self._send(401, {'errorCode': '404.001.03', 'errorMessage': 'Invalid Access Token'})
+                    mock._count('stk_query')
+                    result = mock.results.get(body.get('CheckoutRequestID'))
+                    if result is None:
+                        return self._send(500, {'errorCode': '500.001.1001', 'errorMessage': 'The transaction is being processed'})
+                    return self._send(200, {'ResponseCode': '0', 'ResultCode': str(result['ResultCode']),
+                                            'ResultDesc': result['ResultDesc'],
+                                            'CheckoutRequestID': result['CheckoutRequestID']})
+                if path == '/simulate/callback':
+                    # For flows where the app creates the checkout id itself (the built-in simulation)
+                    mock.schedule_callback(body['CheckoutRequestID'], body.get('MerchantRequestID', ''),
+                                           body['CallBackURL'], body.get('Amount', 1), body.get('PhoneNumber'))
+                    return self._send(202, {'scheduled': True})
+                self._send(404, {'errorMessage': 'Not found'})
+
+        return Handler
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8089)
+    parser.add_argument('--callback-delay', type=float, default=2.0)
+    parser.add_argument('--success-rate', type=float, default=0.8)
+    args = parser.parse_args()
+
+    mock = MockDaraja(args.host, args.port, args.callback_delay, args.success_rate).start()
+    print(f'Mock Daraja listening on {mock.url}')
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        mock.stop()
+
+
+if __name__ == '__main__':
+    main()
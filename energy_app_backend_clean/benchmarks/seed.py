@@ -0,0 +1,112 @@
+"""Bulk seeding of a realistic station history for the benchmarks.
+
+Rows go in through the model tables with executemany, so seeding a million
+sales takes seconds rather than the hours the ORM would need.
+"""
+import random
+from datetime import datetime, timedelta
+
+from app.models import (
+    MpesaTransaction, Pump, PumpShift, SalesRecord, Shift, User, UserRole
+)
+from app.search import index_mobile_numbers, normalize_mobile
+
+PUMPS = 12
+ATTENDANTS = 40
+CUSTOMERS = 50000
+SHIFT_HOURS = 12
+SALES_PER_PUMP_SHIFT = 200
+BATCH_SIZE = 50000
+START = datetime(2025, 1, 1)
+
+# Share of STK pushes that fail, with the Daraja result codes they fail with
+FAILURE_RATE = 0.12
+FAILURE_CODES = [('1', 'The balance is insufficient for the transaction.'),
+                 ('1032', 'Request cancelled by user.'),
+                 ('1037', 'DS timeout user cannot be reached.')]
+
+
+def seed(conn, rows, password_hash='x', seed_value=42):
+    """Inserts roles, shifts, pumps, attendants, pump shifts and `rows` sales with their M-Pesa transactions.
+
+    Each pump works a day and a night shift per day; the last night shift of
+    every pump is left open. Attendants are attendant1..attendantN, all with
+    `password_hash`. Returns the checkout request ids of a sample of the sales,
+    never empty while `rows` is positive.
+    """
+    rng = random.Random(seed_value)
+    conn.execute(UserRole.__table__.insert(), [{'role_id': 1, 'role_name': 'Admin'},
+                                                {'role_id': 2, 'role_name': 'Pump Attendant'}])
+    conn.execute(Shift.__table__.insert(), [{'shift_id': 1, 'shift_name': 'Day Shift'},
+                                             {'shift_id': 2, 'shift_name': 'Night Shift'}])
+    conn.execute(Pump.__table__.insert(), [
+        {'pump_id': p, 'pump_no': f'P{p}', 'pump_name': f'Pump {p}', 'is_active': True}
+        for p in range(1, PUMPS + 1)])
+    conn.execute(User.__table__.insert(), [
+        {'user_id': u, 'full_name': f'Attendant {u}', 'username': f'attendant{u}',
+         'password_hash': password_hash, 'role_id': 2, 'is_active': True}
+        for u in range(1, ATTENDANTS + 1)])
+
+    days = max(1, rows // (PUMPS * 2 * SALES_PER_PUMP_SHIFT))
+    shifts = []
+    for day in range(days):
+        for half in range(2):
+            opened = START + timedelta(days=day, hours=half * SHIFT_HOURS)
+            last = day == days - 1 and half == 1
+            for pump in range(1, PUMPS + 1):
+                attendant = rng.randint(1, ATTENDANTS)
+                shifts.append({
+                    'pump_shift_id': len(shifts) + 1, 'pump_id': pump, 'shift_id': half + 1,
+                    'opening_attendant_id': attendant, 'opening_time': opened, 'opening_meter_reading': 0,
+                    'closing_attendant_id': None if last else attendant,
+                    'closing_time': None if last else opened + timedelta(hours=SHIFT_HOURS),
+                    'closing_meter_reading': None if last else 0,
+                    'is_closed': not last,
+                })
+    conn.execute(PumpShift.__table__.insert(), shifts)
+
+    customers = [f'0712{n:06d}' for n in rng.sample(range(1000000), CUSTOMERS)]
+    index_mobile_numbers(conn, [normalize_mobile(mobile) for mobile in customers])
+
+    checkout_ids = []
+    sales, transactions = [], []
+    for sale_id in range(1, rows + 1):
+        shift = shifts[rng.randrange(len(shifts))]
+        sale_time = shift['opening_time'] + timedelta(seconds=rng.randrange(SHIFT_HOURS * 3600))
+        mobile = customers[rng.randrange(CUSTOMERS)]
+        amount = rng.randint(100, 5000)
+        checkout = f'ws_CO_{rng.getrandbits(64):016x}'
+        if rng.random() < FAILURE_RATE:
+            result_code, result_description = rng.choice(FAILURE_CODES)
+            status, receipt = 'FAILED', None
+        else:
+            result_code, result_description = '0', 'The service request is processed successfully.'
+            status, receipt = 'SUCCESS', f'MK{sale_id:08X}'
+        sales.append({
+            'sale_id': sale_id, 'sale_id_no': f'S{sale_id}', 'pump_shift_id': shift['pump_shift_id'],
+            'pump_id': shift['pump_id'], 'attendant_id': shift['opening_attendant_id'], 'sale_time': sale_time,
+            'amount': amount, 'customer_mobile_no': mobile, 'customer_mobile_norm': normalize_mobile(mobile),
+            'mpesa_transaction_code': receipt, 'transaction_status': status,
+        })
+        transactions.append({
+            'transaction_id': sale_id, 'sale_id': sale_id, 'mobile_no': mobile, 'amount': amount,
+            'request_time': sale_time, 'checkout_request_id': checkout, 'merchant_request_id': checkout,
+            'response_code': '0', 'response_description': 'Success. Request accepted for processing',
+            'result_code': result_code, 'result_description': result_description, 'mpesa_receipt_number': receipt,
+        })
+        # Every 997th sale, and always the last, so small runs have a sample too
+        if sale_id % 997 == 0 or sale_id == rows:
+            checkout_ids.append(checkout)
+        if len(sales) == BATCH_SIZE:
+            _flush(conn, sales, transactions)
+    _flush(conn, sales, transactions)
+    return checkout_ids
+
+
+def _flush(conn, sales, transactions):
+    if not sales:
+        return
+    conn.execute(SalesRecord.__table__.insert(), sales)
+    conn.execute(MpesaTransaction.__table__.insert(), transactions)
+    sales.clear()
+    transactions.clear()
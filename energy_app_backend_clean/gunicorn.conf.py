@@ -0,0 +1,36 @@
+import multiprocessing
+import os
+
+# The app is imported (and the schema bootstrapped) once in the master, then forked into
+# the workers, so a restart or a new container serves requests as soon as the workers fork
+wsgi_app = 'wsgi:app'
+preload_app = True
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '5000')}"
+workers = int(os.environ.get('WEB_CONCURRENCY', multiprocessing.cpu_count() * 2 + 1))
+
+# gthread serves each request, including every open /api/events/stream, on a worker thread.
+# For many live dashboards set GUNICORN_WORKER_CLASS=gevent (needs the gevent package):
+# each stream is then a parked greenlet instead of a thread.
+worker_class = os.environ.get('GUNICORN_WORKER_CLASS', 'gthread')
+threads = int(os.environ.get('GUNICORN_THREADS', 8))
+worker_connections = int(os.environ.get('GUNICORN_WORKER_CONNECTIONS', 1000)) # gevent only
+
+if worker_class == 'gthread':
+    # Streams beyond half the threads are turned away (503), so they cannot starve other requests.
+    # Set before the app is preloaded, which reads it into EVENT_MAX_SUBSCRIBERS
+    os.environ.setdefault('EVENT_MAX_SUBSCRIBERS', str(max(1, threads // 2)))
+
+if worker_class == 'gevent':
+    # Patch before the preloaded app creates its locks and threads
+    from gevent import monkey
+    monkey.patch_all()
+
+# Long-polled status requests wait up to MPESA_STATUS_MAX_WAIT; event streams send a
+# keep-alive every EVENT_HEARTBEAT_INTERVAL, well within this
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', 60))
+graceful_timeout = 30
+keepalive = 5
+
+accesslog = '-'
+errorlog = '-'
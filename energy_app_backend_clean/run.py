@@ -4,7 +4,8 @@ from app.models import initialize_db
 app = create_app()
 
 if __name__ == '__main__':
-    # Initialize the database with default data
+    # Create or upgrade the database and seed default data; a no-op when it is already current.
+    # Production runs wsgi.py under gunicorn instead (gunicorn -c gunicorn.conf.py)
     initialize_db(app)
     
     # Run the Flask application
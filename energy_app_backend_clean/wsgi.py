@@ -0,0 +1,12 @@
+from app import create_app, db
+from app.bootstrap import bootstrap_database
+
+# Production entry point: gunicorn -c gunicorn.conf.py (see there for workers and preloading)
+app = create_app()
+
+if app.config['SCHEMA_BOOTSTRAP_ON_START']:
+    with app.app_context():
+        # One query when the schema is current; a full upgrade and seed only after a release bumps it
+        bootstrap_database()
+        # With preload_app the workers are forked from this process and must not inherit its connections
+        db.engine.dispose()